@@ -0,0 +1,260 @@
+"""
+Read-only analytic snapshot of the ETL results.
+
+At the end of the ETL, the user summaries, volume rankings, and daily totals are written to a compact binary file. API
+workers memory-map the file and answer lookups by binary search directly on the mapped pages, so every worker shares a
+single page-cache copy of the data and most requests never touch the SQLite Database.
+
+File layout (little-endian, fixed-width records):
+    - Header: magic, format version, country field width, number of user, daily, and top user records.
+    - User records sorted by user_id: user_id, country, total amount, deposits, withdrawals, purchases, volume, rank.
+    - Daily records sorted by date and transaction type: date, transaction type, daily total, transaction count.
+    - Top user records sorted by volume rank: user_id, transaction volume.
+"""
+
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+
+import logs
+import settings
+
+SNAPSHOT_MAGIC = b'MLSNAP01'
+SNAPSHOT_VERSION = 1
+HEADER_FORMAT = struct.Struct('<8sIIIII')
+DAILY_RECORD_FORMAT = struct.Struct('<10s10sdq')
+TOP_USER_RECORD_FORMAT = struct.Struct('<qq')
+
+_snapshot_cache = {}
+_snapshot_lock = threading.Lock()
+
+
+def _user_record_format(country_width):
+    """Returns the struct describing a user record for the given country field width."""
+    return struct.Struct(f'<q{country_width}sddddqq')
+
+def write_snapshot(db_path, snapshot_path, top_n=10):
+    """
+    Writes the ETL results from the database to a snapshot file. The file is written to a temporary path and renamed
+    into place so API workers never map a partially written snapshot.
+
+    :param db_path: Path to the SQLite database containing the fused ETL output tables.
+    :param snapshot_path: Path of the snapshot file to write.
+    :param top_n: Number of top users by transaction volume to store.
+    :return: None
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        users = conn.execute("""
+            SELECT
+                u.user_id,
+                u.country,
+                u.total_transaction_amount,
+                u.total_deposit,
+                u.total_withdrawal,
+                u.total_purchase,
+                r.transaction_volume,
+                r.volume_rank
+            FROM
+                users u
+            JOIN
+                user_volume_rankings r
+            ON
+                u.user_id = r.user_id
+            ORDER BY
+                u.user_id ASC;
+        """).fetchall()
+        daily = conn.execute("""
+            SELECT transaction_date, transaction_type, daily_total, transaction_count
+            FROM daily_transaction_totals
+            ORDER BY transaction_date, transaction_type;
+        """).fetchall()
+        top_users = conn.execute("""
+            SELECT user_id, transaction_volume
+            FROM user_volume_rankings
+            ORDER BY volume_rank
+            LIMIT ?;
+        """, (top_n,)).fetchall()
+    except sqlite3.Error as e:
+        logs.log_error(f'Analytic snapshot could not be read from SQLite Database. Error: {e}')
+        raise
+    finally:
+        conn.close()
+
+    encoded_countries = [(row[1] or '').encode('utf-8') for row in users]
+    country_width = max((len(country) for country in encoded_countries), default=1)
+    user_format = _user_record_format(country_width)
+
+    temp_path = f'{snapshot_path}.tmp'
+    with open(temp_path, 'wb') as snapshot_file:
+        snapshot_file.write(HEADER_FORMAT.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, country_width,
+                                               len(users), len(daily), len(top_users)))
+        for row, country in zip(users, encoded_countries):
+            snapshot_file.write(user_format.pack(row[0], country, row[2] or 0.0, row[3] or 0.0, row[4] or 0.0,
+                                                 row[5] or 0.0, row[6], row[7]))
+        for transaction_date, transaction_type, daily_total, transaction_count in daily:
+            snapshot_file.write(DAILY_RECORD_FORMAT.pack(transaction_date.encode('utf-8'),
+                                                         transaction_type.encode('utf-8'),
+                                                         daily_total, transaction_count))
+        for user_id, transaction_volume in top_users:
+            snapshot_file.write(TOP_USER_RECORD_FORMAT.pack(user_id, transaction_volume))
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+    os.replace(temp_path, snapshot_path)
+
+    logs.log_event(f'Analytic snapshot written to {snapshot_path}: {len(users)} users, {len(daily)} daily totals, '
+                   f'{len(top_users)} top users.')
+
+
+class AnalyticSnapshot:
+    """
+    Memory-mapped, read-only view of a snapshot file. Records are decoded on demand straight from the mapped pages.
+    """
+
+    def __init__(self, snapshot_path):
+        with open(snapshot_path, 'rb') as snapshot_file:
+            self._mmap = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, country_width, self.user_count, self.daily_count, self.top_user_count = \
+            HEADER_FORMAT.unpack_from(self._mmap, 0)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            self._mmap.close()
+            raise ValueError(f'{snapshot_path} is not a supported analytic snapshot.')
+
+        self._user_format = _user_record_format(country_width)
+        self._users_offset = HEADER_FORMAT.size
+        self._daily_offset = self._users_offset + self.user_count * self._user_format.size
+        self._top_users_offset = self._daily_offset + self.daily_count * DAILY_RECORD_FORMAT.size
+
+    def _user_id_at(self, index):
+        return struct.unpack_from('<q', self._mmap, self._users_offset + index * self._user_format.size)[0]
+
+    def _user_at(self, index):
+        return self._user_format.unpack_from(self._mmap, self._users_offset + index * self._user_format.size)
+
+    def _date_at(self, index):
+        offset = self._daily_offset + index * DAILY_RECORD_FORMAT.size
+        return self._mmap[offset:offset + 10]
+
+    def _find_user(self, user_id):
+        """Binary search over the sorted user records. Returns the record index or None."""
+        low, high = 0, self.user_count
+        while low < high:
+            mid = (low + high) // 2
+            if self._user_id_at(mid) < user_id:
+                low = mid + 1
+            else:
+                high = mid
+        if low < self.user_count and self._user_id_at(low) == user_id:
+            return low
+        return None
+
+    def get_user_summary(self, user_id):
+        """
+        Looks up a user's transaction summary.
+        :param user_id: Integer user ID.
+        :return: Dictionary shaped like the user transaction summary API response, or None if the user has no
+        transactions.
+        """
+        index = self._find_user(user_id)
+        if index is None:
+            return None
+        user_id, country, total, deposit, withdrawal, purchase, _, _ = self._user_at(index)
+        return {
+            'user_id': user_id,
+            'country': country.rstrip(b'\x00').decode('utf-8'),
+            'total_transaction_amount': total,
+            'total_deposit': deposit,
+            'total_withdrawal': withdrawal,
+            'total_purchase': purchase,
+        }
+
+    def get_daily_transactions(self, transaction_date):
+        """
+        Looks up the daily totals per transaction type for a date.
+        :param transaction_date: Date string in the format YYYY-MM-DD.
+        :return: List of dictionaries shaped like the daily transactions API response.
+        """
+        key = transaction_date.encode('utf-8')
+        if len(key) != 10:
+            return []  # Only YYYY-MM-DD matches. Longer values must not be truncated onto a stored date.
+        low, high = 0, self.daily_count
+        while low < high:
+            mid = (low + high) // 2
+            if self._date_at(mid) < key:
+                low = mid + 1
+            else:
+                high = mid
+
+        result = []
+        while low < self.daily_count and self._date_at(low) == key:
+            date, transaction_type, daily_total, _ = DAILY_RECORD_FORMAT.unpack_from(
+                self._mmap, self._daily_offset + low * DAILY_RECORD_FORMAT.size)
+            result.append({
+                'transaction_date': date.rstrip(b'\x00').decode('utf-8'),
+                'transaction_type': transaction_type.rstrip(b'\x00').decode('utf-8'),
+                'daily_total': daily_total,
+            })
+            low += 1
+        return result
+
+    def get_top_users(self):
+        """
+        Returns the top users by transaction volume.
+        :return: List of dictionaries shaped like the top users API response.
+        """
+        result = []
+        for index in range(self.top_user_count):
+            user_id, transaction_volume = TOP_USER_RECORD_FORMAT.unpack_from(
+                self._mmap, self._top_users_offset + index * TOP_USER_RECORD_FORMAT.size)
+            user_index = self._find_user(user_id)
+            country = self._user_at(user_index)[1].rstrip(b'\x00').decode('utf-8') if user_index is not None else None
+            result.append({'user_id': user_id, 'country': country, 'transaction_count': transaction_volume})
+        return result
+
+    def close(self):
+        self._mmap.close()
+
+
+def load_snapshot(snapshot_path):
+    """
+    Returns the memory-mapped snapshot for the path, remapping it when the file has been replaced by a newer ETL run.
+    :param snapshot_path: Path of the snapshot file.
+    :return: AnalyticSnapshot, or None if no snapshot file exists.
+    """
+    try:
+        stat = os.stat(snapshot_path)
+    except FileNotFoundError:
+        return None
+
+    version_key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    with _snapshot_lock:
+        cached = _snapshot_cache.get(snapshot_path)
+        if cached is not None and cached[0] == version_key:
+            return cached[1]
+        try:
+            snapshot = AnalyticSnapshot(snapshot_path)
+        except (OSError, ValueError, struct.error) as e:
+            logs.log_error(f'Analytic snapshot {snapshot_path} could not be mapped. Error: {e}')
+            return None
+        _snapshot_cache[snapshot_path] = (version_key, snapshot)
+        return snapshot
+
+def snapshot_enabled():
+    """
+    Returns True if the ETL writes the snapshot: only the fused scan does, and only on a single database.
+    :return: bool
+    """
+    return settings.WRITE_ANALYTIC_SNAPSHOT and settings.USE_FUSED_ETL_SCAN and settings.SHARD_COUNT <= 1
+
+def get_snapshot():
+    """
+    Returns the snapshot configured in settings if snapshot serving is enabled. The snapshot is only served when the
+    ETL writes it, so a file left by an earlier run is not served after the settings change.
+    :return: AnalyticSnapshot or None
+    """
+    if not settings.SERVE_FROM_ANALYTIC_SNAPSHOT or not snapshot_enabled():
+        return None
+    return load_snapshot(settings.ANALYTIC_SNAPSHOT_PATH)
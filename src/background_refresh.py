@@ -0,0 +1,148 @@
+"""
+Background data refresh decoupled from the serving process.
+
+With BACKGROUND_REFRESH enabled, the API server starts immediately against the last good database and analytic
+snapshot, and ingestion and ETL run in a separate process against a copy of the database:
+    1. The live database is copied to a build database with the SQLite backup API, and the live snapshot is copied
+       next to it, so unchanged ingestion and ETL stages are skipped in the build.
+    2. A child process points the application at the build files and runs data_import_executive() and etl_executive().
+    3. If the build changed any data, it is swapped in: the build database is copied into the live database with the
+       backup API in a single transaction, and the build snapshot is renamed over the live snapshot.
+
+The database is swapped with the backup API rather than by renaming the file, because renaming a file over a WAL-mode
+database while readers hold connections to it would pair the new file with the old write-ahead log. Readers see either
+the old or the new data, never a mix, and are not blocked during the copy. Micro-batches of the ingestion daemon are
+paused while a refresh runs so that none is overwritten by the swap. Sharded storage is not supported: the build would
+write to its own shard files, which are never swapped into the live shards.
+"""
+
+import os
+import shutil
+import sqlite3
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import logs
+import settings
+import sharding
+import utility_library
+
+
+def copy_database(source_path, destination_path):
+    """
+    Copies a SQLite database with the online backup API, which produces a consistent copy while other connections
+    keep reading and writing the source.
+    :param source_path: Path of the database to copy.
+    :param destination_path: Path of the destination database. Its contents are replaced.
+    :return: None
+    """
+    source = sqlite3.connect(source_path)
+    destination = sqlite3.connect(destination_path)
+    try:
+        source.backup(destination)
+    finally:
+        destination.close()
+        source.close()
+
+def remove_database_files(db_path):
+    """Removes a database file together with its write-ahead log and shared memory files."""
+    for path in (db_path, f'{db_path}-wal', f'{db_path}-shm'):
+        if os.path.exists(path):
+            os.remove(path)
+
+def check_unsharded():
+    """
+    Raises if sharded storage is enabled. Only the main database is copied and swapped, while sharded ingestion and ETL
+    write to the shard files, so a refresh would report new data while the old shards keep being served.
+    :return: None
+    """
+    if sharding.is_sharded():
+        raise RuntimeError('The background refresh does not support sharded storage. Set SHARD_COUNT to 1 or refresh '
+                           'the data with the ingest and etl commands.')
+
+def build_database(build_db_path, build_snapshot_path, users_csv_path, transactions_csv_path, log_file=None):
+    """
+    Runs ingestion and the ETL against the build files. Runs in a child process, so re-pointing the modules at the
+    build database does not affect the serving process.
+    :param build_db_path: Path of the build database.
+    :param build_snapshot_path: Path of the build analytic snapshot.
+    :param users_csv_path: Path of the users CSV file.
+    :param transactions_csv_path: Path of the transactions CSV file.
+    :param log_file: Log file of the parent process to append to, or None if logging is not initialized.
+    :return: True if the build changed any data.
+    """
+    import etl
+    import import_raw_to_db
+
+    if log_file is not None:
+        logs.init_logging(log_file)
+
+    utility_library.set_database_path(build_db_path)
+    settings.ANALYTIC_SNAPSHOT_PATH = build_snapshot_path
+    import_raw_to_db.USERS_PATH = users_csv_path
+    import_raw_to_db.TRANSACTIONS_PATH = transactions_csv_path
+
+    data_version = utility_library.get_metadata('data_version')
+    import_raw_to_db.data_import_executive()
+    etl.etl_executive()
+    return utility_library.get_metadata('data_version') != data_version
+
+def refresh_database(db_path=None, snapshot_path=None):
+    """
+    Builds fresh data in a separate process and swaps it into the live database and snapshot.
+    :param db_path: Path of the live database. Defaults to settings.DB_PATH.
+    :param snapshot_path: Path of the live analytic snapshot. Defaults to settings.ANALYTIC_SNAPSHOT_PATH.
+    :return: True if new data was swapped in.
+    """
+    import ingest_daemon  # Imported lazily, so the serving process only loads the ingestion modules when refreshing.
+
+    check_unsharded()
+    db_path = db_path or settings.DB_PATH
+    snapshot_path = snapshot_path or settings.ANALYTIC_SNAPSHOT_PATH
+    build_db_path = f'{db_path}{settings.REFRESH_BUILD_SUFFIX}'
+    build_snapshot_path = f'{snapshot_path}{settings.REFRESH_BUILD_SUFFIX}'
+
+    with ingest_daemon.batch_lock:
+        logs.log_event(f'Background refresh started. Building into {build_db_path}.')
+        remove_database_files(build_db_path)
+        if os.path.exists(db_path):
+            copy_database(db_path, build_db_path)
+        if os.path.exists(snapshot_path):
+            shutil.copyfile(snapshot_path, build_snapshot_path)
+
+        try:
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+                changed = executor.submit(build_database, build_db_path, build_snapshot_path,
+                                          settings.USER_CSV_PATH, settings.TRANSACTIONS_CSV_PATH,
+                                          logs.LOG_FILE).result()
+
+            if changed:
+                copy_database(build_db_path, db_path)
+                if os.path.exists(build_snapshot_path):
+                    os.replace(build_snapshot_path, snapshot_path)
+                logs.log_event(f'Background refresh completed. New data swapped into {db_path}.')
+            else:
+                logs.log_event(f'Background refresh completed. Data unchanged, nothing swapped.')
+            return changed
+        finally:
+            remove_database_files(build_db_path)
+            if os.path.exists(build_snapshot_path):
+                os.remove(build_snapshot_path)
+
+def start_background_refresh():
+    """
+    Runs refresh_database() on a background thread so the API server can start serving immediately.
+    :return: The started thread.
+    """
+    check_unsharded()  # Fails on startup rather than in the background thread.
+
+    def run():
+        try:
+            refresh_database()
+        except Exception as e:
+            logs.log_error(f'Background refresh failed. Serving the last good data. Error: {e}')
+
+    thread = threading.Thread(target=run, name='background-refresh', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,252 @@
+"""
+Load-testing and latency benchmark suite.
+
+1. Generates synthetic users and transactions at a configurable scale (e.g. 1M, 10M, or 100M transactions) with
+   synthetic_data.py, optionally with heavy users, bad rows, and duplicates.
+2. Runs data ingestion and the ETL against a temporary database and times each step.
+3. Drives the Flask API endpoints with a concurrent client and reports throughput and p50/p99 latency per endpoint.
+
+The API is exercised in-process through app.test_client() by default, or over HTTP against a local threaded server with
+--http.
+
+Usage:
+    python benchmark.py --scale 1M --concurrency 16 --requests 5000
+    python benchmark.py --scale 100k --http --output bench_results.json
+    python benchmark.py --scale 10M --user-skew 1.1 --bad-row-rate 0.001
+    python main.py bench --scale 1M
+"""
+
+import argparse
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import logs
+import settings
+import synthetic_data
+import utility_library
+
+
+def timed(timings, name, func, *args, **kwargs):
+    """
+    Runs a function and records its wall time in seconds under the given name.
+    :return: The function's return value.
+    """
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    timings[name] = time.perf_counter() - start
+    print(f'\t{name}: {timings[name]:.2f}s')
+    return result
+
+def run_pipeline_benchmark(db_path, users_path, transactions_path):
+    """
+    Runs ingestion and the ETL against the given database and records the wall time of each step.
+    :return: Dictionary of step name to seconds.
+    """
+    import import_raw_to_db
+    import etl
+
+    utility_library.set_database_path(db_path)
+    timings = {}
+    timed(timings, 'create_schema', import_raw_to_db.create_db_schemas, db_path)
+    timed(timings, 'ingest_users', import_raw_to_db.load_users_to_db, db_path, users_path)
+    timed(timings, 'ingest_transactions', import_raw_to_db.load_transactions_to_db, db_path, transactions_path)
+    timed(timings, 'etl', etl.etl_executive)
+    return timings
+
+def percentile(sorted_values, pct):
+    """
+    Nearest-rank percentile of an already sorted list.
+    :param sorted_values: Sorted list of numbers.
+    :param pct: Percentile between 0 and 100.
+    :return: The percentile value, or None for an empty list.
+    """
+    if not sorted_values:
+        return None
+    rank = max(1, int(np.ceil(pct / 100 * len(sorted_values))))
+    return sorted_values[rank - 1]
+
+def build_request_mix(db_path, num_requests, seed=0):
+    """
+    Builds a list of (endpoint name, URL path) pairs covering every data endpoint, using user IDs and dates that exist
+    in the database.
+    :return: List of tuples.
+    """
+    import sqlite3
+
+    conn = sqlite3.connect(db_path)
+    user_ids = [row[0] for row in conn.execute("SELECT user_id FROM users ORDER BY RANDOM() LIMIT 1000;")]
+    dates = [row[0] for row in conn.execute("SELECT DISTINCT transaction_date FROM transactions LIMIT 1000;")]
+    conn.close()
+
+    rng = random.Random(seed)
+    mix = []
+    for i in range(num_requests):
+        choice = i % 3
+        if choice == 0 and user_ids:
+            mix.append(('user_transaction_summary',
+                        f'/api/user_transaction_summary?user_id={rng.choice(user_ids)}'))
+        elif choice == 1 and dates:
+            mix.append(('daily_transactions', f'/api/daily_transactions?date={rng.choice(dates)}'))
+        else:
+            mix.append(('top_users', '/api/top_users'))
+    return mix
+
+def run_api_benchmark(request_mix, concurrency, base_url=None):
+    """
+    Sends every request in the mix using a pool of concurrent clients and measures per-request latency.
+    :param request_mix: List of (endpoint name, URL path) pairs.
+    :param concurrency: Number of concurrent clients.
+    :param base_url: URL of a local server. If None, requests go through the in-process Flask test client.
+    :return: Dictionary of endpoint name to throughput and latency statistics, plus an 'overall' entry.
+    """
+    local = threading.local()
+
+    def send(item):
+        name, path = item
+        start = time.perf_counter()
+        if base_url:
+            try:
+                with urllib.request.urlopen(base_url.rstrip('/') + path) as response:
+                    response.read()
+                    status = response.status
+            except urllib.error.HTTPError as e:
+                status = e.code
+        else:
+            if not hasattr(local, 'client'):
+                import flask_api
+                local.client = flask_api.app.test_client()
+            response = local.client.get(path)
+            response.get_data()
+            status = response.status_code
+        return name, status, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(send, request_mix))
+    elapsed = time.perf_counter() - start
+
+    grouped = {'overall': results}
+    for result in results:
+        grouped.setdefault(result[0], []).append(result)
+
+    report = {}
+    for name, endpoint_results in grouped.items():
+        latencies = sorted(result[2] for result in endpoint_results)
+        report[name] = {
+            'requests': len(endpoint_results),
+            'errors': sum(1 for result in endpoint_results if result[1] >= 500),
+            'throughput_rps': len(endpoint_results) / elapsed if elapsed else None,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+        }
+    return report
+
+def start_local_server():
+    """
+    Starts a threaded local HTTP server for the Flask app on a free port.
+    :return: Tuple of (server, base URL). Call server.shutdown() to stop it.
+    """
+    from werkzeug.serving import make_server
+    import flask_api
+
+    server = make_server('127.0.0.1', 0, flask_api.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+def print_api_report(report):
+    """
+    Prints the API benchmark report as a table.
+    :param report: Report returned by run_api_benchmark().
+    :return: None
+    """
+    print(f'{"Endpoint":<28}{"Requests":>10}{"Errors":>8}{"RPS":>10}{"p50 ms":>10}{"p99 ms":>10}')
+    for name, stats in report.items():
+        print(f'{name:<28}{stats["requests"]:>10}{stats["errors"]:>8}{stats["throughput_rps"]:>10.1f}'
+              f'{stats["p50_ms"]:>10.2f}{stats["p99_ms"]:>10.2f}')
+
+def run_benchmark(scale='100k', num_users=None, concurrency=8, num_requests=1000, use_http=False, work_dir=None,
+                  seed=0, user_skew=0.0, bad_row_rate=0.0, duplicate_rate=0.0):
+    """
+    Runs the full benchmark: data generation, ingestion and ETL timings, and the API load test. Everything runs against
+    a temporary database, and the original database settings are restored afterwards.
+    :return: Dictionary with the pipeline timings and the API report.
+    """
+    num_transactions = synthetic_data.parse_scale(scale)
+    bad_row_rates = synthetic_data.parse_bad_row_rates(bad_row_rate, None)
+    original_db_path, original_snapshot_path = settings.DB_PATH, settings.ANALYTIC_SNAPSHOT_PATH
+    try:
+        with tempfile.TemporaryDirectory(dir=work_dir) as temp_dir:
+            db_path = os.path.join(temp_dir, 'benchmark.db')
+            settings.ANALYTIC_SNAPSHOT_PATH = os.path.join(temp_dir, 'benchmark_snapshot.bin')
+
+            print(f'Generating {num_transactions} synthetic transactions...')
+            timings = {}
+            generated = timed(timings, 'generate_data', synthetic_data.generate_synthetic_data, temp_dir,
+                              num_transactions, num_users, seed, user_skew, bad_row_rates, duplicate_rate)
+            users_path, transactions_path = generated['users_path'], generated['transactions_path']
+            print(f'Running ingestion and ETL...')
+            timings.update(run_pipeline_benchmark(db_path, users_path, transactions_path))
+
+            print(f'Running API load test with {concurrency} concurrent clients...')
+            request_mix = build_request_mix(db_path, num_requests, seed)
+            server, base_url = start_local_server() if use_http else (None, None)
+            try:
+                api_report = run_api_benchmark(request_mix, concurrency, base_url)
+            finally:
+                if server is not None:
+                    server.shutdown()
+            print_api_report(api_report)
+    finally:
+        utility_library.set_database_path(original_db_path)
+        settings.ANALYTIC_SNAPSHOT_PATH = original_snapshot_path
+
+    return {
+        'scale': num_transactions,
+        'concurrency': concurrency,
+        'pipeline_seconds': timings,
+        'api': api_report,
+    }
+
+def main(argv=None):
+    """
+    Command line entry point, also used by `python main.py bench`.
+    :param argv: Command line arguments. Defaults to sys.argv.
+    :return: The benchmark results.
+    """
+    parser = argparse.ArgumentParser(description='Benchmark ingestion, ETL, and API latency on synthetic data.')
+    parser.add_argument('--scale', default='100k', help='Number of transactions, e.g. 1M, 10M, 100M.')
+    parser.add_argument('--users', default=None, help='Number of users, e.g. 100k. Defaults to scale / 10.')
+    parser.add_argument('--concurrency', type=int, default=8, help='Number of concurrent API clients.')
+    parser.add_argument('--requests', type=int, default=1000, help='Total number of API requests to send.')
+    parser.add_argument('--http', action='store_true',
+                        help='Send requests over HTTP to a local threaded server instead of the Flask test client.')
+    parser.add_argument('--work-dir', default=None, help='Directory for the temporary database and CSV files.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--user-skew', type=float, default=0.0,
+                        help='Power law exponent of transactions per user. 0 is uniform, around 1 gives heavy users.')
+    parser.add_argument('--bad-row-rate', type=float, default=0.0, help='Fraction of rows breaking each cleaner rule.')
+    parser.add_argument('--duplicate-rate', type=float, default=0.0, help='Fraction of rows with a duplicated ID.')
+    parser.add_argument('--output', default=None, help='Optional path to write the results as JSON.')
+    args = parser.parse_args(argv)
+
+    num_users = synthetic_data.parse_scale(args.users) if args.users else None
+    results = run_benchmark(args.scale, num_users, args.concurrency, args.requests, args.http, args.work_dir,
+                            args.seed, args.user_skew, args.bad_row_rate, args.duplicate_rate)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    logs.init_logging()
+    main()
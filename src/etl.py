@@ -8,17 +8,31 @@ TASK 2: ETL
 3. Loads the processed data back into the database or prepares it for use by the API.
 """
 
+import os
 import sqlite3
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
 import pandas as pd
 
+import analytic_snapshot
 import logs
+import pipeline_scheduler
+import prefix_sums
+import profiling
+import risk_scoring
+import rollup_cube
 import settings
+import sharding
+import sketches
 import utility_library
 
 DATABASE_PATH = settings.DB_PATH
 pd.set_option('display.max_columns', None)
 
 
+@profiling.profile_stage()
 def calculate_total_transaction_amount_per_user(log_events=True):
     """
     This function calculates the total transaction amount as defined by the sum of all transactions from the associated
@@ -58,6 +72,7 @@ def calculate_total_transaction_amount_per_user(log_events=True):
         # required tasks, I separated out the functionality.
     return result
 
+@profiling.profile_stage()
 def identify_top_ten_users_by_transaction_volume():
     """
     This function calculates the top users by transaction volume. Transaction volume is defined as the number of
@@ -91,6 +106,7 @@ def identify_top_ten_users_by_transaction_volume():
     logs.log_event(f'Task 2-2-2 Completed. Top Ten Users by Transaction Volume Calculated.')
     return result
 
+@profiling.profile_stage()
 def aggregate_daily_transactions():
     """
     This function aggregates the total deposits, purchases, and withdrawals made on each day in the dataset.
@@ -118,6 +134,7 @@ def aggregate_daily_transactions():
     logs.log_event(f'Task 2-2-3 Completed. Daily Aggregates by Transaction Type Calculated.')
     return result
 
+@profiling.profile_stage()
 def alter_users_table_for_transaction_summary():
     """
     Alter the users table to add the columns needed for transaction summary data if they don't already exist.
@@ -165,6 +182,7 @@ def alter_users_table_for_transaction_summary():
     print("Users table updated successfully with transaction summary columns.")
     logs.log_event(f'Task 2-3 Completed. Users table updated successfully with transaction summary columns.')
 
+@profiling.profile_stage()
 def upsert_transaction_summary_to_users():
     """
     This function updates the user table with the calculated transaction summary
@@ -173,6 +191,7 @@ def upsert_transaction_summary_to_users():
     Upsert = Update & Insert
     """
     transaction_summary = calculate_total_transaction_amount_per_user(log_events=False)
+    profiling.record_rows(len(transaction_summary))
 
     conn = sqlite3.connect(DATABASE_PATH)
     cursor = conn.cursor()
@@ -205,17 +224,420 @@ def upsert_transaction_summary_to_users():
     print("User transaction summary successfully updated without affecting existing user data.")
     logs.log_event(f'Task 2-3 Completed. User transaction summary successfully updated without affecting existing user data.')
 
-def etl_executive():
+def create_etl_output_tables(cursor):
+    """
+    Creates the destination tables for the ETL aggregates if they don't already exist.
+    - user_volume_rankings: Transaction volume and volume rank of every user with transactions.
+    - daily_transaction_totals: Total amount and number of transactions for each day and transaction type.
+    :param cursor: SQLite cursor used to create the tables.
+    :return: None
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS user_volume_rankings (
+            user_id INTEGER PRIMARY KEY,
+            transaction_volume INTEGER,
+            volume_rank INTEGER
+        );
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_volume_rankings_volume "
+                   "ON user_volume_rankings (transaction_volume, user_id);")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS daily_transaction_totals (
+            transaction_date TEXT,
+            transaction_type TEXT,
+            daily_total REAL,
+            transaction_count INTEGER,
+            PRIMARY KEY (transaction_date, transaction_type)
+        );
+    """)
+
+@profiling.profile_stage()
+def fused_etl_scan():
+    """
+    Single-pass alternative to the individual ETL tasks. The transactions table is streamed once through a cursor and
+    every row feeds three accumulators:
+        1. Total transaction amount per user, split by deposits, withdrawals, and purchases.
+        2. Transaction volume per user.
+        3. Daily transaction totals per transaction type.
+    The user summary is upserted into the users table, and the volume rankings and daily totals replace the contents of
+    the user_volume_rankings and daily_transaction_totals tables. All writes happen in a single database transaction.
+
+    As in the individual tasks, per-user results only include users present in the users table while the daily totals
+    include all transactions.
+    :return: Tuple of Pandas DataFrames (user summary, top ten users by transaction volume, daily aggregates)
+    """
+    alter_users_table_for_transaction_summary()
+
+    conn = sqlite3.connect(DATABASE_PATH)
+    cursor = conn.cursor()
+
+    cursor.execute("SELECT user_id FROM users;")
+    known_users = {row[0] for row in cursor.fetchall()}
+
+    user_totals = defaultdict(lambda: {'total': 0.0, 'deposit': 0.0, 'withdrawal': 0.0, 'purchase': 0.0})
+    user_volume = defaultdict(int)
+    daily_totals = defaultdict(lambda: [0.0, 0])
+
+    scanned_rows = 0
+    cursor.execute("SELECT user_id, transaction_date, amount, transaction_type FROM transactions;")
+    while True:
+        rows = cursor.fetchmany(settings.ETL_FETCH_SIZE)
+        if not rows:
+            break
+        scanned_rows += len(rows)
+        for user_id, transaction_date, amount, transaction_type in rows:
+            daily = daily_totals[(transaction_date, transaction_type)]
+            daily[0] += amount
+            daily[1] += 1
+            if user_id in known_users:
+                user_volume[user_id] += 1
+                totals = user_totals[user_id]
+                totals['total'] += amount
+                if transaction_type in totals:
+                    totals[transaction_type] += amount
+
+    profiling.record_rows(scanned_rows)
+
+    user_summary = pd.DataFrame(
+        [(user_id, totals['total'], totals['deposit'], totals['withdrawal'], totals['purchase'])
+         for user_id, totals in sorted(user_totals.items())],
+        columns=['user_id', 'total_transaction_amount', 'total_deposit', 'total_withdrawal', 'total_purchase'])
+    rankings = sorted(user_volume.items(), key=lambda item: (-item[1], item[0]))
+    top_ten = pd.DataFrame(rankings[:10], columns=['user_id', 'transaction_volume'])
+    daily_aggregates = pd.DataFrame(
+        [(transaction_date, transaction_type, total[0]) for (transaction_date, transaction_type), total
+         in sorted(daily_totals.items())],
+        columns=['transaction_date', 'transaction_type', 'daily_total'])
+
+    try:
+        create_etl_output_tables(cursor)
+        cursor.executemany("""
+            UPDATE users
+            SET
+                total_transaction_amount = ?,
+                total_deposit = ?,
+                total_withdrawal = ?,
+                total_purchase = ?
+            WHERE user_id = ?;
+        """, [(row.total_transaction_amount, row.total_deposit, row.total_withdrawal, row.total_purchase,
+               row.user_id) for row in user_summary.itertuples(index=False)])
+        cursor.execute("DELETE FROM user_volume_rankings;")
+        cursor.executemany("""
+            INSERT INTO user_volume_rankings (user_id, transaction_volume, volume_rank)
+            VALUES (?, ?, ?);
+        """, [(user_id, volume, rank) for rank, (user_id, volume) in enumerate(rankings, start=1)])
+        cursor.execute("DELETE FROM daily_transaction_totals;")
+        cursor.executemany("""
+            INSERT INTO daily_transaction_totals (transaction_date, transaction_type, daily_total, transaction_count)
+            VALUES (?, ?, ?, ?);
+        """, [(transaction_date, transaction_type, total[0], total[1])
+              for (transaction_date, transaction_type), total in daily_totals.items()])
+        conn.commit()
+    except sqlite3.Error as e:
+        conn.rollback()
+        logs.log_error(f'Fused ETL scan could not be loaded into SQLite Database. Error: {e}')
+        raise
+    finally:
+        conn.close()
+
+    if settings.DISPLAY_ETL_PROCESSES_TO_CONSOLE:
+        print(f'Total Transaction Amount Per User:')
+        print(user_summary)
+        print(f'\nTop Ten Users by Transaction Volume: ')
+        print(top_ten)
+        print(f'\nDaily Aggregates Per Transaction Type')
+        print(daily_aggregates)
+
+    logs.log_event(f'Task 2 Fused Scan Completed. User summary, volume rankings, and daily aggregates calculated in a '
+                   f'single pass and loaded into the database.')
+    return user_summary, top_ten, daily_aggregates
+
+def volume_range_condition(first, last):
+    """
+    Builds the condition matching the user_volume_rankings rows between two positions of the ranking order
+    (transaction_volume descending, then user_id ascending), inclusive.
+    :param first: Tuple (transaction_volume, user_id) of the first position.
+    :param last: Tuple (transaction_volume, user_id) of the last position.
+    :return: Tuple of the SQL condition and its parameters.
     """
-    Executive function that runs all ETL tasks in the appropriate order.
+    condition = ('(transaction_volume < ? OR (transaction_volume = ? AND user_id >= ?)) AND '
+                 '(transaction_volume > ? OR (transaction_volume = ? AND user_id <= ?))')
+    return condition, [first[0], first[0], first[1], last[0], last[0], last[1]]
+
+def update_volume_rankings(cursor, volumes):
+    """
+    Writes the new transaction volumes of some users into user_volume_rankings and moves only the ranks that changed.
+    Every moved user lies between the first and last old or new position of the updated users, so those rows are
+    re-ranked after the number of users ahead of them, and the rows after them shift by the number of users added or
+    removed. Users with no transactions are removed from the rankings.
+    :param cursor: SQLite cursor, in the caller's transaction.
+    :param volumes: Dictionary of user ID to new transaction volume.
     :return: None
     """
+    if not volumes:
+        return
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS ranked_users (user_id INTEGER PRIMARY KEY);")
+    cursor.execute("DELETE FROM ranked_users;")
+    cursor.executemany("INSERT INTO ranked_users (user_id) VALUES (?);", [(user_id,) for user_id in volumes])
+    old_volumes = dict(cursor.execute("""
+        SELECT user_id, transaction_volume FROM user_volume_rankings
+        WHERE user_id IN (SELECT user_id FROM ranked_users);
+    """).fetchall())
+    positions = [(volume, user_id) for user_id, volume in old_volumes.items()] + \
+                [(volume, user_id) for user_id, volume in volumes.items() if volume > 0]
+    if not positions:
+        return
+    order = lambda position: (-position[0], position[1])
+    first, last = min(positions, key=order), max(positions, key=order)
+    in_range, range_params = volume_range_condition(first, last)
+
+    # Users ahead of the range are unchanged, so their count is one less than the first old rank in the range.
+    first_rank = cursor.execute(f"SELECT MIN(volume_rank) FROM user_volume_rankings WHERE {in_range};",
+                                range_params).fetchone()[0]
+    if first_rank is None:
+        first_rank = cursor.execute(
+            "SELECT COUNT(*) + 1 FROM user_volume_rankings WHERE transaction_volume > ? OR "
+            "(transaction_volume = ? AND user_id < ?);", (first[0], first[0], first[1])).fetchone()[0]
 
-    calculate_total_transaction_amount_per_user()
-    identify_top_ten_users_by_transaction_volume()
-    aggregate_daily_transactions()
+    cursor.execute("DELETE FROM user_volume_rankings WHERE user_id IN (SELECT user_id FROM ranked_users);")
+    cursor.executemany("INSERT INTO user_volume_rankings (user_id, transaction_volume, volume_rank) VALUES (?, ?, 0);",
+                       [(user_id, volume) for user_id, volume in volumes.items() if volume > 0])
+    ranks = cursor.execute(f"""
+        SELECT user_id, volume_rank, ROW_NUMBER() OVER (ORDER BY transaction_volume DESC, user_id ASC)
+        FROM user_volume_rankings
+        WHERE {in_range};
+    """, range_params).fetchall()
+    cursor.executemany("UPDATE user_volume_rankings SET volume_rank = ? WHERE user_id = ?;",
+                       [(first_rank + row_number - 1, user_id) for user_id, rank, row_number in ranks
+                        if rank != first_rank + row_number - 1])
+
+    added = sum(volume > 0 for volume in volumes.values()) - len(old_volumes)
+    if added:
+        cursor.execute("""
+            UPDATE user_volume_rankings SET volume_rank = volume_rank + ?
+            WHERE transaction_volume < ? OR (transaction_volume = ? AND user_id > ?);
+        """, (added, last[0], last[0], last[1]))
+
+@profiling.profile_stage()
+def incremental_etl_update(user_ids, transaction_dates):
+    """
+    Updates the ETL outputs for newly ingested data without rescanning the whole transactions table. Only the affected
+    users and days are recomputed, using the transactions indexes on user_id and transaction_date:
+        1. The transaction summary columns in the users table and the volumes in user_volume_rankings for the users.
+        2. The daily_transaction_totals rows for the transaction dates.
+    Users left without transactions get zero totals and are removed from the rankings, and only the volume ranks that
+    moved are rewritten. All writes happen in a single transaction.
+    :param user_ids: User IDs whose transactions changed, or who were newly ingested.
+    :param transaction_dates: Transaction dates that received new transactions.
+    :return: None
+    """
     alter_users_table_for_transaction_summary()
-    upsert_transaction_summary_to_users()
+
+    conn = sqlite3.connect(DATABASE_PATH)
+    cursor = conn.cursor()
+    try:
+        create_etl_output_tables(cursor)
+        cursor.execute("CREATE TEMP TABLE IF NOT EXISTS affected_users (user_id INTEGER PRIMARY KEY);")
+        cursor.execute("CREATE TEMP TABLE IF NOT EXISTS affected_dates (transaction_date TEXT PRIMARY KEY);")
+        cursor.execute("DELETE FROM affected_users;")
+        cursor.execute("DELETE FROM affected_dates;")
+        cursor.executemany("INSERT OR IGNORE INTO affected_users (user_id) VALUES (?);",
+                           [(int(user_id),) for user_id in user_ids])
+        cursor.executemany("INSERT OR IGNORE INTO affected_dates (transaction_date) VALUES (?);",
+                           [(transaction_date,) for transaction_date in transaction_dates])
+
+        user_summary = cursor.execute("""
+            SELECT
+                u.user_id,
+                COALESCE(SUM(t.amount), 0.0) AS total_transaction_amount,
+                COALESCE(SUM(CASE WHEN t.transaction_type = 'deposit' THEN t.amount ELSE 0 END), 0.0) AS total_deposit,
+                COALESCE(SUM(CASE WHEN t.transaction_type = 'withdrawal' THEN t.amount ELSE 0 END), 0.0)
+                    AS total_withdrawal,
+                COALESCE(SUM(CASE WHEN t.transaction_type = 'purchase' THEN t.amount ELSE 0 END), 0.0)
+                    AS total_purchase,
+                COUNT(t.transaction_id) AS transaction_volume
+            FROM
+                affected_users a
+            JOIN
+                users u
+            ON
+                u.user_id = a.user_id
+            LEFT JOIN
+                transactions t
+            ON
+                t.user_id = a.user_id
+            GROUP BY
+                u.user_id;
+        """).fetchall()
+        cursor.executemany("""
+            UPDATE users
+            SET
+                total_transaction_amount = ?,
+                total_deposit = ?,
+                total_withdrawal = ?,
+                total_purchase = ?
+            WHERE user_id = ?;
+        """, [(row[1], row[2], row[3], row[4], row[0]) for row in user_summary])
+        update_volume_rankings(cursor, {row[0]: row[5] for row in user_summary})
+
+        cursor.execute("""
+            DELETE FROM daily_transaction_totals
+            WHERE transaction_date IN (SELECT transaction_date FROM affected_dates);
+        """)
+        cursor.execute("""
+            INSERT INTO daily_transaction_totals (transaction_date, transaction_type, daily_total, transaction_count)
+            SELECT
+                t.transaction_date,
+                t.transaction_type,
+                SUM(t.amount),
+                COUNT(*)
+            FROM
+                transactions t
+            WHERE
+                t.transaction_date IN (SELECT transaction_date FROM affected_dates)
+            GROUP BY
+                t.transaction_date, t.transaction_type;
+        """)
+        conn.commit()
+    except sqlite3.Error as e:
+        conn.rollback()
+        logs.log_error(f'Incremental ETL update could not be loaded into SQLite Database. Error: {e}')
+        raise
+    finally:
+        conn.close()
+
+    logs.log_event(f'Incremental ETL update completed for {len(user_summary)} users and '
+                   f'{len(set(transaction_dates))} transaction dates.')
+
+@profiling.profile_stage()
+def build_prefix_sums(user_ids=None):
+    """
+    Rebuilds the prefix sum tables used by rolling-window queries from the daily aggregates: the
+    daily_transaction_totals table written by the fused scan, or the output of aggregate_daily_transactions() in the
+    individual task mode.
+    :param user_ids: Optional user IDs. Only the per-user prefix sums of these users are rebuilt if given.
+    :return: None
+    """
+    if settings.USE_FUSED_ETL_SCAN:
+        daily_aggregates = utility_library.execute_custom_query(
+            "SELECT transaction_date, transaction_type, daily_total FROM daily_transaction_totals;")
+    else:
+        daily_aggregates = aggregate_daily_transactions()
+    prefix_sums.write_prefix_sums(daily_aggregates, DATABASE_PATH, user_ids)
+    logs.log_event(f'Prefix sum tables for rolling-window queries updated.')
+
+def run_shard_etl(shard_db_path, log_file=None):
+    """
+    Runs the fused ETL scan against one shard. Runs in a child process, so re-pointing the modules at the shard database
+    does not affect the parent.
+    :param shard_db_path: Path of the shard database.
+    :param log_file: Log file of the parent process to append to, or None if logging is not initialized.
+    :return: The shard database path.
+    """
+    if log_file is not None:
+        logs.init_logging(log_file)
+    utility_library.set_database_path(shard_db_path)
+    fused_etl_scan()
+    if settings.BUILD_PREFIX_SUMS:
+        build_prefix_sums()
+    if settings.BUILD_ROLLUP_CUBE:
+        rollup_cube.build_rollup_cube(shard_db_path)
+    if settings.SCORE_USER_RISK:
+        risk_scoring.update_user_risk(db_path=shard_db_path)
+    return shard_db_path
+
+@profiling.profile_stage()
+def sharded_etl_scan():
+    """
+    Runs the fused ETL scan on every shard in parallel processes. Every user and all of their transactions live in the
+    same shard, so the user summaries and volumes of each shard are complete, while the volume ranks and daily totals of
+    each shard cover that shard only and are merged at query time.
+    :return: None
+    """
+    paths = sharding.shard_paths(DATABASE_PATH)
+    max_workers = min(len(paths), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=get_context('spawn')) as executor:
+        for path in executor.map(run_shard_etl, paths, [logs.LOG_FILE] * len(paths)):
+            logs.log_event(f'Fused ETL scan completed for shard {path}.')
+
+def build_etl_stages():
+    """
+    Builds the ETL stage DAG. In the individual task mode, the three read-only aggregates are independent of each other
+    and run concurrently, and only the alter-then-upsert pair is ordered. Every stage that reads the users and
+    transactions tables is skipped when ingestion did not change them since its last run. With sharded storage enabled,
+    the fused scan runs on every shard and no analytic snapshot is written. The prefix sums for rolling-window queries
+    are rebuilt after the daily aggregates, the rollup cube is rebuilt from the users and transactions tables, the user
+    risk scores are updated from the days that changed, and with approximate analytics enabled, the sketches are
+    rebuilt when they are missing.
+    :return: List of pipeline_scheduler.Stage objects.
+    """
+    source_tables = lambda: pipeline_scheduler.table_fingerprint('users', 'transactions')
+
+    if sharding.is_sharded():
+        return [pipeline_scheduler.Stage('sharded_etl_scan', sharded_etl_scan, writes=True, inputs=source_tables)]
+
+    if settings.USE_FUSED_ETL_SCAN:
+        stages = [
+            pipeline_scheduler.Stage('fused_etl_scan', fused_etl_scan, writes=True, inputs=source_tables,
+                                     outputs_exist=lambda: utility_library.table_has_rows('user_volume_rankings')),
+        ]
+        if analytic_snapshot.snapshot_enabled():
+            stages.append(pipeline_scheduler.Stage(
+                'write_analytic_snapshot',
+                lambda: analytic_snapshot.write_snapshot(DATABASE_PATH, settings.ANALYTIC_SNAPSHOT_PATH),
+                depends_on=['fused_etl_scan'], inputs=source_tables,
+                outputs_exist=lambda: os.path.exists(settings.ANALYTIC_SNAPSHOT_PATH)))
+    else:
+        stages = [
+            pipeline_scheduler.Stage('calculate_total_transaction_amount_per_user',
+                                     calculate_total_transaction_amount_per_user, inputs=source_tables),
+            pipeline_scheduler.Stage('identify_top_ten_users_by_transaction_volume',
+                                     identify_top_ten_users_by_transaction_volume, inputs=source_tables),
+            pipeline_scheduler.Stage('aggregate_daily_transactions', aggregate_daily_transactions,
+                                     inputs=source_tables),
+            pipeline_scheduler.Stage('alter_users_table_for_transaction_summary',
+                                     alter_users_table_for_transaction_summary, writes=True),
+            pipeline_scheduler.Stage('upsert_transaction_summary_to_users', upsert_transaction_summary_to_users,
+                                     depends_on=['alter_users_table_for_transaction_summary'], writes=True,
+                                     inputs=source_tables),
+        ]
+
+    if settings.BUILD_PREFIX_SUMS:
+        stages.append(pipeline_scheduler.Stage(
+            'build_prefix_sums', build_prefix_sums, writes=True, inputs=source_tables,
+            depends_on=['fused_etl_scan'] if settings.USE_FUSED_ETL_SCAN else [],
+            outputs_exist=lambda: utility_library.table_has_rows('daily_prefix_sums')))
+
+    if settings.BUILD_ROLLUP_CUBE:
+        stages.append(pipeline_scheduler.Stage(
+            'build_rollup_cube', lambda: rollup_cube.build_rollup_cube(DATABASE_PATH), writes=True,
+            inputs=source_tables, outputs_exist=lambda: utility_library.table_has_rows(rollup_cube.CUBE_TABLE)))
+
+    if settings.SCORE_USER_RISK:
+        stages.append(pipeline_scheduler.Stage(
+            'score_user_risk', lambda: risk_scoring.update_user_risk(db_path=DATABASE_PATH), writes=True,
+            inputs=source_tables, outputs_exist=lambda: utility_library.table_has_rows('user_risk')))
+
+    if settings.ENABLE_APPROXIMATE_ANALYTICS:
+        # Ingestion keeps the sketches up to date. They are only rebuilt from the full transactions table when they are
+        # missing or their sizes change in settings.
+        stages.append(pipeline_scheduler.Stage(
+            'rebuild_sketches', sketches.rebuild_sketches, writes=True,
+            inputs=lambda: f'{settings.SKETCH_TOP_USERS_CAPACITY}:{settings.SKETCH_HLL_PRECISION}:'
+                           f'{settings.SKETCH_TDIGEST_COMPRESSION}',
+            outputs_exist=lambda: utility_library.table_has_rows('analytic_sketches')))
+    return stages
+
+@profiling.profile_stage()
+def etl_executive():
+    """
+    Executive function that runs all ETL tasks in the appropriate order through the pipeline scheduler.
+    :return: None
+    """
+
+    statuses, _ = pipeline_scheduler.run_stages(build_etl_stages(), max_workers=pipeline_scheduler.get_max_workers())
+    if any(status == pipeline_scheduler.STAGE_COMPLETED for status in statuses.values()):
+        utility_library.bump_data_version()
     logs.log_event(f'Task 2 Completed. All ETL Processes Completed.')
     print(f'Task 2 Completed. All ETL Processes Completed.')
     print(f'-' * 30)
\ No newline at end of file
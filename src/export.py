@@ -0,0 +1,268 @@
+"""
+Bulk export of the ETL outputs as CSV or Parquet.
+
+Datasets:
+    - user_summary: Transaction summary of every user from the users table, ordered by user_id. The date filter applies
+      to signup_date.
+    - daily_aggregates: Total amount and number of transactions for each day and transaction type, ordered by date and
+      type. The date filter applies to transaction_date.
+Rows are fetched from the cursor in batches and written in chunks of EXPORT_CHUNK_ROWS rows (one Parquet row group per
+chunk), so memory is bounded by one chunk regardless of the size of the export. With sharded storage enabled, the
+ordered rows of every shard are merged while they are read. Parquet output requires pyarrow, which is optional.
+
+Exports are available from the command line (python main.py export daily_aggregates --format parquet) and from the
+/api/export/<dataset> endpoint, which streams the file with chunked transfer encoding.
+"""
+
+import csv
+import heapq
+import importlib.util
+import io
+import os
+from itertools import groupby
+
+import logs
+import settings
+import sharding
+import utility_library
+
+FORMATS = ('csv', 'parquet')
+CONTENT_TYPES = {'csv': 'text/csv', 'parquet': 'application/vnd.apache.parquet'}
+
+# Columns of each dataset with their Parquet types.
+DATASETS = {
+    'user_summary': (('user_id', 'int64'), ('signup_date', 'string'), ('country', 'string'),
+                     ('total_transaction_amount', 'double'), ('total_deposit', 'double'),
+                     ('total_withdrawal', 'double'), ('total_purchase', 'double')),
+    'daily_aggregates': (('transaction_date', 'string'), ('transaction_type', 'string'), ('daily_total', 'double'),
+                         ('transaction_count', 'int64')),
+}
+
+
+def parquet_available():
+    """Returns True if pyarrow is installed, without importing it."""
+    return importlib.util.find_spec('pyarrow') is not None
+
+def dataset_columns(dataset):
+    """Returns the column names of a dataset."""
+    return [column for column, _ in DATASETS[dataset]]
+
+def date_conditions(column, start_date, end_date):
+    """
+    Builds the WHERE clause of an optional date range.
+    :param column: Date column.
+    :param start_date: Optional first day (YYYY-MM-DD).
+    :param end_date: Optional last day (YYYY-MM-DD).
+    :return: Tuple of the WHERE clause (empty without a range) and its parameters.
+    """
+    conditions, params = [], []
+    if start_date is not None:
+        conditions.append(f'{column} >= ?')
+        params.append(start_date)
+    if end_date is not None:
+        conditions.append(f'{column} <= ?')
+        params.append(end_date)
+    return (f'WHERE {" AND ".join(conditions)}' if conditions else ''), tuple(params)
+
+def dataset_query(dataset, start_date=None, end_date=None):
+    """
+    Builds the query of a dataset. The daily aggregates are read from the daily_transaction_totals table written by the
+    fused scan, or aggregated from the transactions table in the individual task mode.
+    :param dataset: Dataset name, one of DATASETS.
+    :param start_date: Optional first day (YYYY-MM-DD).
+    :param end_date: Optional last day (YYYY-MM-DD).
+    :return: Tuple of the SQL query string and its parameters.
+    """
+    if dataset == 'user_summary':
+        where_clause, params = date_conditions('signup_date', start_date, end_date)
+        return f"""
+            SELECT {', '.join(dataset_columns(dataset))}
+            FROM users
+            {where_clause}
+            ORDER BY user_id;
+        """, params
+
+    if dataset == 'daily_aggregates':
+        where_clause, params = date_conditions('transaction_date', start_date, end_date)
+        if settings.USE_FUSED_ETL_SCAN or sharding.is_sharded():
+            return f"""
+                SELECT {', '.join(dataset_columns(dataset))}
+                FROM daily_transaction_totals
+                {where_clause}
+                ORDER BY transaction_date, transaction_type;
+            """, params
+        return f"""
+            SELECT
+                transaction_date,
+                transaction_type,
+                SUM(amount) AS daily_total,
+                COUNT(*) AS transaction_count
+            FROM transactions
+            {where_clause}
+            GROUP BY transaction_date, transaction_type
+            ORDER BY transaction_date, transaction_type;
+        """, params
+
+    raise ValueError(f'Invalid dataset: {dataset}. Expected one of {", ".join(DATASETS)}.')
+
+def iterate_dataset(dataset, start_date=None, end_date=None):
+    """
+    Streams the rows of a dataset as tuples of its columns. With sharded storage enabled, the rows of every shard are
+    merged in order, and daily aggregates of the same day and type are summed.
+    :param dataset: Dataset name, one of DATASETS.
+    :param start_date: Optional first day (YYYY-MM-DD).
+    :param end_date: Optional last day (YYYY-MM-DD).
+    :return: Generator of tuples.
+    """
+    query, params = dataset_query(dataset, start_date, end_date)
+    if not sharding.is_sharded():
+        for row in utility_library.iterate_db_for_api(query, params):
+            yield tuple(row)
+        return
+
+    shard_rows = [(tuple(row) for row in utility_library.iterate_db_for_api(query, params, db_path=path))
+                  for path in sharding.shard_paths(utility_library.DATABASE_PATH)]
+    if dataset == 'user_summary':
+        # Every user is stored in exactly one shard.
+        yield from heapq.merge(*shard_rows, key=lambda row: row[0])
+        return
+    for key, rows in groupby(heapq.merge(*shard_rows, key=lambda row: row[:2]), key=lambda row: row[:2]):
+        rows = list(rows)
+        yield key + (sum(row[2] for row in rows), sum(row[3] for row in rows))
+
+def chunked(rows, chunk_rows):
+    """
+    Groups rows into lists of at most chunk_rows rows.
+    :param rows: Iterable of rows.
+    :param chunk_rows: Maximum number of rows per chunk.
+    :return: Generator of lists.
+    """
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_rows:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def generate_csv(columns, rows, chunk_rows=None):
+    """
+    Serializes rows as CSV, one chunk of rows at a time.
+    :param columns: Column names written as the header.
+    :param rows: Iterable of tuples.
+    :param chunk_rows: Rows per chunk. Defaults to settings.EXPORT_CHUNK_ROWS.
+    :return: Generator of bytes.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(columns)
+    for chunk in chunked(rows, chunk_rows or settings.EXPORT_CHUNK_ROWS):
+        writer.writerows(chunk)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')  # The header alone if there are no rows.
+
+class ChunkSink(io.RawIOBase):
+    """
+    Write-only file object that holds the bytes written since they were last taken, so a Parquet file can be streamed
+    while it is being written.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def take(self):
+        """Returns and clears the bytes written since the last call."""
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def generate_parquet(columns, rows, chunk_rows=None):
+    """
+    Serializes rows as a Parquet file with one row group per chunk of rows.
+    :param columns: Tuples of column name and Parquet type, as in DATASETS.
+    :param rows: Iterable of tuples.
+    :param chunk_rows: Rows per row group. Defaults to settings.EXPORT_CHUNK_ROWS.
+    :return: Generator of bytes.
+    """
+    import pyarrow as pa  # Optional dependency, only needed for Parquet exports.
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([(column, pa.type_for_alias(column_type)) for column, column_type in columns])
+    sink = ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+    try:
+        for chunk in chunked(rows, chunk_rows or settings.EXPORT_CHUNK_ROWS):
+            arrays = [pa.array(values, type=field.type) for values, field in zip(zip(*chunk), schema)]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            yield sink.take()
+    finally:
+        writer.close()
+    yield sink.take()  # The footer.
+
+def generate_export(dataset, export_format='csv', start_date=None, end_date=None):
+    """
+    Streams a dataset as a CSV or Parquet file.
+    :param dataset: Dataset name, one of DATASETS.
+    :param export_format: 'csv' or 'parquet'.
+    :param start_date: Optional first day (YYYY-MM-DD).
+    :param end_date: Optional last day (YYYY-MM-DD).
+    :return: Generator of bytes.
+    """
+    if dataset not in DATASETS:
+        raise ValueError(f'Invalid dataset: {dataset}. Expected one of {", ".join(DATASETS)}.')
+    if export_format not in FORMATS:
+        raise ValueError(f'Invalid export format: {export_format}. Expected one of {", ".join(FORMATS)}.')
+    if export_format == 'parquet' and not parquet_available():
+        raise RuntimeError('Parquet exports require pyarrow. Install it with: pip install pyarrow')
+
+    rows = iterate_dataset(dataset, start_date, end_date)
+    if export_format == 'parquet':
+        return generate_parquet(DATASETS[dataset], rows)
+    return generate_csv(dataset_columns(dataset), rows)
+
+def export_to_file(dataset, export_format='csv', output_path=None, start_date=None, end_date=None):
+    """
+    Writes a dataset to a file. The file is written under a temporary name and renamed once complete, so readers never
+    see a partial export.
+    :param dataset: Dataset name, one of DATASETS.
+    :param export_format: 'csv' or 'parquet'.
+    :param output_path: Output file path. Defaults to {EXPORT_DIR}/{dataset}.{export_format}.
+    :param start_date: Optional first day (YYYY-MM-DD).
+    :param end_date: Optional last day (YYYY-MM-DD).
+    :return: Path of the written file.
+    """
+    output_path = output_path or os.path.join(settings.EXPORT_DIR, f'{dataset}.{export_format}')
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    temp_path = f'{output_path}.tmp'
+    try:
+        with open(temp_path, 'wb') as output_file:
+            for chunk in generate_export(dataset, export_format, start_date, end_date):
+                output_file.write(chunk)
+        os.replace(temp_path, output_path)
+    except Exception as e:
+        logs.log_error(f'Export of {dataset} to {output_path} failed. Error: {e}')
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    logs.log_event(f'Export of {dataset} written to {output_path}.')
+    print(f'Export of {dataset} written to {output_path}.')
+    return output_path
@@ -7,28 +7,257 @@ Develop a RESTful API to expose the processed data.
     - Copy into browser to test: http://your_ip_address:5000/api/top_users
 3. Get Daily Transactions: get_daily_transactions()
     - Copy into browser to test: http://your_ip_address:5000/api/daily_transactions?date=2022-01-09
+4. Get Rolling Totals: get_rolling_totals()
+    - Copy into browser to test: http://your_ip_address:5000/api/rolling_totals?start=2022-01-01&end=2022-01-31&window=7
+5. Get Rollup: get_rollup()
+    - Copy into browser to test: http://your_ip_address:5000/api/rollup?dimensions=country,signup_month
+    - Copy into browser to test: http://your_ip_address:5000/api/rollup?dimensions=transaction_date&country=USA
+6. Export ETL Outputs: get_export()
+    - Copy into browser to test: http://your_ip_address:5000/api/export/user_summary
+    - Copy into browser to test: http://your_ip_address:5000/api/export/daily_aggregates?format=parquet&start=2022-01-01
+7. Get Top Anomalies: get_top_anomalies()
+    - Copy into browser to test: http://your_ip_address:5000/api/top_anomalies?k=10
+8. Approximate Analytics (with ENABLE_APPROXIMATE_ANALYTICS): answered from streaming sketches in constant time.
+    - Copy into browser to test: http://your_ip_address:5000/api/approx/top_users?k=10
+    - Copy into browser to test: http://your_ip_address:5000/api/approx/active_users?date=2022-01-09
+    - Copy into browser to test: http://your_ip_address:5000/api/approx/amount_percentiles?transaction_type=deposit
 
 Rather than pass the data from the ETL step to the API via a Pandas DataFrame, the API queries the data directly from
-the database. This is a better practice as it pulls from the ground truth and avoids RAM saturation.
+the database. This is a better practice as it pulls from the ground truth and avoids RAM saturation. When the ETL has
+written an analytic snapshot, the endpoints answer from the memory-mapped snapshot and fall back to the database
+otherwise.
+Results are streamed to the client in chunks straight from the cursor. Add `format=ndjson` to any data endpoint to
+receive newline-delimited JSON instead of a JSON array.
+
+Data endpoint responses carry an ETag derived from the data version recorded by ingestion and ETL. Requests with a
+matching If-None-Match header are answered with 304 Not Modified before any query runs. Responses above a size threshold
+are compressed with brotli or gzip when the client accepts it.
+
+With sharded storage enabled, user lookups are routed to the user's shard, and top users and daily transactions are
+queried on every shard and merged. With monthly partitions enabled, daily transactions are queried from the partition of
+the requested month only.
 
 Task 4a: Monitoring
 1. Monitor application performance and health
     - Copy into browser to test: http://your_ip_address:5000/api/health
     - Copy into browser to test: http://your_ip_address:5000/api/log_monitor
+    - Copy into browser to test: http://your_ip_address:5000/api/query_stats
 """
 
-from flask import Flask, jsonify, request
-import psutil
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import zlib
+from datetime import timedelta
+from itertools import chain, islice
+
+from flask import Flask, Response, g, jsonify, request
+
+try:
+    import orjson
+except ImportError:  # orjson is optional. The standard library serializer is used when it is not installed.
+    orjson = None
 
+try:
+    import brotli
+except ImportError:  # brotli is optional. Responses are compressed with gzip when it is not installed.
+    brotli = None
+
+import analytic_snapshot
+import export
 import logs
 import monitoring
+import partitions
+import prefix_sums
+import risk_scoring
+import rollup_cube
 import settings
+import sharding
+import sketches
 import utility_library
 
 app = Flask(__name__)
 
 DATABASE_PATH = settings.DB_PATH
 
+# Monitoring endpoints report live system state, so their responses are never tagged with the data version.
+UNVERSIONED_ENDPOINTS = {'health_check', 'log_monitoring', 'query_monitoring', 'static'}
+COMPRESSIBLE_MIMETYPES = {'application/json', 'application/x-ndjson', 'text/csv'}
+
+_data_version_cache = {'value': None, 'expires_at': 0.0}
+
+
+def serialize_json(obj):
+    """
+    Serializes an object to JSON bytes, using orjson when it is available.
+    :param obj: JSON serializable object.
+    :return: bytes
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+def stream_json_response(rows):
+    """
+    Builds a response that serializes rows lazily while the body is being sent. Rows are written as a JSON array, or as
+    newline-delimited JSON when the request has the query parameter `format=ndjson`.
+    :param rows: Iterable of sqlite3.Row objects or dictionaries.
+    :return: Flask Response
+    """
+    ndjson = request.args.get('format') == 'ndjson'
+    chunk_rows = settings.STREAM_CHUNK_ROWS
+
+    def generate():
+        iterator = iter(rows)
+        first_chunk = True
+        while True:
+            chunk = [serialize_json(dict(row)) for row in islice(iterator, chunk_rows)]
+            if not chunk:
+                break
+            if ndjson:
+                yield b'\n'.join(chunk) + b'\n'
+            else:
+                yield (b'[' if first_chunk else b',') + b','.join(chunk)
+            first_chunk = False
+        if not ndjson:
+            yield b']' if not first_chunk else b'[]'
+
+    return Response(generate(), mimetype='application/x-ndjson' if ndjson else 'application/json')
+
+def get_cached_data_version():
+    """
+    Returns the current data version, re-reading it from the database at most every DATA_VERSION_CACHE_SECONDS.
+    :return: Data version string, or None if ingestion and ETL have not recorded one yet.
+    """
+    now = time.monotonic()
+    if now >= _data_version_cache['expires_at']:
+        _data_version_cache['value'] = utility_library.get_metadata('data_version')
+        _data_version_cache['expires_at'] = now + settings.DATA_VERSION_CACHE_SECONDS
+    return _data_version_cache['value']
+
+def compute_etag():
+    """
+    Computes the ETag of the current request from the data version and the full request path, including the query
+    string, so each distinct query has its own tag.
+    :return: ETag string, or None if the request is not versioned.
+    """
+    if not settings.ENABLE_ETAGS or request.method != 'GET' or request.endpoint in UNVERSIONED_ENDPOINTS:
+        return None
+    data_version = get_cached_data_version()
+    if data_version is None:
+        return None
+    return hashlib.sha1(f'{data_version}:{request.full_path}'.encode('utf-8')).hexdigest()
+
+@app.before_request
+def answer_conditional_get():
+    """
+    Answers requests whose If-None-Match header matches the current ETag with 304 Not Modified, skipping the query and
+    serialization entirely.
+    :return: 304 response, or None to continue with the endpoint.
+    """
+    g.etag = compute_etag()
+    if g.etag is not None and request.if_none_match.contains_weak(g.etag):
+        response = Response(status=304)
+        response.set_etag(g.etag, weak=True)
+        return response
+    return None
+
+def choose_content_encoding():
+    """
+    Picks the best compression supported by both the client and the server.
+    :return: 'br', 'gzip', or None
+    """
+    if brotli is not None and request.accept_encodings['br']:
+        return 'br'
+    if request.accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+def compress_chunks(chunks, encoding):
+    """
+    Compresses an iterable of byte chunks incrementally so streamed responses never have to be buffered in full.
+    :param chunks: Iterable of bytes.
+    :param encoding: 'br' or 'gzip'
+    :return: Generator of compressed bytes.
+    """
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=min(settings.COMPRESSION_LEVEL, 11))
+        for chunk in chunks:
+            data = compressor.process(chunk)
+            if data:
+                yield data
+        yield compressor.finish()
+    else:
+        compressor = zlib.compressobj(settings.COMPRESSION_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
+@app.after_request
+def add_etag_and_compress(response):
+    """
+    Tags successful data responses with the ETag computed for the request, then compresses the body if the client
+    accepts it and the body reaches COMPRESSION_MIN_SIZE. For streamed bodies, only the first COMPRESSION_MIN_SIZE bytes
+    are buffered to make that decision.
+    :param response: Flask Response
+    :return: Flask Response
+    """
+    etag = g.get('etag')
+    if etag is not None and response.status_code == 200:
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = 'no-cache'
+
+    if (not settings.ENABLE_COMPRESSION or response.status_code != 200 or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = choose_content_encoding()
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        chunks = iter(response.response)
+        if hasattr(chunks, 'close'):
+            response.call_on_close(chunks.close)  # Release the cursor if the client disconnects mid-stream.
+        buffered = []
+        buffered_size = 0
+        for chunk in chunks:
+            chunk = chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+            buffered.append(chunk)
+            buffered_size += len(chunk)
+            if buffered_size >= settings.COMPRESSION_MIN_SIZE:
+                break
+        if buffered_size < settings.COMPRESSION_MIN_SIZE:
+            response.response = buffered
+            return response
+        response.response = compress_chunks(chain(buffered, chunks), encoding)
+    else:
+        data = response.get_data()
+        if len(data) < settings.COMPRESSION_MIN_SIZE:
+            return response
+        response.set_data(b''.join(compress_chunks([data], encoding)))
+
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+def first_row_or_none(rows):
+    """
+    Peeks at the first row of a row iterator so empty results can be answered with an error before streaming starts.
+    :param rows: Iterable of rows.
+    :return: Iterable yielding every row, or None if there are no rows.
+    """
+    iterator = iter(rows)
+    first = next(iterator, None)
+    if first is None:
+        if hasattr(iterator, 'close'):
+            iterator.close()
+        return None
+    return chain([first], iterator)
+
 
 @app.route('/api/user_transaction_summary', methods=['GET'])
 def get_user_transaction_summary():
@@ -46,6 +275,15 @@ def get_user_transaction_summary():
         logs.log_error(f'Bad API Call: User ID is Required. Error Status: 400')
         return jsonify({'error': 'user_id is required'}), 400
 
+    snapshot = analytic_snapshot.get_snapshot()
+    if snapshot is not None and user_id.isdigit():
+        summary = snapshot.get_user_summary(int(user_id))
+        if summary is None:
+            logs.log_error(f'Bad API Call: User ID is not found. Error Status: 404')
+            return jsonify({'error': 'User not found'}), 404
+        logs.log_event(f'User {user_id} Transaction Summary call completed successfully and delivered to Flask Server.')
+        return stream_json_response([summary])
+
     query = """
     SELECT 
         u.user_id, 
@@ -65,14 +303,15 @@ def get_user_transaction_summary():
     GROUP BY 
         u.user_id, u.country
     """
-    result = utility_library.query_db_for_api(query, (user_id,))
+    result = first_row_or_none(utility_library.iterate_db_for_api(
+        query, (user_id,), db_path=utility_library.get_user_db_path(user_id)))
 
-    if not result:
+    if result is None:
         logs.log_error(f'Bad API Call: User ID is not found. Error Status: 404')
         return jsonify({'error': 'User not found'}), 404
 
     logs.log_event(f'User {user_id} Transaction Summary call completed successfully and delivered to Flask Server.')
-    return jsonify([dict(row) for row in result])
+    return stream_json_response(result)
 
 @app.route('/api/top_users', methods=['GET'])
 def get_top_users():
@@ -81,6 +320,11 @@ def get_top_users():
 
     :return: JSON response containing the top 10 users by transaction volume or an error message.
     """
+    snapshot = analytic_snapshot.get_snapshot()
+    if snapshot is not None and snapshot.top_user_count:
+        logs.log_event(f'Top Users by Transaction Volume Found and Delivered to Flask Server.')
+        return stream_json_response(snapshot.get_top_users())
+
     query = """
     SELECT 
         u.user_id, 
@@ -98,14 +342,18 @@ def get_top_users():
         transaction_count DESC
     LIMIT 10
     """
-    result = utility_library.query_db_for_api(query)
+    if sharding.is_sharded():
+        result = first_row_or_none(
+            utility_library.merge_top_rows(utility_library.scatter_gather(query), 'transaction_count', 10))
+    else:
+        result = first_row_or_none(utility_library.iterate_db_for_api(query))
 
-    if not result:
+    if result is None:
         logs.log_error(f'Bad API Call: Top Users by Transaction Volume Not Found. Status error: 404')
         return jsonify({'error': 'No users found'}), 404
 
     logs.log_event(f'Top Users by Transaction Volume Found and Delivered to Flask Server.')
-    return jsonify([dict(row) for row in result])
+    return stream_json_response(result)
 
 @app.route('/api/daily_transactions', methods=['GET'])
 def get_daily_transactions():
@@ -121,13 +369,30 @@ def get_daily_transactions():
         logs.log_error(f'Bad API Call: Missing date parameter. Status error: 400')
         return jsonify({'error': 'Missing required query parameter: date'}), 400
 
-    query = """
+    snapshot = analytic_snapshot.get_snapshot()
+    if snapshot is not None:
+        result = snapshot.get_daily_transactions(transaction_date)
+        if not result:
+            logs.log_error(f'Bad API Call: No transactions found for {transaction_date}. Status error: 404')
+            return jsonify({'error': f'No transactions found for date: {transaction_date}'}), 404
+        logs.log_event(f'Daily Transactions for {transaction_date} Found and Delivered to Flask Server.')
+        return stream_json_response(result)
+
+    source_table = 'transactions'
+    if partitions.is_partitioned() and not sharding.is_sharded():
+        # The partition name is built from the digits of a validated date, so it is safe to format into the query.
+        source_table = partitions.partition_for_date(transaction_date)
+        if source_table is None or not partitions.partition_exists(source_table):
+            logs.log_error(f'Bad API Call: No transactions found for {transaction_date}. Status error: 404')
+            return jsonify({'error': f'No transactions found for date: {transaction_date}'}), 404
+
+    query = f"""
     SELECT 
         t.transaction_date, 
         t.transaction_type,
         SUM(t.amount) AS daily_total
     FROM 
-        transactions t
+        {source_table} t
     WHERE 
         t.transaction_date = ?
     GROUP BY 
@@ -135,14 +400,290 @@ def get_daily_transactions():
     ORDER BY 
         t.transaction_type
     """
-    result = utility_library.query_db_for_api(query, (transaction_date,))
+    if sharding.is_sharded():
+        result = first_row_or_none(utility_library.merge_summed_rows(
+            utility_library.scatter_gather(query, (transaction_date,)),
+            ('transaction_date', 'transaction_type'), ('daily_total',)))
+    else:
+        result = first_row_or_none(utility_library.iterate_db_for_api(query, (transaction_date,)))
 
-    if not result:
+    if result is None:
         logs.log_error(f'Bad API Call: No transactions found for {transaction_date}. Status error: 404')
         return jsonify({'error': f'No transactions found for date: {transaction_date}'}), 404
 
     logs.log_event(f'Daily Transactions for {transaction_date} Found and Delivered to Flask Server.')
-    return jsonify([dict(row) for row in result])
+    return stream_json_response(result)
+
+@app.route('/api/rolling_totals', methods=['GET'])
+def get_rolling_totals():
+    """
+    Handles the `/api/rolling_totals` endpoint to retrieve rolling-window totals and moving averages for each day in a
+    date range, answered from the prefix sum tables written by the ETL.
+
+    Request Parameters:
+    - `start` (str): First day of the series (YYYY-MM-DD).
+    - `end` (str): Last day of the series (YYYY-MM-DD).
+    - `window` (int, optional): Window length in days, at most MAX_ROLLING_POINTS. Defaults to 7.
+    - `transaction_type` (str, optional): deposit, withdrawal, purchase, or all. Defaults to all.
+    - `user_id` (int, optional): Restricts the totals to one user. Global totals are returned if omitted.
+    :return: JSON response containing the window total and the moving average of the daily totals for each day, or an
+    error message.
+    """
+    start_date = prefix_sums.parse_date(request.args.get('start'))
+    end_date = prefix_sums.parse_date(request.args.get('end'))
+    window = request.args.get('window', 7, type=int)
+    transaction_type = request.args.get('transaction_type', prefix_sums.ALL_TYPES)
+    user_id = request.args.get('user_id')
+
+    if start_date is None or end_date is None or end_date < start_date:
+        logs.log_error(f'Bad API Call: Invalid start or end date. Status error: 400')
+        return jsonify({'error': 'start and end are required dates (YYYY-MM-DD), with start on or before end'}), 400
+    if window is None or not 0 < window <= settings.MAX_ROLLING_POINTS:
+        logs.log_error(f'Bad API Call: window must be a positive integer up to {settings.MAX_ROLLING_POINTS}. '
+                       f'Status error: 400')
+        return jsonify({'error': f'window must be a positive integer up to {settings.MAX_ROLLING_POINTS}'}), 400
+    if (end_date - start_date).days + 1 > settings.MAX_ROLLING_POINTS:
+        logs.log_error(f'Bad API Call: Rolling totals range too long. Status error: 400')
+        return jsonify({'error': f'The range may cover at most {settings.MAX_ROLLING_POINTS} days'}), 400
+    if user_id is not None and not user_id.isdigit():
+        logs.log_error(f'Bad API Call: Invalid User ID. Status error: 400')
+        return jsonify({'error': 'user_id must be a positive integer'}), 400
+
+    try:
+        if user_id is not None:
+            totals = prefix_sums.rolling_window_totals(start_date, end_date, window, transaction_type, int(user_id),
+                                                       db_path=utility_library.get_user_db_path(user_id))
+        else:
+            # Window totals are additive, so the totals of every shard are summed when sharded storage is enabled.
+            paths = sharding.shard_paths(utility_library.DATABASE_PATH) if sharding.is_sharded() else [None]
+            totals = [sum(point) for point in zip(*(
+                prefix_sums.rolling_window_totals(start_date, end_date, window, transaction_type, db_path=path)
+                for path in paths))]
+    except sqlite3.OperationalError as e:
+        logs.log_error(f'Bad API Call: Rolling totals unavailable. Error: {e}. Status error: 404')
+        return jsonify({'error': 'Rolling totals are not available. Run the ETL with BUILD_PREFIX_SUMS enabled'}), 404
+
+    result = [{'date': (start_date + timedelta(days=offset)).isoformat(), 'window_total': total,
+               'moving_average': total / window} for offset, total in enumerate(totals)]
+    logs.log_event(f'Rolling {window} Day Totals from {start_date} to {end_date} Delivered to Flask Server.')
+    return stream_json_response(result)
+
+@app.route('/api/rollup', methods=['GET'])
+def get_rollup():
+    """
+    Handles the `/api/rollup` endpoint to retrieve transaction totals, counts, and averages rolled up to any subset of
+    the cube dimensions (country, signup_month, transaction_type, transaction_date), answered from the rollup cube
+    written by the ETL.
+
+    Request Parameters:
+    - `dimensions` (str, optional): Comma-separated dimensions to group by. A grand total is returned if omitted.
+    - `country`, `signup_month`, `transaction_type` (str, optional): Restrict the rollup to one value of a dimension.
+    - `start`, `end` (str, optional): First and last day (YYYY-MM-DD) of the rolled up transactions.
+    :return: JSON response containing one row per group, or an error message.
+    """
+    dimensions = rollup_cube.parse_dimensions(request.args.get('dimensions'))
+    filters = {name: request.args[name] for name in ('country', 'signup_month', 'transaction_type')
+               if name in request.args}
+    start_date = request.args.get('start')
+    end_date = request.args.get('end')
+
+    if dimensions is None:
+        logs.log_error(f'Bad API Call: Invalid rollup dimensions. Status error: 400')
+        return jsonify({'error': f'dimensions must be a comma-separated subset of: '
+                                 f'{", ".join(rollup_cube.CUBE_DIMENSIONS)}'}), 400
+    for value in (start_date, end_date):
+        if value is not None and prefix_sums.parse_date(value) is None:
+            logs.log_error(f'Bad API Call: Invalid start or end date. Status error: 400')
+            return jsonify({'error': 'start and end must be dates (YYYY-MM-DD)'}), 400
+
+    try:
+        result = rollup_cube.rollup(dimensions, filters, start_date, end_date)
+    except sqlite3.OperationalError as e:
+        logs.log_error(f'Bad API Call: Rollup cube unavailable. Error: {e}. Status error: 404')
+        return jsonify({'error': 'The rollup cube is not available. Run the ETL with BUILD_ROLLUP_CUBE enabled'}), 404
+    if not result:
+        logs.log_error(f'Bad API Call: No transactions found for rollup. Status error: 404')
+        return jsonify({'error': 'No transactions found for the requested rollup'}), 404
+
+    logs.log_event(f'Rollup by {", ".join(dimensions) or "grand total"} Delivered to Flask Server.')
+    return stream_json_response(result)
+
+@app.route('/api/export/<dataset>', methods=['GET'])
+def get_export(dataset):
+    """
+    Handles the `/api/export/<dataset>` endpoint to download an ETL output (user_summary or daily_aggregates) as a CSV
+    or Parquet file. The file is streamed with chunked transfer encoding while the rows are read from the cursor.
+
+    Request Parameters:
+    - `format` (str, optional): csv or parquet. Defaults to csv. Parquet requires pyarrow.
+    - `start`, `end` (str, optional): First and last day (YYYY-MM-DD) of the exported rows.
+    :return: The file as an attachment, or an error message.
+    """
+    export_format = request.args.get('format', 'csv')
+    start_date = request.args.get('start')
+    end_date = request.args.get('end')
+
+    if dataset not in export.DATASETS:
+        logs.log_error(f'Bad API Call: Unknown export dataset {dataset}. Status error: 404')
+        return jsonify({'error': f'Unknown dataset. Expected one of: {", ".join(export.DATASETS)}'}), 404
+    if export_format not in export.FORMATS:
+        logs.log_error(f'Bad API Call: Invalid export format {export_format}. Status error: 400')
+        return jsonify({'error': f'format must be one of: {", ".join(export.FORMATS)}'}), 400
+    if export_format == 'parquet' and not export.parquet_available():
+        logs.log_error(f'Bad API Call: Parquet exports require pyarrow. Status error: 501')
+        return jsonify({'error': 'Parquet exports are not available on this server'}), 501
+    for value in (start_date, end_date):
+        if value is not None and prefix_sums.parse_date(value) is None:
+            logs.log_error(f'Bad API Call: Invalid start or end date. Status error: 400')
+            return jsonify({'error': 'start and end must be dates (YYYY-MM-DD)'}), 400
+
+    try:
+        # The first chunk runs the query, so a missing ETL output is reported before streaming starts.
+        chunks = first_row_or_none(export.generate_export(dataset, export_format, start_date, end_date))
+    except sqlite3.OperationalError as e:
+        logs.log_error(f'Bad API Call: Export of {dataset} unavailable. Error: {e}. Status error: 404')
+        return jsonify({'error': f'{dataset} is not available. Run the ETL first'}), 404
+
+    response = Response(chunks, mimetype=export.CONTENT_TYPES[export_format])
+    response.headers['Content-Disposition'] = f'attachment; filename={dataset}.{export_format}'
+    logs.log_event(f'Export of {dataset} as {export_format} Streaming to Flask Server.')
+    return response
+
+@app.route('/api/top_anomalies', methods=['GET'])
+def get_top_anomalies():
+    """
+    Handles the `/api/top_anomalies` endpoint to retrieve the users with the highest risk scores, from the scores
+    maintained by the ETL and ingestion. A risk score of 1 or more means the user's latest daily amount z-score or
+    withdrawal burst crossed its threshold.
+
+    Request Parameters:
+    - `k` (int, optional): Number of users to return. Defaults to 10 and is capped at MAX_TOP_ANOMALIES.
+    :return: JSON response containing each user's risk score, daily amount z-score, and withdrawal burst, or an error
+    message.
+    """
+    k = request.args.get('k', 10, type=int)
+    if k is None or k <= 0:
+        logs.log_error(f'Bad API Call: k must be a positive integer. Status error: 400')
+        return jsonify({'error': 'k must be a positive integer'}), 400
+
+    try:
+        result = risk_scoring.top_anomalies(min(k, settings.MAX_TOP_ANOMALIES))
+    except sqlite3.OperationalError as e:
+        logs.log_error(f'Bad API Call: Risk scores unavailable. Error: {e}. Status error: 404')
+        return jsonify({'error': 'Risk scores are not available. Run the ETL first'}), 404
+    if not result:
+        logs.log_error(f'Bad API Call: Top Anomalies Not Found. Status error: 404')
+        return jsonify({'error': 'No users found'}), 404
+
+    logs.log_event(f'Top Anomalies by Risk Score Found and Delivered to Flask Server.')
+    return stream_json_response(result)
+
+def approximate_analytics_disabled():
+    """
+    Answers approximate analytics requests with an error when the sketches are not maintained.
+    :return: 404 response, or None to continue with the endpoint.
+    """
+    if settings.ENABLE_APPROXIMATE_ANALYTICS:
+        return None
+    logs.log_error(f'Bad API Call: Approximate analytics are disabled. Status error: 404')
+    return jsonify({'error': 'Approximate analytics are disabled'}), 404
+
+@app.route('/api/approx/top_users', methods=['GET'])
+def get_approximate_top_users():
+    """
+    Handles the `/api/approx/top_users` endpoint to estimate the top users by transaction volume from the space-saving
+    sketch.
+
+    Request Parameters:
+    - `k` (int, optional): Number of users to return. Defaults to 10 and is capped at SKETCH_TOP_USERS_CAPACITY.
+    :return: JSON response containing each user's estimated transaction count and maximum overestimate, or an error
+    message.
+    """
+    disabled = approximate_analytics_disabled()
+    if disabled is not None:
+        return disabled
+
+    k = request.args.get('k', 10, type=int)
+    if k is None or k <= 0:
+        logs.log_error(f'Bad API Call: k must be a positive integer. Status error: 400')
+        return jsonify({'error': 'k must be a positive integer'}), 400
+
+    sketch = sketches.read_sketch(sketches.TOP_USERS_KEY)
+    if sketch is None or not sketch.counts:
+        logs.log_error(f'Bad API Call: Approximate Top Users Not Found. Status error: 404')
+        return jsonify({'error': 'No users found'}), 404
+
+    result = [{'user_id': user_id, 'estimated_transaction_count': count, 'max_overestimate': error}
+              for user_id, count, error in sketch.top(min(k, settings.SKETCH_TOP_USERS_CAPACITY))]
+    logs.log_event(f'Approximate Top Users by Transaction Volume Found and Delivered to Flask Server.')
+    return stream_json_response(result)
+
+@app.route('/api/approx/active_users', methods=['GET'])
+def get_approximate_active_users():
+    """
+    Handles the `/api/approx/active_users` endpoint to estimate the number of distinct users with transactions on a date
+    from the HyperLogLog sketch of the date.
+
+    Request Parameters:
+    - `date` (str): The date, e.g. `/api/approx/active_users?date=2022-01-09`.
+    :return: JSON response containing the estimated number of active users or an error message.
+    """
+    disabled = approximate_analytics_disabled()
+    if disabled is not None:
+        return disabled
+
+    transaction_date = request.args.get('date')
+    if not transaction_date:
+        logs.log_error(f'Bad API Call: Missing date parameter. Status error: 400')
+        return jsonify({'error': 'Missing required query parameter: date'}), 400
+
+    sketch = sketches.read_sketch(sketches.ACTIVE_USERS_KEY.format(transaction_date))
+    if sketch is None:
+        logs.log_error(f'Bad API Call: No transactions found for {transaction_date}. Status error: 404')
+        return jsonify({'error': f'No transactions found for date: {transaction_date}'}), 404
+
+    logs.log_event(f'Approximate Active Users for {transaction_date} Found and Delivered to Flask Server.')
+    return jsonify({'transaction_date': transaction_date, 'estimated_active_users': sketch.count()}), 200
+
+@app.route('/api/approx/amount_percentiles', methods=['GET'])
+def get_approximate_amount_percentiles():
+    """
+    Handles the `/api/approx/amount_percentiles` endpoint to estimate transaction amount percentiles for a transaction
+    type from its t-digest.
+
+    Request Parameters:
+    - `transaction_type` (str): deposit, withdrawal, or purchase.
+    - `q` (str, optional): Comma separated quantiles between 0 and 1. Defaults to 0.5,0.9,0.99.
+    :return: JSON response containing the estimated percentiles or an error message.
+    """
+    disabled = approximate_analytics_disabled()
+    if disabled is not None:
+        return disabled
+
+    transaction_type = request.args.get('transaction_type')
+    if not transaction_type:
+        logs.log_error(f'Bad API Call: Missing transaction_type parameter. Status error: 400')
+        return jsonify({'error': 'Missing required query parameter: transaction_type'}), 400
+
+    try:
+        quantiles = [float(q) for q in request.args.get('q', '0.5,0.9,0.99').split(',')]
+    except ValueError:
+        quantiles = None
+    if not quantiles or any(not 0 <= q <= 1 for q in quantiles):
+        logs.log_error(f'Bad API Call: Quantiles must be numbers between 0 and 1. Status error: 400')
+        return jsonify({'error': 'q must be a comma separated list of numbers between 0 and 1'}), 400
+
+    sketch = sketches.read_sketch(sketches.AMOUNTS_KEY.format(transaction_type))
+    if sketch is None or not sketch.total_weight:
+        logs.log_error(f'Bad API Call: No {transaction_type} transactions found. Status error: 404')
+        return jsonify({'error': f'No transactions found for transaction type: {transaction_type}'}), 404
+
+    logs.log_event(f'Approximate {transaction_type} Amount Percentiles Found and Delivered to Flask Server.')
+    return jsonify({
+        'transaction_type': transaction_type,
+        'transaction_count': int(sketch.total_weight),
+        'percentiles': {str(q): sketch.quantile(q) for q in quantiles},
+    }), 200
 
 @app.route("/api/health", methods=["GET"])
 def health_check():
@@ -150,6 +691,8 @@ def health_check():
     Health check endpoint to monitor application health.
     :return: JSON containing system performance metrics like CPU, memory, and uptime.
     """
+    import psutil
+
     health_status = {
         "cpu_usage_%": psutil.cpu_percent(interval=1),
         "num_cores": psutil.cpu_count(),
@@ -167,7 +710,10 @@ def log_monitoring():
     Log Monitoring endpoint to monitor application status via logs.
     :return: JSON containing the number of INFO, WARNING, ERROR, and CRITICAL logs in the current log file.
     """
-    counts = monitoring.count_log_levels(f'logs/{logs.LOG_FILE}')
+    if logs.LOG_FILE is None:
+        logs.log_error(f'Log Monitoring Unsuccessful. Logging is not initialized.')
+        return jsonify({'error': 'Logging is not initialized'}), 404
+    counts = monitoring.count_log_levels(os.path.join(logs.LOG_DIR, logs.LOG_FILE))
 
     log_status = {
         "info_count": counts['INFO'],
@@ -180,4 +726,14 @@ def log_monitoring():
         logs.log_error(f'Log Monitoring Unsuccessful. Check log file exists.')
 
     logs.log_event(f'Log Monitoring Successful and Delivered to Flask Server.')
-    return jsonify(log_status), 200
\ No newline at end of file
+    return jsonify(log_status), 200
+
+@app.route("/api/query_stats", methods=["GET"])
+def query_monitoring():
+    """
+    Query Monitoring endpoint to find slow and unindexed queries.
+    :return: JSON containing per-fingerprint query statistics (calls, total/avg/max duration, rows, slow calls, and the
+    query plan captured for the last slow call), sorted by total time spent.
+    """
+    logs.log_event(f'Query Monitoring Successful and Delivered to Flask Server.')
+    return jsonify(utility_library.get_query_stats()), 200
@@ -10,17 +10,25 @@ like SQLite).
 """
 
 import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 from datetime import datetime
 
 import logs
+import partitions
+import pipeline_scheduler
+import profiling
 import settings
+import sharding
+import sketches
+import utility_library
 
 DATABASE_PATH = settings.DB_PATH
 USERS_PATH = settings.USER_CSV_PATH
 TRANSACTIONS_PATH = settings.TRANSACTIONS_CSV_PATH
 
 
+@profiling.profile_stage()
 def create_db_schemas(db_path):
     """
 
@@ -36,6 +44,10 @@ def create_db_schemas(db_path):
 
         cursor = conn.cursor()
 
+        if settings.ENABLE_WAL_MODE:
+            # WAL mode lets readers run concurrently with each other and with a writer. The setting persists in the file.
+            cursor.execute('PRAGMA journal_mode=WAL;')
+
         # Create users table
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS users (
@@ -46,6 +58,16 @@ def create_db_schemas(db_path):
         ''')
         logs.log_event(f'Task 1-1a Completed. User Table Created Successfully.')
 
+        if partitions.is_partitioned():
+            # Transactions are stored in monthly partitions behind a `transactions` view.
+            partitions.migrate_to_partitions(conn)
+            conn.commit()
+            conn.close()
+            print("Task 1-1 Completed. Database schema created successfully with monthly transaction partitions.")
+            logs.log_event("Task 1-1 Completed. Database schema created successfully with monthly transaction "
+                           "partitions.")
+            return
+
         # Create transactions table
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS transactions (
@@ -59,6 +81,10 @@ def create_db_schemas(db_path):
         ''')
         logs.log_event(f'Task 1-1b Completed. Transactions Table Created Successfully.')
 
+        # Indexes for per-user and per-day lookups, used by the API and by incremental ETL updates
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_transactions_user_id ON transactions (user_id);')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_transactions_date ON transactions (transaction_date);')
+
         conn.commit()
         conn.close()
         print("Task 1-1 Completed. Database schema created successfully.")
@@ -66,6 +92,7 @@ def create_db_schemas(db_path):
     except Exception as e:
         logs.log_error(f'Error Connecting to SQLite Database. Error code: {e}')
 
+@profiling.profile_stage()
 def clean_users_data(df):
     """
     Cleans a pandas DataFrame containing user information by handling poor data quality.
@@ -107,7 +134,7 @@ def clean_users_data(df):
 
     invalid_signup_date = df[~df['signup_date'].apply(is_valid_date)]
     if len(invalid_signup_date) != 0:
-        logs.log_warning(f'There are {invalid_signup_date.sum()} instances of invalid signup dates. These rows have been dropped.')
+        logs.log_warning(f'There are {len(invalid_signup_date)} instances of invalid signup dates. These rows have been dropped.')
     df = df[df['signup_date'].apply(is_valid_date)]
 
     # Count rows with missing `country` values
@@ -130,6 +157,7 @@ def clean_users_data(df):
         print(f'\tUser Data Cleaned. {dropped_row_num} rows have been dropped.')
     return df
 
+@profiling.profile_stage()
 def clean_transactions_data(df):
     """
     Cleans a pandas DataFrame containing transaction information by handling poor data quality.
@@ -158,9 +186,12 @@ def clean_transactions_data(df):
     poor_data_count['missing_transaction_id'] = len(missing_transaction_id)
     df = df[df['transaction_id'].notna()]
 
-    invalid_transaction_id = df[df['transaction_id'].apply(lambda x: not isinstance(x, int) or x <= 0)]
+    # A CSV column with missing IDs is read as floats, so whole-numbered floats are valid IDs.
+    transaction_ids = pd.to_numeric(df['transaction_id'], errors='coerce')
+    valid_transaction_id = (transaction_ids > 0) & (transaction_ids % 1 == 0)
+    invalid_transaction_id = df[~valid_transaction_id]
     poor_data_count['invalid_transaction_id'] = len(invalid_transaction_id)
-    df = df[df['transaction_id'].apply(lambda x: isinstance(x, int) and x > 0)]
+    df = df[valid_transaction_id].assign(transaction_id=transaction_ids[valid_transaction_id].astype('int64'))
 
     # Validate and filter out rows with invalid `user_id`
     missing_user_id = df[df['user_id'].isna()]
@@ -206,6 +237,52 @@ def clean_transactions_data(df):
 
     return df
 
+def insert_users(conn, data):
+    """
+    Inserts cleaned user rows on an open connection, skipping duplicates based on user_id, and records a new version of
+    the users table. The caller commits the transaction.
+
+    :param conn: Open SQLite connection.
+    :param data: Cleaned users DataFrame.
+    :return: None
+    """
+    # Insert or ignore duplicates in the users table
+    query = '''
+        INSERT OR IGNORE INTO users (user_id, signup_date, country)
+        VALUES (?, ?, ?);
+    '''
+    rows = data[['user_id', 'signup_date', 'country']].astype(object).itertuples(index=False, name=None)
+    conn.executemany(query, rows)
+    utility_library.bump_table_version('users', conn)
+
+def insert_transactions(conn, data):
+    """
+    Inserts cleaned transaction rows on an open connection, replacing existing rows with the same transaction_id, and
+    records a new version of the transactions table. Rows are routed to monthly partitions when partitioning is enabled,
+    and new transactions are added to the approximate analytics sketches when they are enabled. The caller commits the
+    transaction.
+
+    :param conn: Open SQLite connection.
+    :param data: Cleaned transactions DataFrame.
+    :return: None
+    """
+    # Insert or replace to handle duplicate transaction_id
+    query = '''
+        INSERT OR REPLACE INTO transactions (
+            transaction_id, user_id, transaction_date, amount, transaction_type
+        )
+        VALUES (?, ?, ?, ?, ?);
+    '''
+    columns = ['transaction_id', 'user_id', 'transaction_date', 'amount', 'transaction_type']
+    if settings.ENABLE_APPROXIMATE_ANALYTICS:
+        sketches.update_sketches(conn, data)
+    if partitions.is_partitioned():
+        partitions.insert_partitioned_transactions(conn, data)
+    else:
+        conn.executemany(query, data[columns].astype(object).itertuples(index=False, name=None))
+    utility_library.bump_table_version('transactions', conn)
+
+@profiling.profile_stage()
 def load_users_to_db(db_path, csv_path):
     """
     Loads data from the users CSV into the database,
@@ -218,30 +295,30 @@ def load_users_to_db(db_path, csv_path):
 
     if not db_path:
         logs.log_error(f'Database path not found.')
+        raise ValueError('Database path not found.')
 
     if not csv_path:
         logs.log_error(f'User CSV path not found.')
+        raise ValueError('User CSV path not found.')
 
     try:
         data = pd.read_csv(csv_path)
         data = clean_users_data(data)
+        profiling.record_rows(len(data))
         conn = sqlite3.connect(db_path)
-
-        for _, row in data.iterrows():
-            # Insert or ignore duplicates in the users table
-            query = '''
-                INSERT OR IGNORE INTO users (user_id, signup_date, country)
-                VALUES (?, ?, ?);
-            '''
-            conn.execute(query, (row['user_id'], row['signup_date'], row['country']))
-
-        conn.commit()
-        conn.close()
+        try:
+            insert_users(conn, data)
+            conn.commit()
+        finally:
+            conn.close()
         print("Task 1-2a Completed. Users data ingested successfully.")
         logs.log_event("Task 1-2a Completed. Users data ingested successfully.")
     except Exception as e:
+        # Re-raised so the pipeline stage fails and the CSV is imported again on the next run.
         logs.log_error(f'User data could not be ingested into SQLite Database. Error: {e}')
+        raise
 
+@profiling.profile_stage()
 def load_transactions_to_db(db_path, csv_path):
     """
     Loads data from the transactions CSV into the database,
@@ -253,37 +330,103 @@ def load_transactions_to_db(db_path, csv_path):
     """
     if not db_path:
         logs.log_error(f'Database path not found.')
+        raise ValueError('Database path not found.')
     if not csv_path:
         logs.log_error(f'Transactions CSV path not found.')
+        raise ValueError('Transactions CSV path not found.')
 
     try:
         data = pd.read_csv(csv_path)
         data = clean_transactions_data(data)
+        profiling.record_rows(len(data))
         conn = sqlite3.connect(db_path)
-
-        for _, row in data.iterrows():
-            # Insert or replace to handle duplicate transaction_id
-            query = '''
-                INSERT OR REPLACE INTO transactions (
-                    transaction_id, user_id, transaction_date, amount, transaction_type
-                )
-                VALUES (?, ?, ?, ?, ?);
-            '''
-            conn.execute(query, (
-                row['transaction_id'], row['user_id'], row['transaction_date'],
-                row['amount'], row['transaction_type']
-            ))
-
-        conn.commit()
-        conn.close()
+        try:
+            insert_transactions(conn, data)
+            conn.commit()
+        finally:
+            conn.close()
         print("Task 1-2b Completed. Transactions data ingested successfully.")
         logs.log_event("Task 1-2b Completed. Transactions data ingested successfully.")
     except Exception as e:
         logs.log_error(f'Transaction data could not be ingested into SQLite Database. Error: {e}')
+        raise
+
+def create_shard_schemas(db_path):
+    """
+    Creates the database schema in every shard.
+    :param db_path: Path of the main database the shard paths are derived from.
+    :return: None
+    """
+    for path in sharding.shard_paths(db_path):
+        create_db_schemas(path)
+
+def insert_into_shards(db_path, data, insert):
+    """
+    Routes cleaned rows to their shards by user_id and inserts the rows of each shard in its own transaction. Shards are
+    separate files with separate write locks, so they are written concurrently.
+    :param db_path: Path of the main database the shard paths are derived from.
+    :param data: Cleaned DataFrame with a user_id column.
+    :param insert: insert_users or insert_transactions.
+    :return: None
+    """
+    def write_shard(item):
+        index, rows = item
+        conn = sqlite3.connect(sharding.shard_path(index, db_path))
+        try:
+            insert(conn, rows)
+            conn.commit()
+        finally:
+            conn.close()
+
+    with ThreadPoolExecutor(max_workers=settings.SHARD_COUNT) as executor:
+        list(executor.map(write_shard, sharding.split_by_shard(data).items()))
+
+@profiling.profile_stage()
+def load_users_to_shards(db_path, csv_path):
+    """
+    Sharded variant of load_users_to_db. Loads data from the users CSV into the shard of each user.
+
+    :param db_path: Path of the main database the shard paths are derived from.
+    :param csv_path:
+    :return:
+    """
+    try:
+        data = clean_users_data(pd.read_csv(csv_path))
+        profiling.record_rows(len(data))
+        insert_into_shards(db_path, data, insert_users)
+        utility_library.bump_table_version('users')
+        print("Task 1-2a Completed. Users data ingested successfully into shards.")
+        logs.log_event(f"Task 1-2a Completed. Users data ingested successfully into {settings.SHARD_COUNT} shards.")
+    except Exception as e:
+        logs.log_error(f'User data could not be ingested into SQLite Database shards. Error: {e}')
+        raise
+
+@profiling.profile_stage()
+def load_transactions_to_shards(db_path, csv_path):
+    """
+    Sharded variant of load_transactions_to_db. Loads data from the transactions CSV into the shard of each
+    transaction's user.
+
+    :param db_path: Path of the main database the shard paths are derived from.
+    :param csv_path:
+    :return:
+    """
+    try:
+        data = clean_transactions_data(pd.read_csv(csv_path))
+        profiling.record_rows(len(data))
+        insert_into_shards(db_path, data, insert_transactions)
+        utility_library.bump_table_version('transactions')
+        print("Task 1-2b Completed. Transactions data ingested successfully into shards.")
+        logs.log_event(f"Task 1-2b Completed. Transactions data ingested successfully into {settings.SHARD_COUNT} "
+                       f"shards.")
+    except Exception as e:
+        logs.log_error(f'Transaction data could not be ingested into SQLite Database shards. Error: {e}')
+        raise
 
 def delete_table(db_path, table_name):
     """
-    Deletes a table from the SQLite database. Utility function for manual testing.
+    Deletes a table from the SQLite database. Utility function for manual testing. A partitioned transactions table is
+    deleted by dropping the `transactions` view and every monthly partition.
 
     :param db_path: Path to the SQLite database file
     :param table_name: Name of the table to be deleted
@@ -293,9 +436,13 @@ def delete_table(db_path, table_name):
         conn = sqlite3.connect(db_path)
         cursor = conn.cursor()
 
-        query = f"DROP TABLE IF EXISTS {table_name};"
-
-        cursor.execute(query)
+        row = cursor.execute("SELECT type FROM sqlite_master WHERE name = ?;", (table_name,)).fetchone()
+        if table_name == 'transactions' and row is not None and row[0] == 'view':
+            cursor.execute("DROP VIEW transactions;")
+            for partition in partitions.list_partitions(conn):
+                cursor.execute(f"DROP TABLE {partition};")
+        else:
+            cursor.execute(f"DROP TABLE IF EXISTS {table_name};")
         conn.commit()
         conn.close()
 
@@ -306,9 +453,12 @@ def delete_table(db_path, table_name):
         print(f"An error occurred while deleting the table: {e}")
         logs.log_error(f"Error occurred while deleting {table_name} table.")
 
+@profiling.profile_stage()
 def data_import_executive():
     """
     This function executes the steps to create the database schema and import the raw data from the CSV files.
+    The steps run through the pipeline scheduler, so a CSV file that did not change since its last import is skipped.
+    With sharded storage enabled, the rows are routed to the shard databases instead.
     :return: None
     """
 
@@ -317,9 +467,31 @@ def data_import_executive():
     if settings.DELETE_TRANSACTION_TABLE:
         delete_table(DATABASE_PATH, "transactions")
 
-    create_db_schemas(DATABASE_PATH)
-    load_users_to_db(DATABASE_PATH, USERS_PATH)
-    load_transactions_to_db(DATABASE_PATH, TRANSACTIONS_PATH)
+    if sharding.is_sharded():
+        create_schemas, load_users, load_transactions = \
+            create_shard_schemas, load_users_to_shards, load_transactions_to_shards
+        users_exist = transactions_exist = None  # The main database holds no rows when sharded.
+    else:
+        create_schemas, load_users, load_transactions = create_db_schemas, load_users_to_db, load_transactions_to_db
+        users_exist = lambda: utility_library.table_has_rows('users')
+        transactions_exist = lambda: utility_library.table_has_rows('transactions')
+
+    stages = [
+        pipeline_scheduler.Stage('create_db_schemas', lambda: create_schemas(DATABASE_PATH), writes=True),
+        pipeline_scheduler.Stage('load_users_to_db', lambda: load_users(DATABASE_PATH, USERS_PATH),
+                                 depends_on=['create_db_schemas'], writes=True,
+                                 inputs=lambda: pipeline_scheduler.file_fingerprint(USERS_PATH),
+                                 outputs_exist=users_exist),
+        pipeline_scheduler.Stage('load_transactions_to_db',
+                                 lambda: load_transactions(DATABASE_PATH, TRANSACTIONS_PATH),
+                                 depends_on=['create_db_schemas'], writes=True,
+                                 inputs=lambda: pipeline_scheduler.file_fingerprint(TRANSACTIONS_PATH),
+                                 outputs_exist=transactions_exist),
+    ]
+    statuses, _ = pipeline_scheduler.run_stages(stages, max_workers=pipeline_scheduler.get_max_workers())
+    if statuses['load_users_to_db'] != pipeline_scheduler.STAGE_SKIPPED or \
+            statuses['load_transactions_to_db'] != pipeline_scheduler.STAGE_SKIPPED:
+        utility_library.bump_data_version()
 
     logs.log_event('Task 1 Completed Successfully. All data has been imported into SQLite Database.')
 
@@ -0,0 +1,213 @@
+"""
+Continuous micro-batch ingestion.
+
+The daemon watches a spool directory for CSV files. Every INGEST_POLL_SECONDS, each new file is ingested as a
+micro-batch:
+    1. The file is classified as users or transactions data by its header and cleaned with the same cleaners used by
+       the initial import (clean_users_data and clean_transactions_data).
+    2. The rows of all files in the batch are inserted in a single transaction.
+    3. The ETL outputs, per-user prefix sums, rollup cube, and user risk scores are updated incrementally for the
+       affected users and dates only, and the analytic snapshot is rewritten.
+    4. Ingested files are moved to the processed directory. Files that could not be read are moved to the failed
+       directory.
+
+Producers should write files under a temporary name and rename them to *.csv once complete, so the daemon never reads
+a partially written file. The database runs in WAL mode, so the API keeps serving reads while a batch is written.
+"""
+
+import glob
+import os
+import sqlite3
+import threading
+
+import pandas as pd
+
+import analytic_snapshot
+import etl
+import import_raw_to_db
+import logs
+import profiling
+import risk_scoring
+import rollup_cube
+import settings
+import sharding
+import utility_library
+
+DATABASE_PATH = settings.DB_PATH
+USER_COLUMNS = {'user_id', 'signup_date', 'country'}
+TRANSACTION_COLUMNS = {'transaction_id', 'user_id', 'transaction_date', 'amount', 'transaction_type'}
+
+# Held while a micro-batch is written. A background refresh holds it from copying the database until the swap, so no
+# batch is written to the live database in between and lost.
+batch_lock = threading.Lock()
+
+
+def classify_batch_file(columns):
+    """
+    Classifies a spooled CSV file by its columns.
+    :param columns: Column names of the file.
+    :return: 'users', 'transactions', or None if the file matches neither schema.
+    """
+    columns = set(columns)
+    if TRANSACTION_COLUMNS <= columns:
+        return 'transactions'
+    if USER_COLUMNS <= columns:
+        return 'users'
+    return None
+
+def move_spooled_file(path, destination_dir):
+    """
+    Moves a spooled file into a subdirectory of the spool directory.
+    :param path: Path of the spooled file.
+    :param destination_dir: Destination directory.
+    :return: None
+    """
+    os.makedirs(destination_dir, exist_ok=True)
+    os.replace(path, os.path.join(destination_dir, os.path.basename(path)))
+
+def find_previous_transaction_keys(conn, transaction_ids):
+    """
+    Looks up the users and dates of existing transactions that a batch is about to replace, so their aggregates are
+    updated as well.
+    :param conn: Open SQLite connection.
+    :param transaction_ids: Transaction IDs in the batch.
+    :return: Tuple of sets (user IDs, transaction dates)
+    """
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS batch_transaction_ids (transaction_id INTEGER PRIMARY KEY);")
+    conn.execute("DELETE FROM batch_transaction_ids;")
+    conn.executemany("INSERT OR IGNORE INTO batch_transaction_ids (transaction_id) VALUES (?);",
+                     [(int(transaction_id),) for transaction_id in transaction_ids])
+    rows = conn.execute("""
+        SELECT t.user_id, t.transaction_date
+        FROM transactions t
+        JOIN batch_transaction_ids b ON t.transaction_id = b.transaction_id;
+    """).fetchall()
+    return {row[0] for row in rows}, {row[1] for row in rows}
+
+def check_unsharded():
+    """
+    Raises if sharded storage is enabled. Micro-batches are written to the main database, which sharded reads never
+    query, so ingesting would silently diverge from the served data.
+    :return: None
+    """
+    if sharding.is_sharded():
+        raise RuntimeError('The ingestion daemon does not support sharded storage. Set SHARD_COUNT to 1 or load data '
+                           'with the ingest command.')
+
+@profiling.profile_stage()
+def ingest_micro_batch(spool_dir=None):
+    """
+    Ingests every CSV file currently in the spool directory as one micro-batch and updates the ETL outputs
+    incrementally.
+    :param spool_dir: Spool directory. Defaults to settings.INGEST_SPOOL_DIR.
+    :return: Number of files ingested.
+    """
+    check_unsharded()
+    spool_dir = spool_dir or settings.INGEST_SPOOL_DIR
+    paths = sorted(glob.glob(os.path.join(spool_dir, '*.csv')))
+    if not paths:
+        return 0
+
+    users_frames, transactions_frames, ingested_paths = [], [], []
+    for path in paths:
+        try:
+            data = pd.read_csv(path)
+        except (OSError, ValueError) as e:
+            logs.log_error(f'Spooled file {path} could not be read and was moved to the failed directory. Error: {e}')
+            move_spooled_file(path, os.path.join(spool_dir, 'failed'))
+            continue
+
+        kind = classify_batch_file(data.columns)
+        if kind == 'users':
+            users_frames.append(import_raw_to_db.clean_users_data(data))
+        elif kind == 'transactions':
+            transactions_frames.append(import_raw_to_db.clean_transactions_data(data))
+        else:
+            logs.log_error(f'Spooled file {path} matches neither the users nor the transactions schema and was moved '
+                           f'to the failed directory.')
+            move_spooled_file(path, os.path.join(spool_dir, 'failed'))
+            continue
+        ingested_paths.append(path)
+
+    if not ingested_paths:
+        return 0
+
+    users = pd.concat(users_frames, ignore_index=True) if users_frames else None
+    transactions = pd.concat(transactions_frames, ignore_index=True) if transactions_frames else None
+    user_count = len(users) if users is not None else 0
+    transaction_count = len(transactions) if transactions is not None else 0
+    affected_users, affected_dates = set(), set()
+
+    conn = sqlite3.connect(DATABASE_PATH)
+    try:
+        if user_count:
+            import_raw_to_db.insert_users(conn, users)
+            affected_users.update(users['user_id'].tolist())
+        if transaction_count:
+            previous_users, previous_dates = find_previous_transaction_keys(conn, transactions['transaction_id'])
+            import_raw_to_db.insert_transactions(conn, transactions)
+            affected_users.update(previous_users, transactions['user_id'].tolist())
+            affected_dates.update(previous_dates, transactions['transaction_date'].tolist())
+        conn.commit()
+    except sqlite3.Error as e:
+        conn.rollback()
+        logs.log_error(f'Micro-batch could not be ingested into SQLite Database. Error: {e}')
+        raise
+    finally:
+        conn.close()
+
+    profiling.record_rows(user_count + transaction_count)
+    etl.incremental_etl_update(affected_users, affected_dates)
+    if settings.BUILD_PREFIX_SUMS:
+        etl.build_prefix_sums(affected_users)
+    if settings.BUILD_ROLLUP_CUBE:
+        rollup_cube.update_rollup_cube(affected_users, affected_dates, DATABASE_PATH)
+    if settings.SCORE_USER_RISK:
+        risk_scoring.update_user_risk(affected_users, affected_dates, DATABASE_PATH)
+    if analytic_snapshot.snapshot_enabled():
+        analytic_snapshot.write_snapshot(DATABASE_PATH, settings.ANALYTIC_SNAPSHOT_PATH)
+    utility_library.bump_data_version()
+
+    for path in ingested_paths:
+        move_spooled_file(path, os.path.join(spool_dir, 'processed'))
+    logs.log_event(f'Micro-batch ingested {len(ingested_paths)} files: {user_count} users, '
+                   f'{transaction_count} transactions.')
+    return len(ingested_paths)
+
+def run_ingest_daemon(stop_event=None, spool_dir=None, poll_seconds=None):
+    """
+    Ingests micro-batches from the spool directory until the stop event is set.
+    :param stop_event: threading.Event used to stop the daemon. The daemon runs forever if None.
+    :param spool_dir: Spool directory. Defaults to settings.INGEST_SPOOL_DIR.
+    :param poll_seconds: Seconds between batches. Defaults to settings.INGEST_POLL_SECONDS.
+    :return: None
+    """
+    check_unsharded()
+    stop_event = stop_event or threading.Event()
+    spool_dir = spool_dir or settings.INGEST_SPOOL_DIR
+    poll_seconds = poll_seconds or settings.INGEST_POLL_SECONDS
+    os.makedirs(spool_dir, exist_ok=True)
+    logs.log_event(f'Ingestion daemon started. Watching {spool_dir} every {poll_seconds} seconds.')
+
+    while not stop_event.is_set():
+        try:
+            with batch_lock:
+                ingest_micro_batch(spool_dir)
+        except Exception as e:
+            # Keep the daemon alive. The files stay in the spool directory and are retried on the next batch.
+            logs.log_error(f'Micro-batch ingestion failed. Error: {e}')
+        stop_event.wait(poll_seconds)
+
+    logs.log_event(f'Ingestion daemon stopped.')
+
+def start_ingest_daemon_thread(stop_event=None):
+    """
+    Starts the ingestion daemon on a background thread, so it runs alongside the API server.
+    :param stop_event: threading.Event used to stop the daemon.
+    :return: The started thread.
+    """
+    check_unsharded()  # Fails on startup rather than in the background thread.
+    thread = threading.Thread(target=run_ingest_daemon, kwargs={'stop_event': stop_event}, name='ingest-daemon',
+                              daemon=True)
+    thread.start()
+    return thread
@@ -3,27 +3,42 @@ Task 4b: Logging
 - Key events are logged using the logging library.
 - Errors are logged in try-except wrappings.
 
-New log files are created for each run describing the application status for each run.
+New log files are created for each run describing the application status for each run. Logging is initialized
+explicitly with init_logging() by the entry points, so importing a module never creates a log file. Until then, only
+warnings and errors are printed to stderr.
 """
 
 import logging
 import os
 from datetime import datetime
 
-# Generate a unique log file name based on the current timestamp
-current_time = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-LOG_FILE = f"app_{current_time}.log"
-os.makedirs("logs", exist_ok=True)  # Ensure the logs directory exists
-
-logging.basicConfig(
-    filename=os.path.join("logs", LOG_FILE),
-    level=logging.INFO,  # Log INFO level and above
-    format="%(asctime)s - %(levelname)s - %(message)s",
-)
+LOG_DIR = "logs"
+LOG_FILE = None  # Name of the log file of this run, set by init_logging()
 
 # Create a logger instance
 logger = logging.getLogger(__name__)
 
+def init_logging(log_file=None):
+    """
+    Creates the logs directory and routes log events to a log file. Only the first call has an effect.
+    :param log_file: Optional name of an existing log file to append to, e.g. the log file of a parent process. A new
+    file named after the current timestamp is created if None.
+    :return: Path of the log file.
+    """
+    global LOG_FILE
+    if LOG_FILE is None:
+        # Generate a unique log file name based on the current timestamp
+        current_time = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        LOG_FILE = log_file or f"app_{current_time}.log"
+        os.makedirs(LOG_DIR, exist_ok=True)  # Ensure the logs directory exists
+
+        logging.basicConfig(
+            filename=os.path.join(LOG_DIR, LOG_FILE),
+            level=logging.INFO,  # Log INFO level and above
+            format="%(asctime)s - %(levelname)s - %(message)s",
+        )
+    return os.path.join(LOG_DIR, LOG_FILE)
+
 def log_event(event_message):
     """Log an informational event."""
     logger.info(event_message)
@@ -38,4 +53,4 @@ def log_critical(critical_message):
 
 def log_warning(warning_message):
     """Log a warning."""
-    logger.warning(warning_message)
\ No newline at end of file
+    logger.warning(warning_message)
@@ -1,14 +1,30 @@
 """
 Application execution endpoint. Configure interpreter to this file.
+
+Usage:
+    python main.py                  Ingest, run the ETL, and serve the API.
+    python main.py ingest           Ingest the CSV files into the database.
+    python main.py etl              Run the ETL pipeline.
+    python main.py serve            Serve the API. Add --background-refresh or --ingest-daemon to refresh while serving.
+    python main.py bench --scale 1M Run the benchmark. Arguments after `bench` are passed to benchmark.py.
+    python main.py generate --scale 1B
+                                    Generate synthetic data. Arguments after `generate` are passed to synthetic_data.py.
+    python main.py export user_summary --format parquet --start 2024-01-01
+                                    Export an ETL output (user_summary or daily_aggregates) as CSV or Parquet.
+
+Each command imports only the modules it needs, so `python main.py --help` and the batch commands start without
+loading Flask.
 """
 
-import import_raw_to_db
-import etl
-import flask_api
-import settings
+import argparse
+
 import logs
+import settings
 
-if __name__ == "__main__":
+
+def log_global_settings():
+    """Initializes logging for this run and logs the global settings."""
+    logs.init_logging()
     logs.log_event(f'GLOBAL SETTINGS: \n'
                    f'\tDatabase Path = {settings.DB_PATH}\n'
                    f'\tUser CSV Path = {settings.USER_CSV_PATH}\n'
@@ -18,7 +34,122 @@ if __name__ == "__main__":
                    f'\tDelete User Table = {settings.DELETE_USER_TABLE}\n'
                    f'\tDelete Transaction Table = {settings.DELETE_TRANSACTION_TABLE}\n')
 
+def write_profile_summary():
+    """Writes the profiling summary of this run if profiling is enabled."""
+    if settings.ENABLE_PROFILING:
+        import profiling
+        profiling.write_run_summary(settings.PROFILE_SUMMARY_PATH)
+
+def run_ingest(args):
+    """Ingests the CSV files into the database."""
+    import import_raw_to_db
     import_raw_to_db.data_import_executive()
+    write_profile_summary()
+
+def run_etl(args):
+    """Runs the ETL pipeline."""
+    import etl
     etl.etl_executive()
-    flask_api.app.run(debug=True, use_reloader=False)
+    write_profile_summary()
+
+def run_export(args):
+    """Exports an ETL output to a file."""
+    import export
+    export.export_to_file(args.dataset, args.format, args.output, args.start, args.end)
+
+def run_serve(args):
+    """Serves the API, optionally refreshing the data in the background."""
+    import flask_api
+    if args.background_refresh:
+        import background_refresh
+        background_refresh.start_background_refresh()
+    if args.ingest_daemon:
+        import ingest_daemon
+        ingest_daemon.start_ingest_daemon_thread()
+    flask_api.app.run(host=args.host, port=args.port, debug=True, use_reloader=False)
+
+def run_all(args):
+    """Ingests, runs the ETL, and serves the API, as configured in settings.py."""
+    if settings.BACKGROUND_REFRESH:
+        args.background_refresh = True
+    else:
+        import import_raw_to_db
+        import etl
+        import_raw_to_db.data_import_executive()
+        etl.etl_executive()
+        write_profile_summary()
+    run_serve(args)
 
+def run_bench(args):
+    """Runs the benchmark with the remaining command line arguments."""
+    import benchmark
+    benchmark.main(args.passthrough_args)
+
+def run_generate(args):
+    """Generates synthetic data with the remaining command line arguments."""
+    import synthetic_data
+    synthetic_data.main(args.passthrough_args)
+
+def add_serve_arguments(parser):
+    """Adds the arguments of the serve command to a parser."""
+    parser.add_argument('--host', default='127.0.0.1', help='Host to serve the API on.')
+    parser.add_argument('--port', type=int, default=5000, help='Port to serve the API on.')
+    parser.add_argument('--background-refresh', action='store_true', default=settings.BACKGROUND_REFRESH,
+                        help='Refresh the database in a background process while serving.')
+    parser.add_argument('--ingest-daemon', action='store_true', default=settings.RUN_INGEST_DAEMON,
+                        help='Ingest CSV files dropped into the spool directory while serving.')
+
+def build_parser():
+    """
+    Builds the command line parser.
+    :return: argparse.ArgumentParser
+    """
+    parser = argparse.ArgumentParser(description='MoneyLion transaction data pipeline and API.')
+    add_serve_arguments(parser)
+    parser.set_defaults(command=run_all)
+    subparsers = parser.add_subparsers(title='commands')
+
+    subparsers.add_parser('ingest', help='Ingest the CSV files into the database.').set_defaults(command=run_ingest)
+    subparsers.add_parser('etl', help='Run the ETL pipeline.').set_defaults(command=run_etl)
+
+    export_parser = subparsers.add_parser('export', help='Export an ETL output as CSV or Parquet.')
+    # The choices mirror export.DATASETS and export.FORMATS, so parsing the command line does not import export.py.
+    export_parser.add_argument('dataset', choices=['user_summary', 'daily_aggregates'])
+    export_parser.add_argument('--format', choices=['csv', 'parquet'], default='csv',
+                               help='File format. Parquet requires pyarrow.')
+    export_parser.add_argument('--output', default=None,
+                               help=f'Output file. Defaults to {settings.EXPORT_DIR}/<dataset>.<format>.')
+    export_parser.add_argument('--start', default=None, help='First day (YYYY-MM-DD) of the exported rows.')
+    export_parser.add_argument('--end', default=None, help='Last day (YYYY-MM-DD) of the exported rows.')
+    export_parser.set_defaults(command=run_export)
+
+    serve_parser = subparsers.add_parser('serve', help='Serve the API.')
+    add_serve_arguments(serve_parser)
+    serve_parser.set_defaults(command=run_serve)
+
+    bench_parser = subparsers.add_parser('bench', help='Run the benchmark. See python benchmark.py --help.',
+                                         add_help=False)
+    bench_parser.set_defaults(command=run_bench)
+    generate_parser = subparsers.add_parser('generate', add_help=False,
+                                            help='Generate synthetic data. See python synthetic_data.py --help.')
+    generate_parser.set_defaults(command=run_generate)
+    return parser
+
+def main(argv=None):
+    """
+    Parses the command line and runs the command.
+    :param argv: Command line arguments. Defaults to sys.argv.
+    :return: None
+    """
+    parser = build_parser()
+    # Unknown arguments are only accepted by the bench and generate commands, which pass them on to their scripts.
+    args, unknown_args = parser.parse_known_args(argv)
+    if unknown_args and args.command not in (run_bench, run_generate):
+        parser.error(f'unrecognized arguments: {" ".join(unknown_args)}')
+    args.passthrough_args = unknown_args
+    log_global_settings()
+    args.command(args)
+
+
+if __name__ == "__main__":
+    main()
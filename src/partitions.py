@@ -0,0 +1,184 @@
+"""
+Monthly partitions of the transactions table.
+
+With PARTITION_TRANSACTIONS_BY_MONTH enabled, transactions are stored in one table per month (e.g.
+transactions_2024_03) and `transactions` is a UNION ALL view over every partition, so existing queries keep working:
+    - Ingestion routes rows to the partition of their transaction_date.
+    - The daily transactions endpoint queries the partition of the requested date only.
+    - A month is removed with drop_month(), which drops its table instead of deleting rows from one large table.
+A database created before partitioning was enabled is migrated to partitions by create_db_schemas().
+"""
+
+import re
+import sqlite3
+from datetime import datetime
+
+import logs
+import settings
+import utility_library
+
+PARTITION_PREFIX = 'transactions_'
+PARTITION_PATTERN = re.compile(r'^transactions_\d{4}_\d{2}$')
+DATE_PATTERN = re.compile(r'^(\d{4})-(\d{2})(-\d{2})?$')
+TRANSACTION_COLUMNS = 'transaction_id, user_id, transaction_date, amount, transaction_type'
+
+
+def is_partitioned():
+    """Returns True if monthly partitions are enabled in settings."""
+    return settings.PARTITION_TRANSACTIONS_BY_MONTH
+
+def partition_for_date(transaction_date):
+    """
+    Returns the partition table of a date or month.
+    :param transaction_date: Date as YYYY-MM-DD, or month as YYYY-MM.
+    :return: Table name, or None if the value is not a date.
+    """
+    match = DATE_PATTERN.match(str(transaction_date))
+    if match is None:
+        return None
+    return f'{PARTITION_PREFIX}{match.group(1)}_{match.group(2)}'
+
+def normalize_date(transaction_date):
+    """
+    Zero-pads a date accepted by the cleaners (e.g. 2024-3-5) to YYYY-MM-DD, so it routes to a partition.
+    :param transaction_date: Date string.
+    :return: Date as YYYY-MM-DD.
+    """
+    return datetime.strptime(str(transaction_date), '%Y-%m-%d').strftime('%Y-%m-%d')
+
+def list_partitions(conn):
+    """
+    Lists the partition tables of a database in chronological order.
+    :param conn: Open SQLite connection.
+    :return: List of table names.
+    """
+    tables = conn.execute("SELECT name FROM sqlite_master WHERE type = 'table';").fetchall()
+    return sorted(row[0] for row in tables if PARTITION_PATTERN.match(row[0]))
+
+def partition_exists(table, db_path=None):
+    """
+    Checks whether a partition table exists.
+    :param table: Partition table name.
+    :param db_path: Database path. Defaults to utility_library.DATABASE_PATH.
+    :return: bool
+    """
+    conn = sqlite3.connect(db_path or utility_library.DATABASE_PATH)
+    try:
+        return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?;",
+                            (table,)).fetchone() is not None
+    finally:
+        conn.close()
+
+def create_partition(conn, table):
+    """
+    Creates a partition table and its indexes if they don't already exist. The schema matches the unpartitioned
+    transactions table.
+    :param conn: Open SQLite connection.
+    :param table: Partition table name, as returned by partition_for_date().
+    :return: None
+    """
+    conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS {table} (
+            transaction_id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            transaction_date TEXT,
+            amount REAL,
+            transaction_type TEXT,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        );
+    ''')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_user_id ON {table} (user_id);')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_date ON {table} (transaction_date);')
+
+def refresh_transactions_view(conn):
+    """
+    Recreates the `transactions` view as the union of every partition.
+    :param conn: Open SQLite connection.
+    :return: None
+    """
+    partitions = list_partitions(conn)
+    if partitions:
+        body = '\nUNION ALL\n'.join(f'SELECT {TRANSACTION_COLUMNS} FROM {table}' for table in partitions)
+    else:
+        body = ('SELECT CAST(NULL AS INTEGER) AS transaction_id, CAST(NULL AS INTEGER) AS user_id, '
+                'CAST(NULL AS TEXT) AS transaction_date, CAST(NULL AS REAL) AS amount, '
+                'CAST(NULL AS TEXT) AS transaction_type WHERE 0')
+    conn.execute('DROP VIEW IF EXISTS transactions;')
+    conn.execute(f'CREATE VIEW transactions AS\n{body};')
+
+def migrate_to_partitions(conn):
+    """
+    Moves the rows of an unpartitioned transactions table into monthly partitions, drops the table, and creates the
+    `transactions` view. Dates that are not zero-padded are normalized first, so every row lands in a partition. Does
+    nothing but refresh the view if the database is already partitioned.
+    :param conn: Open SQLite connection. The caller commits the transaction.
+    :return: None
+    """
+    row = conn.execute("SELECT type FROM sqlite_master WHERE name = 'transactions';").fetchone()
+    if row is not None and row[0] == 'table':
+        unpadded = conn.execute("SELECT DISTINCT transaction_date FROM transactions "
+                                "WHERE transaction_date NOT GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]';")
+        for (transaction_date,) in unpadded.fetchall():
+            conn.execute("UPDATE transactions SET transaction_date = ? WHERE transaction_date = ?;",
+                         (normalize_date(transaction_date), transaction_date))
+        months = conn.execute("SELECT DISTINCT substr(transaction_date, 1, 7) FROM transactions;").fetchall()
+        for (month,) in months:
+            table = partition_for_date(month)
+            create_partition(conn, table)
+            conn.execute(f'''
+                INSERT OR REPLACE INTO {table} ({TRANSACTION_COLUMNS})
+                SELECT {TRANSACTION_COLUMNS} FROM transactions WHERE substr(transaction_date, 1, 7) = ?;
+            ''', (month,))
+        conn.execute('DROP TABLE transactions;')
+        logs.log_event(f'Transactions table migrated to {len(months)} monthly partitions.')
+    refresh_transactions_view(conn)
+
+def insert_partitioned_transactions(conn, data):
+    """
+    Inserts cleaned transaction rows into the partitions of their transaction dates, stored as YYYY-MM-DD. A row
+    replaces any existing row with the same transaction_id, including one stored in the partition of a different month.
+    :param conn: Open SQLite connection. The caller commits the transaction.
+    :param data: Cleaned transactions DataFrame.
+    :return: None
+    """
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS partition_batch_ids (transaction_id INTEGER PRIMARY KEY);")
+    conn.execute("DELETE FROM partition_batch_ids;")
+    conn.executemany("INSERT OR IGNORE INTO partition_batch_ids (transaction_id) VALUES (?);",
+                     [(int(transaction_id),) for transaction_id in data['transaction_id']])
+    for table in list_partitions(conn):
+        conn.execute(f'DELETE FROM {table} WHERE transaction_id IN (SELECT transaction_id FROM partition_batch_ids);')
+
+    columns = ['transaction_id', 'user_id', 'transaction_date', 'amount', 'transaction_type']
+    data = data.assign(transaction_date=data['transaction_date'].map(normalize_date))
+    for month, rows in data.groupby(data['transaction_date'].str[:7]):
+        table = partition_for_date(month)
+        create_partition(conn, table)
+        conn.executemany(f'INSERT OR REPLACE INTO {table} ({TRANSACTION_COLUMNS}) VALUES (?, ?, ?, ?, ?);',
+                         rows[columns].astype(object).itertuples(index=False, name=None))
+    refresh_transactions_view(conn)
+
+def drop_month(month, db_path=None):
+    """
+    Drops the partition of a month and records a new version of the transactions table, so the next ETL run recomputes
+    the aggregates without the month.
+    :param month: Month as YYYY-MM.
+    :param db_path: Database path. Defaults to utility_library.DATABASE_PATH.
+    :return: True if a partition was dropped.
+    """
+    table = partition_for_date(month)
+    if table is None:
+        raise ValueError(f'Invalid month: {month}. Expected YYYY-MM.')
+
+    conn = sqlite3.connect(db_path or utility_library.DATABASE_PATH)
+    try:
+        if table not in list_partitions(conn):
+            return False
+        conn.execute(f'DROP TABLE {table};')
+        refresh_transactions_view(conn)
+        utility_library.bump_table_version('transactions', conn)
+        conn.commit()
+    finally:
+        conn.close()
+
+    logs.log_event(f'Transactions partition {table} dropped.')
+    return True
@@ -0,0 +1,177 @@
+"""
+Dependency-aware scheduler for ingestion and ETL stages.
+
+Stages form a DAG through their dependencies. Stages whose dependencies have completed run concurrently on a thread
+pool: read-only stages open their own read connections and run in parallel (the database uses WAL mode, so readers
+never block each other or the writer), while stages that write to the database hold a shared writer lock and run one
+at a time.
+
+Stages can be skipped when their inputs did not change since their last successful run. A stage's inputs are described
+by a callable that returns a fingerprint (e.g. table versions recorded by ingestion or the size and modification time
+of a CSV file). The fingerprint of the last successful run is stored in the pipeline_metadata table.
+"""
+
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import logs
+import settings
+import utility_library
+
+STAGE_COMPLETED = 'completed'
+STAGE_SKIPPED = 'skipped'
+STAGE_FAILED = 'failed'
+STAGE_BLOCKED = 'blocked'
+
+
+class Stage:
+    """
+    A single pipeline stage.
+    :param name: Unique stage name.
+    :param func: Callable run without arguments.
+    :param depends_on: Names of the stages that must complete before this stage runs.
+    :param writes: True if the stage writes to the database. Writing stages never run concurrently with each other.
+    :param inputs: Optional callable returning a fingerprint of the stage's inputs. Stages without inputs always run.
+    :param outputs_exist: Optional callable returning False if the stage's outputs are missing, forcing it to run even
+    when its inputs did not change.
+    """
+
+    def __init__(self, name, func, depends_on=(), writes=False, inputs=None, outputs_exist=None):
+        self.name = name
+        self.func = func
+        self.depends_on = tuple(depends_on)
+        self.writes = writes
+        self.inputs = inputs
+        self.outputs_exist = outputs_exist
+
+
+def file_fingerprint(*paths):
+    """
+    Fingerprints files by size and modification time.
+    :param paths: File paths.
+    :return: Fingerprint string.
+    """
+    parts = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            parts.append(f'{path}:{stat.st_size}:{stat.st_mtime_ns}')
+        except FileNotFoundError:
+            parts.append(f'{path}:missing')
+    return '|'.join(parts)
+
+def table_fingerprint(*tables):
+    """
+    Fingerprints tables by the versions ingestion records whenever it writes to them.
+    :param tables: Table names.
+    :return: Fingerprint string.
+    """
+    return '|'.join(f'{table}:{utility_library.get_table_version(table)}' for table in tables)
+
+def get_max_workers():
+    """
+    Returns the number of concurrent stages configured in settings. Stages run one at a time when PARALLEL_PIPELINE is
+    disabled.
+    :return: int
+    """
+    return settings.PIPELINE_MAX_WORKERS if settings.PARALLEL_PIPELINE else 1
+
+def validate_stages(stages):
+    """
+    Ensures stage names are unique, every dependency exists, and the dependencies contain no cycles.
+    :param stages: List of Stage objects.
+    :return: None
+    """
+    by_name = {}
+    for stage in stages:
+        if stage.name in by_name:
+            raise ValueError(f'Duplicate pipeline stage: {stage.name}')
+        by_name[stage.name] = stage
+    for stage in stages:
+        for dependency in stage.depends_on:
+            if dependency not in by_name:
+                raise ValueError(f'Pipeline stage {stage.name} depends on unknown stage {dependency}')
+
+    visiting, visited = set(), set()
+
+    def visit(name):
+        if name in visited:
+            return
+        if name in visiting:
+            raise ValueError(f'Pipeline stages contain a dependency cycle through {name}')
+        visiting.add(name)
+        for dependency in by_name[name].depends_on:
+            visit(dependency)
+        visiting.remove(name)
+        visited.add(name)
+
+    for stage in stages:
+        visit(stage.name)
+
+def run_stages(stages, max_workers=None, skip_unchanged=None):
+    """
+    Runs the stages in dependency order, running independent stages concurrently and serializing writers.
+    If a stage fails, its dependents are not run and a RuntimeError is raised once the running stages have finished.
+    :param stages: List of Stage objects.
+    :param max_workers: Maximum number of concurrent stages. Defaults to settings.PIPELINE_MAX_WORKERS.
+    :param skip_unchanged: Skip stages whose inputs did not change. Defaults to settings.SKIP_UNCHANGED_STAGES.
+    :return: Tuple of dictionaries (stage name to status, stage name to return value).
+    """
+    validate_stages(stages)
+    max_workers = max_workers or settings.PIPELINE_MAX_WORKERS
+    skip_unchanged = settings.SKIP_UNCHANGED_STAGES if skip_unchanged is None else skip_unchanged
+    writer_lock = threading.Lock()
+    statuses = {}
+    results = {}
+
+    def execute(stage):
+        fingerprint = stage.inputs() if stage.inputs is not None else None
+        metadata_key = f'stage_inputs:{stage.name}'
+        if (skip_unchanged and fingerprint is not None
+                and utility_library.get_metadata(metadata_key) == fingerprint
+                and (stage.outputs_exist is None or stage.outputs_exist())):
+            logs.log_event(f'Pipeline stage {stage.name} skipped. Inputs unchanged since the last run.')
+            return STAGE_SKIPPED, None
+
+        if stage.writes:
+            with writer_lock:
+                result = stage.func()
+        else:
+            result = stage.func()
+
+        if fingerprint is not None:
+            with writer_lock:
+                utility_library.set_metadata(metadata_key, fingerprint)
+        logs.log_event(f'Pipeline stage {stage.name} completed.')
+        return STAGE_COMPLETED, result
+
+    pending = {stage.name: stage for stage in stages}
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            for name, stage in list(pending.items()):
+                dependency_statuses = [statuses.get(dependency) for dependency in stage.depends_on]
+                if any(status in (STAGE_FAILED, STAGE_BLOCKED) for status in dependency_statuses):
+                    statuses[name] = STAGE_BLOCKED
+                    del pending[name]
+                    logs.log_warning(f'Pipeline stage {name} not run because a dependency failed.')
+                elif all(status in (STAGE_COMPLETED, STAGE_SKIPPED) for status in dependency_statuses):
+                    running[executor.submit(execute, stage)] = name
+                    del pending[name]
+
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    statuses[name], results[name] = future.result()
+                except Exception as e:
+                    statuses[name] = STAGE_FAILED
+                    logs.log_error(f'Pipeline stage {name} failed. Error: {e}')
+
+    failed = [name for name, status in statuses.items() if status == STAGE_FAILED]
+    if failed:
+        raise RuntimeError(f'Pipeline stages failed: {", ".join(failed)}')
+    return statuses, results
@@ -0,0 +1,190 @@
+"""
+Cumulative prefix sums of daily transaction totals for rolling-window queries.
+
+The ETL writes two prefix sum tables from the daily aggregates:
+    - daily_prefix_sums: Global running totals per transaction type and for all types ('all'), with one row for every
+      calendar day between the first and last transaction date, including days without transactions.
+    - user_daily_prefix_sums: Running totals per user and transaction type (and 'all'), with one row for each day the
+      user had transactions.
+The total of any window is the difference of two prefix values: the total of the `window` days ending on day d is
+P(d) - P(d - window), where P(d) is the running total of the last row on or before d. A series of N points is answered
+from a single range read, with a binary search per point.
+"""
+
+import sqlite3
+from bisect import bisect_right
+from datetime import date, timedelta
+
+import logs
+import profiling
+import utility_library
+
+ALL_TYPES = 'all'
+
+
+def create_prefix_sum_tables(cursor):
+    """
+    Creates the prefix sum tables if they don't already exist.
+    :param cursor: SQLite cursor used to create the tables.
+    :return: None
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS daily_prefix_sums (
+            transaction_type TEXT,
+            transaction_date TEXT,
+            cumulative_total REAL,
+            PRIMARY KEY (transaction_type, transaction_date)
+        );
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS user_daily_prefix_sums (
+            user_id INTEGER,
+            transaction_type TEXT,
+            transaction_date TEXT,
+            cumulative_total REAL,
+            PRIMARY KEY (user_id, transaction_type, transaction_date)
+        );
+    """)
+
+def global_prefix_rows(daily_aggregates):
+    """
+    Builds the dense global prefix sums from the daily aggregates.
+    :param daily_aggregates: DataFrame with transaction_date, transaction_type, and daily_total columns, as returned by
+    etl.aggregate_daily_transactions().
+    :return: List of tuples (transaction_type, transaction_date, cumulative_total)
+    """
+    import pandas as pd
+
+    if daily_aggregates.empty:
+        return []
+    totals = daily_aggregates.pivot_table(index='transaction_date', columns='transaction_type', values='daily_total',
+                                          aggfunc='sum', fill_value=0.0)
+    days = pd.date_range(totals.index.min(), totals.index.max(), freq='D').strftime('%Y-%m-%d')
+    totals = totals.reindex(days, fill_value=0.0)
+    totals[ALL_TYPES] = totals.sum(axis=1)
+    cumulative = totals.cumsum()
+    return [(transaction_type, transaction_date, float(value))
+            for transaction_type in cumulative.columns
+            for transaction_date, value in cumulative[transaction_type].items()]
+
+@profiling.profile_stage()
+def write_prefix_sums(daily_aggregates, db_path=None, user_ids=None):
+    """
+    Replaces the contents of the prefix sum tables in a single transaction. The global prefix sums are built from the
+    daily aggregates, and the per-user prefix sums with a window function over the per-user daily totals.
+    :param daily_aggregates: DataFrame with transaction_date, transaction_type, and daily_total columns.
+    :param db_path: Database path. Defaults to utility_library.DATABASE_PATH.
+    :param user_ids: Optional user IDs. Only the per-user prefix sums of these users are replaced if given, using the
+    transactions index on user_id.
+    :return: None
+    """
+    conn = sqlite3.connect(db_path or utility_library.DATABASE_PATH)
+    cursor = conn.cursor()
+    try:
+        create_prefix_sum_tables(cursor)
+        cursor.execute("DELETE FROM daily_prefix_sums;")
+        cursor.executemany("""
+            INSERT INTO daily_prefix_sums (transaction_type, transaction_date, cumulative_total)
+            VALUES (?, ?, ?);
+        """, global_prefix_rows(daily_aggregates))
+
+        if user_ids is None:
+            user_filter = ''
+            cursor.execute("DELETE FROM user_daily_prefix_sums;")
+        else:
+            user_filter = 'WHERE user_id IN (SELECT user_id FROM prefix_sum_users)'
+            cursor.execute("CREATE TEMP TABLE IF NOT EXISTS prefix_sum_users (user_id INTEGER PRIMARY KEY);")
+            cursor.execute("DELETE FROM prefix_sum_users;")
+            cursor.executemany("INSERT OR IGNORE INTO prefix_sum_users (user_id) VALUES (?);",
+                               [(int(user_id),) for user_id in user_ids])
+            cursor.execute(f"DELETE FROM user_daily_prefix_sums {user_filter};")
+        cursor.execute(f"""
+            INSERT INTO user_daily_prefix_sums (user_id, transaction_type, transaction_date, cumulative_total)
+            SELECT
+                user_id,
+                transaction_type,
+                transaction_date,
+                SUM(daily_total) OVER (
+                    PARTITION BY user_id, transaction_type ORDER BY transaction_date
+                )
+            FROM (
+                SELECT user_id, transaction_type, transaction_date, SUM(amount) AS daily_total
+                FROM transactions
+                {user_filter}
+                GROUP BY user_id, transaction_type, transaction_date
+                UNION ALL
+                SELECT user_id, '{ALL_TYPES}', transaction_date, SUM(amount)
+                FROM transactions
+                {user_filter}
+                GROUP BY user_id, transaction_date
+            );
+        """)
+        conn.commit()
+    except sqlite3.Error as e:
+        conn.rollback()
+        logs.log_error(f'Prefix sums could not be loaded into SQLite Database. Error: {e}')
+        raise
+    finally:
+        conn.close()
+    logs.log_event(f'Prefix sum tables rebuilt from {len(daily_aggregates)} daily aggregates.')
+
+def rolling_window_totals(start_date, end_date, window, transaction_type=ALL_TYPES, user_id=None, db_path=None):
+    """
+    Computes the total of the `window` days ending on each day from start_date to end_date.
+    :param start_date: First day of the series as a datetime.date.
+    :param end_date: Last day of the series as a datetime.date.
+    :param window: Window length in days.
+    :param transaction_type: Transaction type, or 'all'.
+    :param user_id: Optional user ID. Global totals are returned if None.
+    :param db_path: Database path. Defaults to utility_library.DATABASE_PATH.
+    :return: List of window totals, one per day.
+    """
+    def window_start(day):
+        # The day before the window, clamped to '' (before every date) where the window reaches back past date.min.
+        return (day - timedelta(days=window)).isoformat() if (day - date.min).days >= window else ''
+
+    lower = window_start(start_date)
+    upper = end_date.isoformat()
+    if user_id is None:
+        table, key_filter, key_params = 'daily_prefix_sums', 'transaction_type = ?', (transaction_type,)
+    else:
+        table, key_filter = 'user_daily_prefix_sums', 'user_id = ? AND transaction_type = ?'
+        key_params = (user_id, transaction_type)
+
+    # The running total before the range, plus every row in the range, in one index range read.
+    rows = utility_library.query_db_for_api(f"""
+        SELECT transaction_date, cumulative_total FROM (
+            SELECT transaction_date, cumulative_total FROM {table}
+            WHERE {key_filter} AND transaction_date < ?
+            ORDER BY transaction_date DESC
+            LIMIT 1
+        )
+        UNION ALL
+        SELECT transaction_date, cumulative_total FROM {table}
+        WHERE {key_filter} AND transaction_date BETWEEN ? AND ?
+        ORDER BY transaction_date;
+    """, key_params + (lower,) + key_params + (lower, upper), db_path=db_path)
+    dates = [row['transaction_date'] for row in rows]
+    totals = [row['cumulative_total'] for row in rows]
+
+    def prefix(day):
+        index = bisect_right(dates, day)
+        return totals[index - 1] if index else 0.0
+
+    series = []
+    day = start_date
+    while day <= end_date:
+        series.append(prefix(day.isoformat()) - prefix(window_start(day)))
+        day += timedelta(days=1)
+    return series
+
+def parse_date(value):
+    """
+    Parses a YYYY-MM-DD date.
+    :param value: Date string.
+    :return: datetime.date, or None if the value is not a valid date.
+    """
+    try:
+        return date.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,220 @@
+"""
+Stage-level profiling for ingestion, ETL, and queries.
+
+Stage functions are wrapped with the profile_stage() decorator, or a block of code is wrapped with it as a context
+manager. Each stage run records:
+    - Wall time and CPU time.
+    - Rows processed and rows per second.
+    - Peak memory: the Python allocation peak of the stage when tracemalloc is enabled, including the peaks of nested
+      stages, and the process high-water mark RSS at the end of the stage. The RSS figure is the peak of the whole
+      process so far, not of the stage.
+Optionally, a cProfile dump is written per stage run. Runs are aggregated per stage and can be written as a JSON run
+summary with write_run_summary().
+"""
+
+import cProfile
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import deque
+from datetime import datetime
+
+import logs
+import settings
+
+try:
+    import resource
+except ImportError:  # The resource module is only available on Unix. psutil is used instead.
+    resource = None
+
+_lock = threading.Lock()
+_local = threading.local()
+_stage_totals = {}
+_recent_runs = deque(maxlen=settings.PROFILE_MAX_RECORDS)
+_cprofile_active = False
+
+
+def peak_rss_mb():
+    """Returns the peak resident memory of the process in MB, or the current RSS if the peak is unavailable."""
+    if resource is not None:
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is reported in kilobytes on Linux and in bytes on macOS.
+        return max_rss / (1024 * 1024) if sys.platform == 'darwin' else max_rss / 1024
+    import psutil
+
+    return psutil.Process().memory_info().rss / (1024 * 1024)
+
+def record_rows(count):
+    """
+    Records the number of rows processed by the innermost active stage in the current thread.
+    :param count: Number of rows.
+    :return: None
+    """
+    stack = getattr(_local, 'stack', None)
+    if stack:
+        stack[-1].rows = count
+
+
+class StageProfiler:
+    """
+    Context manager and decorator that profiles a single stage. Use profile_stage() to create one.
+    """
+
+    def __init__(self, name=None):
+        self.name = name
+        self.rows = None
+
+    def __call__(self, func):
+        name = self.name or f'{func.__module__}.{func.__name__}'
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with StageProfiler(name) as stage:
+                result = func(*args, **kwargs)
+                if stage.rows is None and hasattr(result, 'shape'):
+                    stage.rows = result.shape[0]
+                return result
+
+        return wrapper
+
+    def __enter__(self):
+        global _cprofile_active
+        if not settings.ENABLE_PROFILING:
+            return self
+
+        if not hasattr(_local, 'stack'):
+            _local.stack = []
+        _local.stack.append(self)
+
+        self._tracemalloc_started = False
+        self._peak_traced = 0
+        if settings.PROFILE_TRACEMALLOC:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._tracemalloc_started = True
+            elif len(_local.stack) > 1:
+                # Resetting the peak below would lose the outer stage's peak so far, so it is kept on the outer stage.
+                outer = _local.stack[-2]
+                outer._peak_traced = max(outer._peak_traced, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+
+        self._profiler = None
+        if settings.PROFILE_CPROFILE:
+            with _lock:
+                # Only one profiler can be active at a time, so nested and concurrent stages are not profiled.
+                if not _cprofile_active:
+                    _cprofile_active = True
+                    self._profiler = cProfile.Profile()
+            if self._profiler is not None:
+                self._profiler.enable()
+
+        self._started_at = datetime.now().isoformat(timespec='seconds')
+        self._start_wall = time.perf_counter()
+        self._start_cpu = time.thread_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global _cprofile_active
+        if not settings.ENABLE_PROFILING:
+            return False
+
+        wall_seconds = time.perf_counter() - self._start_wall
+        cpu_seconds = time.thread_time() - self._start_cpu
+        _local.stack.pop()
+
+        if self._profiler is not None:
+            self._profiler.disable()
+            os.makedirs(settings.PROFILE_OUTPUT_DIR, exist_ok=True)
+            timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S-%f')
+            self._profiler.dump_stats(os.path.join(settings.PROFILE_OUTPUT_DIR, f'{self.name}_{timestamp}.prof'))
+            with _lock:
+                _cprofile_active = False
+
+        peak_traced_mb = None
+        if settings.PROFILE_TRACEMALLOC and tracemalloc.is_tracing():
+            peak_traced = max(self._peak_traced, tracemalloc.get_traced_memory()[1])
+            peak_traced_mb = peak_traced / (1024 * 1024)
+            if _local.stack:
+                outer = _local.stack[-1]
+                outer._peak_traced = max(outer._peak_traced, peak_traced)
+            if self._tracemalloc_started:
+                tracemalloc.stop()
+
+        run = {
+            'stage': self.name,
+            'started_at': self._started_at,
+            'wall_seconds': wall_seconds,
+            'cpu_seconds': cpu_seconds,
+            'rows': self.rows,
+            'rows_per_second': self.rows / wall_seconds if self.rows is not None and wall_seconds > 0 else None,
+            'peak_traced_mb': peak_traced_mb,
+            'process_peak_rss_mb': peak_rss_mb(),
+            'failed': exc_type is not None,
+        }
+        with _lock:
+            _recent_runs.append(run)
+            totals = _stage_totals.setdefault(self.name, {
+                'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'rows': 0, 'peak_traced_mb': None,
+                'failures': 0,
+            })
+            totals['calls'] += 1
+            totals['wall_seconds'] += wall_seconds
+            totals['cpu_seconds'] += cpu_seconds
+            totals['rows'] += self.rows or 0
+            totals['failures'] += int(exc_type is not None)
+            if peak_traced_mb is not None:
+                totals['peak_traced_mb'] = max(totals['peak_traced_mb'] or 0.0, peak_traced_mb)
+        return False
+
+
+def profile_stage(name=None):
+    """
+    Creates a stage profiler. Usable as a decorator, where the stage name defaults to module.function, or as a context
+    manager around a block of code.
+    :param name: Stage name.
+    :return: StageProfiler
+    """
+    return StageProfiler(name)
+
+def get_run_summary():
+    """
+    Returns the aggregated stage statistics and the most recent stage runs.
+    :return: Dictionary
+    """
+    with _lock:
+        stages = {}
+        for name, totals in _stage_totals.items():
+            stages[name] = dict(totals)
+            stages[name]['rows_per_second'] = (totals['rows'] / totals['wall_seconds']
+                                               if totals['rows'] and totals['wall_seconds'] > 0 else None)
+        return {
+            'generated_at': datetime.now().isoformat(timespec='seconds'),
+            'process_peak_rss_mb': peak_rss_mb(),
+            'stages': stages,
+            'runs': list(_recent_runs),
+        }
+
+def write_run_summary(path):
+    """
+    Writes the run summary as JSON.
+    :param path: Output file path.
+    :return: The run summary dictionary.
+    """
+    summary = get_run_summary()
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'w') as summary_file:
+        json.dump(summary, summary_file, indent=2)
+    logs.log_event(f'Profiling run summary written to {path}.')
+    return summary
+
+def reset():
+    """Clears all recorded stage statistics."""
+    with _lock:
+        _stage_totals.clear()
+        _recent_runs.clear()
@@ -0,0 +1,274 @@
+"""
+Per-user anomaly scores for fraud review.
+
+Two signals are scored for every user with transactions:
+    - amount_z_score: z-score of the user's latest daily amount (the sum of the day's transactions) against the user's
+      other days. Users are scored once they have RISK_MIN_HISTORY_DAYS other days.
+    - withdrawal_burst: Number of withdrawals in the RISK_BURST_WINDOW_DAYS days ending on the user's latest day, so a
+      burst stops counting once the user has later activity.
+The risk score is max(amount_z_score / RISK_Z_SCORE_THRESHOLD, withdrawal_burst / RISK_BURST_THRESHOLD), so users with
+a risk score of 1 or more cross at least one threshold.
+
+The user_risk_days table holds the daily amount and withdrawal count of every user and day as last scored, and the
+user_risk table holds the count, mean, and sum of squared deviations (M2) of each user's daily amounts next to the
+scores. An update compares the current daily totals of the affected users and days with user_risk_days and folds only
+the days that changed into the accumulators, with the parallel form of Welford's algorithm: a changed day is removed
+with its old amount and added with its new one. The z-score is then derived from the accumulators and the latest day,
+and the burst from the few days of the window, so a user's update reads a bounded number of rows however long the
+user's history is. user_risk_days keeps the previous totals a changed day is removed with. The first run starts from
+empty accumulators, so the full build is the same update over every user and day.
+"""
+
+import sqlite3
+
+import numpy as np
+
+import logs
+import profiling
+import settings
+import utility_library
+
+MIN_STD = 1.0  # Floor of the standard deviation, so users with near-constant daily amounts don't get huge z-scores.
+
+
+def create_risk_tables(cursor):
+    """
+    Creates the risk scoring tables if they don't already exist.
+    :param cursor: SQLite cursor used to create the tables.
+    :return: None
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS user_risk_days (
+            user_id INTEGER,
+            transaction_date TEXT,
+            daily_amount REAL,
+            withdrawal_count INTEGER,
+            PRIMARY KEY (user_id, transaction_date)
+        );
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS user_risk (
+            user_id INTEGER PRIMARY KEY,
+            day_count INTEGER,
+            mean_daily_amount REAL,
+            m2_daily_amount REAL,
+            latest_date TEXT,
+            latest_daily_amount REAL,
+            amount_z_score REAL,
+            withdrawal_burst INTEGER,
+            risk_score REAL
+        );
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_risk_score ON user_risk (risk_score);")
+
+def grouped_moments(user_ids, values, users):
+    """
+    Computes the count, mean, and M2 of the values of each user.
+    :param user_ids: numpy array with the user of each value.
+    :param values: numpy array of values.
+    :param users: Sorted numpy array of unique users, containing every user in user_ids.
+    :return: Tuple of numpy arrays (count, mean, M2) aligned with users.
+    """
+    index = np.searchsorted(users, user_ids)
+    count = np.bincount(index, minlength=len(users)).astype(float)
+    mean = np.divide(np.bincount(index, weights=values, minlength=len(users)), count, out=np.zeros(len(users)),
+                     where=count > 0)
+    m2 = np.bincount(index, weights=(values - mean[index]) ** 2, minlength=len(users))
+    return count, mean, m2
+
+def add_moments(count, mean, m2, batch_count, batch_mean, batch_m2):
+    """
+    Merges the moments of a batch of values into the accumulators (Chan et al.'s parallel Welford update).
+    :return: Tuple of numpy arrays (count, mean, M2)
+    """
+    total = count + batch_count
+    delta = batch_mean - mean
+    new_mean = mean + np.divide(delta * batch_count, total, out=np.zeros_like(mean), where=total > 0)
+    new_m2 = m2 + batch_m2 + np.divide(delta ** 2 * count * batch_count, total, out=np.zeros_like(mean),
+                                       where=total > 0)
+    return total, new_mean, new_m2
+
+def remove_moments(count, mean, m2, batch_count, batch_mean, batch_m2):
+    """
+    Removes the moments of a batch of values previously added to the accumulators. Inverse of add_moments().
+    :return: Tuple of numpy arrays (count, mean, M2)
+    """
+    remaining = count - batch_count
+    new_mean = np.divide(count * mean - batch_count * batch_mean, remaining, out=np.zeros_like(mean),
+                         where=remaining > 0)
+    new_m2 = m2 - batch_m2 - np.divide((batch_mean - new_mean) ** 2 * remaining * batch_count, count,
+                                       out=np.zeros_like(mean), where=count > 0)
+    return remaining, new_mean, np.where(remaining > 0, np.maximum(new_m2, 0.0), 0.0)
+
+def leave_one_out_z_scores(count, mean, m2, values):
+    """
+    Computes the z-score of one value of each user against the user's other values, by removing the value from the
+    accumulators.
+    :param count: numpy array of value counts, including the scored value.
+    :param mean: numpy array of means.
+    :param m2: numpy array of sums of squared deviations.
+    :param values: numpy array with the scored value of each user.
+    :return: numpy array of z-scores, 0 for users with fewer than RISK_MIN_HISTORY_DAYS other values.
+    """
+    history_count, history_mean, history_m2 = remove_moments(count, mean, m2, np.ones_like(count), values,
+                                                             np.zeros_like(count))
+    variance = np.divide(history_m2, history_count - 1, out=np.zeros_like(mean), where=history_count > 1)
+    z_scores = (values - history_mean) / np.maximum(np.sqrt(variance), MIN_STD)
+    return np.where(history_count >= max(settings.RISK_MIN_HISTORY_DAYS, 2), z_scores, 0.0)
+
+@profiling.profile_stage()
+def update_user_risk(user_ids=None, transaction_dates=None, db_path=None):
+    """
+    Updates the risk scores of the users whose daily totals changed since the last update. Without user IDs, every
+    user and day is compared, which builds the scores from scratch on the first run.
+    :param user_ids: Optional IDs of the users affected by a batch.
+    :param transaction_dates: Optional dates affected by a batch, required with user_ids. Only the days of the
+    affected users on these dates are compared.
+    :param db_path: Database path. Defaults to utility_library.DATABASE_PATH.
+    :return: Number of users whose scores were updated.
+    """
+    conn = sqlite3.connect(db_path or utility_library.DATABASE_PATH)
+    cursor = conn.cursor()
+    try:
+        create_risk_tables(cursor)
+        scope = ''
+        if user_ids is not None:
+            cursor.execute("CREATE TEMP TABLE IF NOT EXISTS risk_scope_users (user_id INTEGER PRIMARY KEY);")
+            cursor.execute("CREATE TEMP TABLE IF NOT EXISTS risk_scope_dates (transaction_date TEXT PRIMARY KEY);")
+            cursor.execute("DELETE FROM risk_scope_users;")
+            cursor.execute("DELETE FROM risk_scope_dates;")
+            cursor.executemany("INSERT OR IGNORE INTO risk_scope_users (user_id) VALUES (?);",
+                               [(int(user_id),) for user_id in user_ids])
+            cursor.executemany("INSERT OR IGNORE INTO risk_scope_dates (transaction_date) VALUES (?);",
+                               [(str(transaction_date),) for transaction_date in transaction_dates or ()])
+            scope = ('WHERE user_id IN (SELECT user_id FROM risk_scope_users) '
+                     'AND transaction_date IN (SELECT transaction_date FROM risk_scope_dates)')
+
+        cursor.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS risk_current_days (
+                user_id INTEGER,
+                transaction_date TEXT,
+                daily_amount REAL,
+                withdrawal_count INTEGER,
+                PRIMARY KEY (user_id, transaction_date)
+            );
+        """)
+        cursor.execute("DELETE FROM risk_current_days;")
+        cursor.execute(f"""
+            INSERT INTO risk_current_days (user_id, transaction_date, daily_amount, withdrawal_count)
+            SELECT user_id, transaction_date, SUM(amount), SUM(transaction_type = 'withdrawal')
+            FROM transactions
+            {scope}
+            GROUP BY user_id, transaction_date;
+        """)
+
+        # Days whose stored amount is replaced or dropped, and days whose current amount is new or replaces one.
+        removed = cursor.execute(f"""
+            SELECT d.user_id, d.daily_amount
+            FROM (SELECT * FROM user_risk_days {scope}) d
+            LEFT JOIN risk_current_days c ON c.user_id = d.user_id AND c.transaction_date = d.transaction_date
+            WHERE c.user_id IS NULL OR c.daily_amount != d.daily_amount OR c.withdrawal_count != d.withdrawal_count;
+        """).fetchall()
+        added = cursor.execute("""
+            SELECT c.user_id, c.daily_amount
+            FROM risk_current_days c
+            LEFT JOIN user_risk_days d ON d.user_id = c.user_id AND d.transaction_date = c.transaction_date
+            WHERE d.user_id IS NULL OR c.daily_amount != d.daily_amount OR c.withdrawal_count != d.withdrawal_count;
+        """).fetchall()
+        removed = np.array(removed, dtype=float).reshape(-1, 2)
+        added = np.array(added, dtype=float).reshape(-1, 2)
+        users = np.unique(np.concatenate((removed[:, 0], added[:, 0]))).astype(np.int64)
+
+        cursor.execute(f"DELETE FROM user_risk_days {scope};")
+        cursor.execute("INSERT INTO user_risk_days SELECT * FROM risk_current_days;")
+        if len(users):
+            scored_users = score_users(cursor, users, removed, added)
+            logs.log_event(f'Risk scores updated for {len(users)} users from {len(removed)} removed and '
+                           f'{len(added)} added days. {scored_users} users have risk scores.')
+        conn.commit()
+    except sqlite3.Error as e:
+        conn.rollback()
+        logs.log_error(f'Risk scores could not be loaded into SQLite Database. Error: {e}')
+        raise
+    finally:
+        conn.close()
+    profiling.record_rows(len(removed) + len(added))
+    return len(users)
+
+def score_users(cursor, users, removed, added):
+    """
+    Folds the changed days into the accumulators of the users and rewrites their user_risk rows. Only the latest day and
+    the burst window of each user are read back.
+    :param cursor: SQLite cursor, with user_risk_days already holding the current days.
+    :param users: Sorted numpy array of the users with changed days.
+    :param removed: numpy array of (user_id, daily_amount) rows removed from the accumulators.
+    :param added: numpy array of (user_id, daily_amount) rows added to the accumulators.
+    :return: Number of users with days left, whose rows were written.
+    """
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS risk_changed_users (user_id INTEGER PRIMARY KEY);")
+    cursor.execute("DELETE FROM risk_changed_users;")
+    cursor.executemany("INSERT INTO risk_changed_users (user_id) VALUES (?);", [(int(user),) for user in users])
+
+    count, mean, m2 = np.zeros(len(users)), np.zeros(len(users)), np.zeros(len(users))
+    stored = cursor.execute("""
+        SELECT user_id, day_count, mean_daily_amount, m2_daily_amount FROM user_risk
+        WHERE user_id IN (SELECT user_id FROM risk_changed_users);
+    """).fetchall()
+    if stored:
+        stored = np.array(stored, dtype=float)
+        index = np.searchsorted(users, stored[:, 0].astype(np.int64))
+        count[index], mean[index], m2[index] = stored[:, 1], stored[:, 2], stored[:, 3]
+    count, mean, m2 = remove_moments(count, mean, m2, *grouped_moments(removed[:, 0], removed[:, 1], users))
+    count, mean, m2 = add_moments(count, mean, m2, *grouped_moments(added[:, 0], added[:, 1], users))
+
+    # Only the latest day and the burst window ending on it are read for each user, through the primary key index.
+    latest_days = cursor.execute("""
+        SELECT
+            l.user_id,
+            l.latest_date,
+            d.daily_amount,
+            (SELECT COALESCE(SUM(w.withdrawal_count), 0) FROM user_risk_days w
+             WHERE w.user_id = l.user_id AND w.transaction_date BETWEEN date(l.latest_date, ?) AND l.latest_date)
+        FROM (
+            SELECT c.user_id, (SELECT MAX(transaction_date) FROM user_risk_days m WHERE m.user_id = c.user_id)
+                AS latest_date
+            FROM risk_changed_users c
+        ) l
+        JOIN user_risk_days d ON d.user_id = l.user_id AND d.transaction_date = l.latest_date
+        ORDER BY l.user_id;
+    """, (f'-{settings.RISK_BURST_WINDOW_DAYS - 1} days',)).fetchall()
+    cursor.execute("DELETE FROM user_risk WHERE user_id IN (SELECT user_id FROM risk_changed_users);")
+    if not latest_days:
+        return 0
+
+    scored = np.array([row[0] for row in latest_days], dtype=np.int64)
+    latest_dates = [row[1] for row in latest_days]
+    latest_amounts = np.array([row[2] for row in latest_days], dtype=float)
+    bursts = np.array([row[3] for row in latest_days], dtype=np.int64)
+    accumulator = np.searchsorted(users, scored)
+
+    z_scores = leave_one_out_z_scores(count[accumulator], mean[accumulator], m2[accumulator], latest_amounts)
+    risk_scores = np.maximum(z_scores / settings.RISK_Z_SCORE_THRESHOLD, bursts / settings.RISK_BURST_THRESHOLD)
+
+    cursor.executemany("""
+        INSERT INTO user_risk (user_id, day_count, mean_daily_amount, m2_daily_amount, latest_date, latest_daily_amount,
+                               amount_z_score, withdrawal_burst, risk_score)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);
+    """, zip(scored.tolist(), count[accumulator].astype(int).tolist(), mean[accumulator].tolist(),
+             m2[accumulator].tolist(), latest_dates, latest_amounts.tolist(), z_scores.tolist(), bursts.tolist(),
+             risk_scores.tolist()))
+    return len(scored)
+
+def top_anomalies(k):
+    """
+    Returns the users with the highest risk scores, across every shard.
+    :param k: Number of users.
+    :return: List of dictionaries, ordered by risk score.
+    """
+    query = """
+        SELECT user_id, risk_score, amount_z_score, latest_date, latest_daily_amount, withdrawal_burst
+        FROM user_risk
+        ORDER BY risk_score DESC
+        LIMIT ?;
+    """
+    return utility_library.merge_top_rows(utility_library.scatter_gather(query, (k,)), 'risk_score', k)
@@ -0,0 +1,206 @@
+"""
+Multi-dimensional rollup cube of transaction totals by country, signup cohort, transaction type, and day.
+
+The ETL writes the transaction_rollup_cube table with one row per combination of the four cube dimensions:
+    - country: Country of the user.
+    - signup_month: Signup cohort of the user, as YYYY-MM.
+    - transaction_type: deposit, withdrawal, or purchase.
+    - transaction_date: Day of the transactions, as YYYY-MM-DD.
+Each row holds the sum and count of the matching transactions. Sums and counts are additive, so a rollup over any subset
+of the dimensions is a GROUP BY over the cube rows, without scanning the transactions table. Averages are derived from
+the rolled up sums and counts.
+"""
+
+import sqlite3
+
+import logs
+import profiling
+import utility_library
+
+CUBE_TABLE = 'transaction_rollup_cube'
+CUBE_DIMENSIONS = ('country', 'signup_month', 'transaction_type', 'transaction_date')
+CUBE_MEASURES = ('total_amount', 'transaction_count')
+
+
+def create_rollup_cube_table(cursor):
+    """
+    Creates the rollup cube table if it doesn't already exist.
+    :param cursor: SQLite cursor used to create the table.
+    :return: None
+    """
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {CUBE_TABLE} (
+            country TEXT,
+            signup_month TEXT,
+            transaction_type TEXT,
+            transaction_date TEXT,
+            total_amount REAL,
+            transaction_count INTEGER,
+            PRIMARY KEY (country, signup_month, transaction_type, transaction_date)
+        );
+    """)
+    cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{CUBE_TABLE}_date ON {CUBE_TABLE} (transaction_date);')
+
+def insert_cube_rows(cursor, date_filter=''):
+    """
+    Aggregates the transactions joined with their users into cube rows.
+    :param cursor: SQLite cursor.
+    :param date_filter: Optional WHERE clause restricting the transactions.
+    :return: None
+    """
+    cursor.execute(f"""
+        INSERT INTO {CUBE_TABLE} (country, signup_month, transaction_type, transaction_date, total_amount,
+                                  transaction_count)
+        SELECT
+            u.country,
+            substr(u.signup_date, 1, 7),
+            t.transaction_type,
+            t.transaction_date,
+            SUM(t.amount),
+            COUNT(*)
+        FROM
+            transactions t
+        JOIN
+            users u ON t.user_id = u.user_id
+        {date_filter}
+        GROUP BY
+            u.country, substr(u.signup_date, 1, 7), t.transaction_type, t.transaction_date;
+    """)
+
+@profiling.profile_stage()
+def build_rollup_cube(db_path=None):
+    """
+    Replaces the contents of the rollup cube with the aggregates of every transaction, in a single transaction.
+    :param db_path: Database path. Defaults to utility_library.DATABASE_PATH.
+    :return: None
+    """
+    conn = sqlite3.connect(db_path or utility_library.DATABASE_PATH)
+    cursor = conn.cursor()
+    try:
+        create_rollup_cube_table(cursor)
+        cursor.execute(f"DELETE FROM {CUBE_TABLE};")
+        insert_cube_rows(cursor)
+        cube_rows = cursor.execute(f"SELECT COUNT(*) FROM {CUBE_TABLE};").fetchone()[0]
+        conn.commit()
+    except sqlite3.Error as e:
+        conn.rollback()
+        logs.log_error(f'Rollup cube could not be loaded into SQLite Database. Error: {e}')
+        raise
+    finally:
+        conn.close()
+    profiling.record_rows(cube_rows)
+    logs.log_event(f'Rollup cube rebuilt with {cube_rows} rows.')
+
+@profiling.profile_stage()
+def update_rollup_cube(user_ids, transaction_dates, db_path=None):
+    """
+    Recomputes the cube rows of the days affected by a micro-batch. A user update can move the user's transactions to
+    another country or cohort, so the days the updated users had transactions on are recomputed as well.
+    :param user_ids: IDs of the users inserted or updated by the batch.
+    :param transaction_dates: Dates of the transactions inserted or replaced by the batch, including the previous dates
+    of replaced transactions.
+    :param db_path: Database path. Defaults to utility_library.DATABASE_PATH.
+    :return: None
+    """
+    conn = sqlite3.connect(db_path or utility_library.DATABASE_PATH)
+    cursor = conn.cursor()
+    try:
+        create_rollup_cube_table(cursor)
+        cursor.execute("CREATE TEMP TABLE IF NOT EXISTS rollup_cube_dates (transaction_date TEXT PRIMARY KEY);")
+        cursor.execute("DELETE FROM rollup_cube_dates;")
+        cursor.executemany("INSERT OR IGNORE INTO rollup_cube_dates (transaction_date) VALUES (?);",
+                           [(str(transaction_date),) for transaction_date in transaction_dates])
+        if user_ids:
+            cursor.execute("CREATE TEMP TABLE IF NOT EXISTS rollup_cube_users (user_id INTEGER PRIMARY KEY);")
+            cursor.execute("DELETE FROM rollup_cube_users;")
+            cursor.executemany("INSERT OR IGNORE INTO rollup_cube_users (user_id) VALUES (?);",
+                               [(int(user_id),) for user_id in user_ids])
+            cursor.execute("""
+                INSERT OR IGNORE INTO rollup_cube_dates (transaction_date)
+                SELECT DISTINCT transaction_date FROM transactions
+                WHERE user_id IN (SELECT user_id FROM rollup_cube_users);
+            """)
+        date_filter = 'WHERE t.transaction_date IN (SELECT transaction_date FROM rollup_cube_dates)'
+        cursor.execute(f"DELETE FROM {CUBE_TABLE} WHERE transaction_date IN "
+                       f"(SELECT transaction_date FROM rollup_cube_dates);")
+        insert_cube_rows(cursor, date_filter)
+        day_count = cursor.execute("SELECT COUNT(*) FROM rollup_cube_dates;").fetchone()[0]
+        conn.commit()
+    except sqlite3.Error as e:
+        conn.rollback()
+        logs.log_error(f'Rollup cube could not be updated in SQLite Database. Error: {e}')
+        raise
+    finally:
+        conn.close()
+    logs.log_event(f'Rollup cube updated for {day_count} days.')
+
+def parse_dimensions(value):
+    """
+    Parses a comma-separated list of cube dimensions.
+    :param value: Comma-separated dimension names, or None for a grand total.
+    :return: Tuple of dimension names in the requested order, or None if any name is not a cube dimension.
+    """
+    dimensions = []
+    for name in (value or '').split(','):
+        name = name.strip()
+        if not name or name in dimensions:
+            continue
+        if name not in CUBE_DIMENSIONS:
+            return None
+        dimensions.append(name)
+    return tuple(dimensions)
+
+def rollup_query(dimensions, filters=None, start_date=None, end_date=None):
+    """
+    Builds the query that rolls the cube up to a subset of its dimensions. Dimension names are checked against
+    CUBE_DIMENSIONS, so only values are passed as parameters.
+    :param dimensions: Dimensions to group by, as returned by parse_dimensions().
+    :param filters: Optional dictionary of dimension name to the value the rows must match.
+    :param start_date: Optional first day (YYYY-MM-DD) of the rolled up transactions.
+    :param end_date: Optional last day (YYYY-MM-DD) of the rolled up transactions.
+    :return: Tuple of the SQL query string and its parameters.
+    """
+    for name in list(dimensions) + list(filters or {}):
+        if name not in CUBE_DIMENSIONS:
+            raise ValueError(f'Invalid cube dimension: {name}. Expected one of {", ".join(CUBE_DIMENSIONS)}.')
+
+    conditions, params = [], []
+    for name, value in (filters or {}).items():
+        conditions.append(f'{name} = ?')
+        params.append(value)
+    if start_date is not None:
+        conditions.append('transaction_date >= ?')
+        params.append(start_date)
+    if end_date is not None:
+        conditions.append('transaction_date <= ?')
+        params.append(end_date)
+
+    select_columns = ''.join(f'{name}, ' for name in dimensions)
+    where_clause = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+    group_clause = f'GROUP BY {", ".join(dimensions)} ORDER BY {", ".join(dimensions)}' if dimensions else ''
+    query = f"""
+        SELECT
+            {select_columns}COALESCE(SUM(total_amount), 0.0) AS total_amount,
+            COALESCE(SUM(transaction_count), 0) AS transaction_count
+        FROM {CUBE_TABLE}
+        {where_clause}
+        {group_clause};
+    """
+    return query, tuple(params)
+
+def rollup(dimensions, filters=None, start_date=None, end_date=None):
+    """
+    Rolls the cube up to a subset of its dimensions on every shard, and merges the results.
+    :param dimensions: Dimensions to group by, as returned by parse_dimensions().
+    :param filters: Optional dictionary of dimension name to the value the rows must match.
+    :param start_date: Optional first day (YYYY-MM-DD) of the rolled up transactions.
+    :param end_date: Optional last day (YYYY-MM-DD) of the rolled up transactions.
+    :return: List of dictionaries with the dimensions, total_amount, transaction_count, and average_amount, sorted by
+    the dimensions. Empty if no transactions match.
+    """
+    query, params = rollup_query(dimensions, filters, start_date, end_date)
+    rows = utility_library.merge_summed_rows(utility_library.scatter_gather(query, params), dimensions, CUBE_MEASURES)
+    rows = [row for row in rows if row['transaction_count']]
+    for row in rows:
+        row['average_amount'] = row['total_amount'] / row['transaction_count']
+    return rows
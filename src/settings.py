@@ -13,4 +13,117 @@ DISPLAY_ETL_PROCESSES_TO_CONSOLE = False
 
 # Use delete table functionality to manually testing application.
 DELETE_USER_TABLE = False
-DELETE_TRANSACTION_TABLE = False
\ No newline at end of file
+DELETE_TRANSACTION_TABLE = False
+
+# ETL Options
+# The fused ETL scan computes every ETL aggregate in a single pass over the transactions table and writes the results to
+# their destination tables in one database transaction. Set to False to run the individual ETL tasks one after another.
+USE_FUSED_ETL_SCAN = True
+ETL_FETCH_SIZE = 50000  # Rows fetched from the cursor per batch during the fused scan.
+
+# Analytic Snapshot Options
+# At the end of the fused ETL, the results are written to a memory-mapped snapshot file that API workers query instead
+# of the SQLite Database.
+WRITE_ANALYTIC_SNAPSHOT = True
+SERVE_FROM_ANALYTIC_SNAPSHOT = True
+ANALYTIC_SNAPSHOT_PATH = "analytic_snapshot.bin"
+
+
+# API Streaming Options
+# Data endpoints stream their results as JSON chunks, or as newline-delimited JSON with the `format=ndjson` parameter.
+STREAM_FETCH_SIZE = 1000  # Rows fetched from the cursor per batch.
+STREAM_CHUNK_ROWS = 500  # Rows serialized into each chunk of the response body.
+
+# API Caching and Compression Options
+# Data endpoints return a weak ETag derived from the data version recorded by ingestion and ETL, and answer matching
+# If-None-Match requests with 304 Not Modified. Responses of at least COMPRESSION_MIN_SIZE bytes are compressed with
+# brotli (if installed) or gzip when the client accepts it.
+ENABLE_ETAGS = True
+DATA_VERSION_CACHE_SECONDS = 2  # How long the API reuses the data version before reading it from the database again.
+ENABLE_COMPRESSION = True
+COMPRESSION_MIN_SIZE = 1024
+COMPRESSION_LEVEL = 6
+
+# Profiling Options
+# Stage functions in ingestion, ETL, and the query utilities record wall time, CPU time, rows processed, and peak
+# memory. A JSON run summary is written to PROFILE_SUMMARY_PATH after the pipeline runs.
+ENABLE_PROFILING = True
+PROFILE_TRACEMALLOC = False  # Track the Python allocation peak of each stage. Slows down allocation-heavy stages.
+PROFILE_CPROFILE = False  # Write a cProfile dump per stage run to PROFILE_OUTPUT_DIR.
+PROFILE_OUTPUT_DIR = "profiles"
+PROFILE_SUMMARY_PATH = "profiles/run_summary.json"
+PROFILE_MAX_RECORDS = 1000  # Number of individual stage runs kept in memory for the run summary.
+
+# Query Monitoring Options
+# Every query run through utility_library records its duration, row count, and normalized fingerprint. Queries slower
+# than SLOW_QUERY_THRESHOLD_MS are logged as warnings together with their EXPLAIN QUERY PLAN output.
+ENABLE_QUERY_STATS = True
+LOG_QUERIES = True
+SLOW_QUERY_THRESHOLD_MS = 100
+
+# Pipeline Scheduler Options
+# Ingestion and ETL stages run as a dependency DAG. Independent read-only stages run concurrently on separate
+# connections, database writers run one at a time, and stages whose inputs did not change since their last run are
+# skipped.
+ENABLE_WAL_MODE = True
+PARALLEL_PIPELINE = True
+PIPELINE_MAX_WORKERS = 3
+SKIP_UNCHANGED_STAGES = True
+
+# Ingestion Daemon Options
+# When enabled, CSV files dropped into INGEST_SPOOL_DIR are ingested as micro-batches every INGEST_POLL_SECONDS while
+# the API keeps serving, and the ETL outputs are updated incrementally.
+RUN_INGEST_DAEMON = False
+INGEST_SPOOL_DIR = "raw_data/spool"
+INGEST_POLL_SECONDS = 30
+
+# Background Refresh Options
+# When enabled, the API starts immediately against the last good database and snapshot, and ingestion and the ETL run in
+# a separate process against a copy of the database. The result is swapped into the live database when it is complete.
+BACKGROUND_REFRESH = False
+REFRESH_BUILD_SUFFIX = ".building"  # Suffix of the database and snapshot files the refresh builds into.
+
+# Sharded Storage Options
+# Users and transactions are partitioned by user_id into SHARD_COUNT database files next to DB_PATH. The ETL runs on
+# every shard in parallel, and queries are routed to a user's shard or merged across shards. 1 disables sharding.
+SHARD_COUNT = 1
+
+# Transaction Partition Options
+# When enabled, transactions are stored in one table per month behind a `transactions` view, so old months can be
+# dropped instantly.
+PARTITION_TRANSACTIONS_BY_MONTH = False
+
+# Approximate Analytics Options
+# When enabled, ingestion maintains streaming sketches of top users, active users per day, and amount percentiles, and
+# the /api/approx endpoints answer from them in constant time and memory.
+ENABLE_APPROXIMATE_ANALYTICS = False
+SKETCH_TOP_USERS_CAPACITY = 1000  # Number of users tracked by the space-saving top users sketch.
+SKETCH_HLL_PRECISION = 12  # HyperLogLog index bits. 2 ** precision registers, about 1.6% error at 12.
+SKETCH_TDIGEST_COMPRESSION = 100  # Approximate number of centroids kept per t-digest.
+
+# Rolling Window Options
+# The ETL maintains cumulative daily totals, globally and per user, so /api/rolling_totals answers each window total as
+# the difference of two prefix values.
+BUILD_PREFIX_SUMS = True
+MAX_ROLLING_POINTS = 3660  # Maximum number of days in one /api/rolling_totals series and in its window.
+
+# Rollup Cube Options
+# The ETL precomputes transaction totals by country, signup cohort, transaction type, and day, and /api/rollup rolls
+# them up to any subset of those dimensions without scanning the transactions table.
+BUILD_ROLLUP_CUBE = True
+
+# Export Options
+# Bulk exports of the ETL outputs are streamed from the cursor as CSV or Parquet in chunks of EXPORT_CHUNK_ROWS, so
+# memory stays bounded.
+EXPORT_CHUNK_ROWS = 10000  # Rows per CSV chunk and per Parquet row group.
+EXPORT_DIR = "exports"  # Default directory of files written by `python main.py export`.
+
+# Risk Scoring Options
+# The ETL scores every user for unusual activity: the z-score of the latest daily amount against the user's other days,
+# and the number of withdrawals in the burst window ending on the latest day. A score of 1 or more crosses a threshold.
+SCORE_USER_RISK = True
+RISK_MIN_HISTORY_DAYS = 5  # Other days a user needs before the latest daily amount gets a z-score.
+RISK_Z_SCORE_THRESHOLD = 3.0
+RISK_BURST_WINDOW_DAYS = 3  # Days ending on a user's latest day in which withdrawals are counted.
+RISK_BURST_THRESHOLD = 5  # Withdrawals within one window at which a user is flagged.
+MAX_TOP_ANOMALIES = 1000  # Maximum number of users returned by /api/top_anomalies.
\ No newline at end of file
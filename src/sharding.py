@@ -0,0 +1,56 @@
+"""
+Sharded storage by user_id.
+
+With SHARD_COUNT above 1, users and transactions are stored in SHARD_COUNT database files next to settings.DB_PATH
+(e.g. transactions_data_shard0.db) instead of the single database file. Rows are routed by user_id modulo SHARD_COUNT,
+so every user and all of their transactions live in the same shard:
+    - Ingestion writes each shard in its own transaction, so shards don't share a write lock.
+    - The ETL runs on every shard in parallel processes. Per-user aggregates are complete within a shard, while volume
+      ranks are local to the shard.
+    - Point queries for a user go to that user's shard. Aggregate queries such as top users and daily totals run on
+      every shard and their results are merged.
+The main database file keeps the pipeline metadata only.
+"""
+
+import os
+
+import settings
+
+
+def is_sharded():
+    """Returns True if sharded storage is enabled in settings."""
+    return settings.SHARD_COUNT > 1
+
+def shard_path(index, db_path=None):
+    """
+    Returns the database file of a shard.
+    :param index: Shard index.
+    :param db_path: Path of the main database. Defaults to settings.DB_PATH.
+    :return: Path string.
+    """
+    base, extension = os.path.splitext(db_path or settings.DB_PATH)
+    return f'{base}_shard{index}{extension}'
+
+def shard_paths(db_path=None):
+    """
+    Returns the database files of every shard, ordered by shard index.
+    :param db_path: Path of the main database. Defaults to settings.DB_PATH.
+    :return: List of path strings.
+    """
+    return [shard_path(index, db_path) for index in range(settings.SHARD_COUNT)]
+
+def shard_for_user(user_id):
+    """
+    Returns the index of the shard storing a user.
+    :param user_id: Integer user ID.
+    :return: int
+    """
+    return int(user_id) % settings.SHARD_COUNT
+
+def split_by_shard(data):
+    """
+    Splits a DataFrame with a user_id column into the rows of each shard.
+    :param data: Pandas DataFrame.
+    :return: Dictionary of shard index to DataFrame. Shards without rows are left out.
+    """
+    return {int(index): rows for index, rows in data.groupby(data['user_id'].astype('int64') % settings.SHARD_COUNT)}
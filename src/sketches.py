@@ -0,0 +1,391 @@
+"""
+Approximate analytics with streaming sketches.
+
+With ENABLE_APPROXIMATE_ANALYTICS enabled, ingestion maintains three kinds of sketches next to the transactions, and the
+/api/approx endpoints answer from them in constant memory and time regardless of how much history is stored:
+    - SpaceSaving: top users by transaction volume. Counts are upper bounds, off by at most the reported error.
+    - HyperLogLog: distinct active users per day, with a relative error of about 1.04 / sqrt(2 ** precision).
+    - TDigest: amount percentiles per transaction type, most accurate at the tails.
+
+Sketches are stored in the analytic_sketches table and updated in the same transaction as the rows they summarize. Only
+transactions with a new transaction_id are added, so re-ingesting a file does not count its rows twice, while a replaced
+transaction keeps its original contribution until the sketches are rebuilt by the ETL. All three sketches are mergeable,
+so the sketches of every shard are merged at query time when sharded storage is enabled.
+"""
+
+import json
+import sqlite3
+
+import numpy as np
+
+import logs
+import profiling
+import settings
+import sharding
+import utility_library
+
+TOP_USERS_KEY = 'top_users'
+ACTIVE_USERS_KEY = 'active_users:{}'
+AMOUNTS_KEY = 'amounts:{}'
+
+
+class SpaceSaving:
+    """
+    Space-saving summary of the most frequent items, keeping at most `capacity` counters. Batches are added with the
+    mergeable variant of the algorithm: an item without a counter starts from the smallest kept count, which is also its
+    maximum overestimate.
+    :param capacity: Maximum number of counters.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+
+    def update(self, counts):
+        """
+        Adds a batch of item counts.
+        :param counts: Dictionary of item to count.
+        :return: None
+        """
+        floor = min(self.counts.values()) if len(self.counts) >= self.capacity else 0
+        for item, count in counts.items():
+            if item in self.counts:
+                self.counts[item] += count
+            else:
+                self.counts[item] = floor + count
+                self.errors[item] = floor
+        self._trim()
+
+    def merge(self, other):
+        """Adds the counters of another summary, e.g. from another shard."""
+        floor = min(self.counts.values()) if len(self.counts) >= self.capacity else 0
+        other_floor = min(other.counts.values()) if len(other.counts) >= other.capacity else 0
+        for item in set(self.counts) | set(other.counts):
+            self.errors[item] = self.errors.get(item, floor) + other.errors.get(item, other_floor)
+            self.counts[item] = self.counts.get(item, floor) + other.counts.get(item, other_floor)
+        self._trim()
+
+    def _trim(self):
+        if len(self.counts) > self.capacity:
+            kept = sorted(self.counts, key=lambda item: (-self.counts[item], item))[:self.capacity]
+            self.counts = {item: self.counts[item] for item in kept}
+            self.errors = {item: self.errors[item] for item in kept}
+
+    def top(self, k):
+        """
+        Returns the k items with the highest estimated counts.
+        :param k: Number of items.
+        :return: List of tuples (item, estimated count, maximum overestimate)
+        """
+        items = sorted(self.counts, key=lambda item: (-self.counts[item], item))[:k]
+        return [(item, self.counts[item], self.errors[item]) for item in items]
+
+    def to_bytes(self):
+        return json.dumps({'capacity': self.capacity, 'counts': list(self.counts.items()),
+                           'errors': list(self.errors.items())}).encode('utf-8')
+
+    @classmethod
+    def from_bytes(cls, data):
+        state = json.loads(data)
+        sketch = cls(state['capacity'])
+        sketch.counts = {item: count for item, count in state['counts']}
+        sketch.errors = {item: error for item, error in state['errors']}
+        return sketch
+
+
+class HyperLogLog:
+    """
+    HyperLogLog distinct counter over integer values, with 2 ** precision one-byte registers.
+    :param precision: Number of index bits, between 4 and 16.
+    """
+
+    def __init__(self, precision):
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    @staticmethod
+    def _hash(values):
+        """splitmix64 finalizer, a fast well-mixed 64-bit hash of integer values."""
+        with np.errstate(over='ignore'):
+            z = np.asarray(values, dtype=np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+            z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+            z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+            return z ^ (z >> np.uint64(31))
+
+    def update(self, values):
+        """
+        Adds integer values.
+        :param values: Iterable or array of integers.
+        :return: None
+        """
+        hashes = self._hash(values)
+        if hashes.size == 0:
+            return
+        index = (hashes >> np.uint64(64 - self.precision)).astype(np.int64)
+        remainder = hashes << np.uint64(self.precision)
+        # Rank = position of the first set bit in the remaining 64 - precision bits, counted from 1.
+        bit_length = np.zeros(remainder.shape, dtype=np.int64)
+        shifted = remainder.copy()
+        for shift in (32, 16, 8, 4, 2, 1):
+            mask = shifted >= (np.uint64(1) << np.uint64(64 - shift))
+            bit_length += np.where(mask, 0, shift)
+            shifted = np.where(mask, shifted, shifted << np.uint64(shift))
+        rank = np.minimum(bit_length + 1, 64 - self.precision + 1).astype(np.uint8)
+        rank[remainder == 0] = 64 - self.precision + 1
+        np.maximum.at(self.registers, index, rank)
+
+    def merge(self, other):
+        """Adds the values counted by another sketch with the same precision."""
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def count(self):
+        """
+        Estimates the number of distinct values, using linear counting for small cardinalities.
+        :return: int
+        """
+        m = self.registers.size
+        alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(m, 0.7213 / (1 + 1.079 / m))
+        estimate = alpha * m * m / np.sum(np.power(2.0, -self.registers.astype(np.float64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * np.log(m / zeros)
+        return int(round(estimate))
+
+    def to_bytes(self):
+        return bytes([self.precision]) + self.registers.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        sketch = cls(data[0])
+        sketch.registers = np.frombuffer(data[1:], dtype=np.uint8).copy()
+        return sketch
+
+
+class TDigest:
+    """
+    Merging t-digest of a value distribution. Values are buffered and merged into at most about `compression` centroids,
+    with smaller centroids near the tails so extreme percentiles stay accurate.
+    :param compression: Target number of centroids.
+    """
+
+    def __init__(self, compression):
+        self.compression = compression
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+        self.minimum = np.inf
+        self.maximum = -np.inf
+
+    def update(self, values, weights=None):
+        """
+        Adds values.
+        :param values: Iterable or array of numbers.
+        :param weights: Optional weights of the values.
+        :return: None
+        """
+        values = np.asarray(values, dtype=np.float64)
+        if values.size == 0:
+            return
+        weights = np.ones(values.size) if weights is None else np.asarray(weights, dtype=np.float64)
+        self.minimum = min(self.minimum, float(values.min()))
+        self.maximum = max(self.maximum, float(values.max()))
+        means = np.concatenate([self.means, values])
+        weights = np.concatenate([self.weights, weights])
+
+        order = np.argsort(means, kind='mergesort')
+        means, weights = means[order], weights[order]
+        quantiles = (np.cumsum(weights) - weights / 2) / weights.sum()
+        # Centroids are bounded by the arcsine scale function, which is finest at the tails.
+        scale = np.floor(self.compression * (np.arcsin(2 * quantiles - 1) / np.pi + 0.5)).astype(np.int64)
+        starts = np.concatenate([[0], np.flatnonzero(np.diff(scale)) + 1])
+        self.weights = np.add.reduceat(weights, starts)
+        self.means = np.add.reduceat(means * weights, starts) / self.weights
+
+    def merge(self, other):
+        """Adds the distribution summarized by another digest."""
+        if other.weights.size:
+            self.update(other.means, other.weights)
+            self.minimum = min(self.minimum, other.minimum)
+            self.maximum = max(self.maximum, other.maximum)
+
+    @property
+    def total_weight(self):
+        return float(self.weights.sum())
+
+    def quantile(self, q):
+        """
+        Estimates a quantile by interpolating between centroid means.
+        :param q: Quantile between 0 and 1.
+        :return: float, or None if the digest is empty.
+        """
+        if not self.weights.size:
+            return None
+        total = self.total_weight
+        positions = np.concatenate([[0.0], np.cumsum(self.weights) - self.weights / 2, [total]])
+        values = np.concatenate([[self.minimum], self.means, [self.maximum]])
+        return float(np.interp(q * total, positions, values))
+
+    def to_bytes(self):
+        return json.dumps({'compression': self.compression, 'means': self.means.tolist(),
+                           'weights': self.weights.tolist(), 'min': self.minimum, 'max': self.maximum}).encode('utf-8')
+
+    @classmethod
+    def from_bytes(cls, data):
+        state = json.loads(data)
+        sketch = cls(state['compression'])
+        sketch.means = np.asarray(state['means'], dtype=np.float64)
+        sketch.weights = np.asarray(state['weights'], dtype=np.float64)
+        sketch.minimum, sketch.maximum = state['min'], state['max']
+        return sketch
+
+
+def new_sketch(key):
+    """
+    Creates an empty sketch for a sketch key, sized by the settings.
+    :param key: Sketch key.
+    :return: SpaceSaving, HyperLogLog, or TDigest
+    """
+    if key == TOP_USERS_KEY:
+        return SpaceSaving(settings.SKETCH_TOP_USERS_CAPACITY)
+    if key.startswith(ACTIVE_USERS_KEY.format('')):
+        return HyperLogLog(settings.SKETCH_HLL_PRECISION)
+    return TDigest(settings.SKETCH_TDIGEST_COMPRESSION)
+
+def sketch_class(key):
+    """Returns the sketch class stored under a sketch key."""
+    return type(new_sketch(key))
+
+def create_sketch_table(conn):
+    """Creates the analytic_sketches table if it doesn't already exist."""
+    conn.execute("CREATE TABLE IF NOT EXISTS analytic_sketches (sketch_key TEXT PRIMARY KEY, data BLOB);")
+
+def load_sketches(conn, keys):
+    """
+    Loads sketches from the database, creating empty sketches for keys that are not stored yet.
+    :param conn: Open SQLite connection.
+    :param keys: Sketch keys.
+    :return: Dictionary of sketch key to sketch.
+    """
+    create_sketch_table(conn)
+    sketches = {key: new_sketch(key) for key in keys}
+    for key in sketches:
+        row = conn.execute("SELECT data FROM analytic_sketches WHERE sketch_key = ?;", (key,)).fetchone()
+        if row is not None:
+            sketches[key] = sketch_class(key).from_bytes(row[0])
+    return sketches
+
+def save_sketches(conn, sketches):
+    """
+    Stores sketches in the database. The caller commits the transaction.
+    :param conn: Open SQLite connection.
+    :param sketches: Dictionary of sketch key to sketch.
+    :return: None
+    """
+    conn.executemany("INSERT OR REPLACE INTO analytic_sketches (sketch_key, data) VALUES (?, ?);",
+                     [(key, sqlite3.Binary(sketch.to_bytes())) for key, sketch in sketches.items()])
+
+def add_to_sketches(sketches, data):
+    """
+    Adds transaction rows to sketches, creating the sketches the rows need.
+    :param sketches: Dictionary of sketch key to sketch, updated in place.
+    :param data: DataFrame with user_id, transaction_date, amount, and transaction_type columns.
+    :return: None
+    """
+    if data.empty:
+        return
+    volumes = data['user_id'].astype('int64').value_counts()
+    sketches.setdefault(TOP_USERS_KEY, new_sketch(TOP_USERS_KEY)).update(
+        {int(user_id): int(count) for user_id, count in volumes.items()})
+    for transaction_date, user_ids in data.groupby('transaction_date')['user_id']:
+        key = ACTIVE_USERS_KEY.format(transaction_date)
+        sketches.setdefault(key, new_sketch(key)).update(user_ids.astype('int64').to_numpy())
+    for transaction_type, amounts in data.groupby('transaction_type')['amount']:
+        key = AMOUNTS_KEY.format(transaction_type)
+        sketches.setdefault(key, new_sketch(key)).update(amounts.to_numpy())
+
+def update_sketches(conn, data):
+    """
+    Adds the transactions of an ingestion batch to the stored sketches. Must be called before the rows are inserted, so
+    rows replacing an existing transaction_id can be left out.
+    :param conn: Open SQLite connection. The caller commits the transaction.
+    :param data: Cleaned transactions DataFrame.
+    :return: None
+    """
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS sketch_batch_ids (transaction_id INTEGER PRIMARY KEY);")
+    conn.execute("DELETE FROM sketch_batch_ids;")
+    conn.executemany("INSERT OR IGNORE INTO sketch_batch_ids (transaction_id) VALUES (?);",
+                     [(int(transaction_id),) for transaction_id in data['transaction_id']])
+    existing = {row[0] for row in conn.execute("""
+        SELECT t.transaction_id
+        FROM transactions t
+        JOIN sketch_batch_ids b ON t.transaction_id = b.transaction_id;
+    """)}
+    new_rows = data[~data['transaction_id'].isin(existing)]
+
+    keys = {TOP_USERS_KEY}
+    keys.update(ACTIVE_USERS_KEY.format(transaction_date) for transaction_date in new_rows['transaction_date'].unique())
+    keys.update(AMOUNTS_KEY.format(transaction_type) for transaction_type in new_rows['transaction_type'].unique())
+    sketches = load_sketches(conn, keys)
+    add_to_sketches(sketches, new_rows)
+    save_sketches(conn, sketches)
+
+@profiling.profile_stage()
+def rebuild_sketches():
+    """
+    Rebuilds every sketch from the full transactions table, streaming it in ETL_FETCH_SIZE chunks, and replaces the
+    stored sketches in one transaction.
+    :return: None
+    """
+    import pandas as pd
+
+    conn = sqlite3.connect(utility_library.DATABASE_PATH)
+    try:
+        sketches = {}
+        scanned_rows = 0
+        cursor = conn.execute("SELECT user_id, transaction_date, amount, transaction_type FROM transactions;")
+        while True:
+            rows = cursor.fetchmany(settings.ETL_FETCH_SIZE)
+            if not rows:
+                break
+            scanned_rows += len(rows)
+            add_to_sketches(sketches, pd.DataFrame(
+                rows, columns=['user_id', 'transaction_date', 'amount', 'transaction_type']))
+        profiling.record_rows(scanned_rows)
+
+        create_sketch_table(conn)
+        conn.execute("DELETE FROM analytic_sketches;")
+        save_sketches(conn, sketches)
+        conn.commit()
+    except sqlite3.Error as e:
+        conn.rollback()
+        logs.log_error(f'Sketches could not be rebuilt. Error: {e}')
+        raise
+    finally:
+        conn.close()
+    logs.log_event(f'Approximate analytics sketches rebuilt from {scanned_rows} transactions.')
+
+def read_sketch(key):
+    """
+    Reads a sketch for the API, merging the sketches of every shard when sharded storage is enabled.
+    :param key: Sketch key.
+    :return: The sketch, or None if it is not stored in any database.
+    """
+    paths = sharding.shard_paths(utility_library.DATABASE_PATH) if sharding.is_sharded() \
+        else [utility_library.DATABASE_PATH]
+    merged = None
+    for path in paths:
+        conn = sqlite3.connect(path)
+        try:
+            row = conn.execute("SELECT data FROM analytic_sketches WHERE sketch_key = ?;", (key,)).fetchone()
+        except sqlite3.OperationalError:
+            row = None
+        finally:
+            conn.close()
+        if row is None:
+            continue
+        sketch = sketch_class(key).from_bytes(row[0])
+        if merged is None:
+            merged = sketch
+        else:
+            merged.merge(sketch)
+    return merged
@@ -0,0 +1,329 @@
+"""
+Deterministic synthetic users and transactions at any scale.
+
+Rows are generated with vectorized numpy draws and streamed to disk one chunk at a time, so memory is bounded by
+CHUNK_ROWS rows no matter how many rows are written (1B transactions need about as much memory as 1M). The same seed and
+chunk size always produce the same files.
+
+- Distributions: signup and transaction dates are uniform over DATE_RANGE, amounts are log-normal, and countries and
+  transaction types are uniform.
+- Heavy users: with a user skew s > 0, transactions are assigned to users by a Zipf-like power law, so the user of rank
+  r has about r^-s times the transactions of the heaviest user. Ranks are scattered over the user IDs, so heavy users
+  are not clustered at low IDs.
+- Bad rows: each rule checked by clean_users_data() and clean_transactions_data() has its own rate. A bad row breaks
+  exactly one rule, so the cleaners drop it for that reason.
+- Duplicates: a fraction of the clean rows reuse the ID of another clean row of the same chunk. The cleaners drop every
+  row of a duplicated ID.
+The returned summary counts the rows written for each rule and the rows the cleaners are expected to keep.
+
+Usage:
+    python synthetic_data.py --scale 1B --users 10M --user-skew 1.1 --bad-row-rate 0.001 --duplicate-rate 0.0005
+    python main.py generate --scale 10M --format parquet --output-dir data/
+"""
+
+import argparse
+import math
+import os
+
+import numpy as np
+import pandas as pd
+
+import logs
+
+SCALE_SUFFIXES = {'k': 1_000, 'm': 1_000_000, 'b': 1_000_000_000}
+TRANSACTIONS_PER_USER = 10
+CHUNK_ROWS = 1_000_000
+COUNTRIES = np.array(['USA', 'Canada', 'UK', 'Germany', 'France', 'Japan', 'India', 'Australia'], dtype=object)
+TRANSACTION_TYPES = np.array(['deposit', 'withdrawal', 'purchase'], dtype=object)
+DATE_RANGE = (np.datetime64('2022-01-01'), np.datetime64('2023-01-01'))
+DATES = np.arange(DATE_RANGE[0], DATE_RANGE[1]).astype(str).astype(object)  # Formatted once, then indexed per chunk.
+FORMATS = ('csv', 'parquet')
+
+# Bad-row rules, named after the checks in import_raw_to_db.clean_users_data() and clean_transactions_data().
+USER_RULES = ('missing_user_id', 'invalid_user_id', 'invalid_signup_date', 'missing_country')
+TRANSACTION_RULES = ('missing_transaction_id', 'invalid_transaction_id', 'missing_user_id',
+                     'invalid_transaction_date', 'invalid_amount', 'invalid_transaction_type')
+INVALID_DATES = np.array(['2022-02-30', '2022-13-01', '01/15/2022', 'not a date', ''], dtype=object)
+INVALID_TRANSACTION_TYPES = np.array(['refund', 'transfer', 'DEPOSIT', 'unknown'], dtype=object)
+
+USER_SCHEMA = (('user_id', 'int64'), ('signup_date', 'string'), ('country', 'string'))
+TRANSACTION_SCHEMA = (('transaction_id', 'int64'), ('user_id', 'int64'), ('transaction_date', 'string'),
+                      ('amount', 'double'), ('transaction_type', 'string'))
+
+
+def parse_scale(scale):
+    """
+    Parses a scale such as '100k', '1M', or '250000' into a number of rows.
+    :param scale: Scale string.
+    :return: Integer number of rows.
+    """
+    scale = str(scale).strip().lower()
+    if scale and scale[-1] in SCALE_SUFFIXES:
+        return int(float(scale[:-1]) * SCALE_SUFFIXES[scale[-1]])
+    return int(scale)
+
+def random_dates(rng, size):
+    """Draws dates uniformly from DATE_RANGE as YYYY-MM-DD strings."""
+    return DATES[rng.integers(0, len(DATES), size)]
+
+def scatter_multiplier(num_users):
+    """
+    Picks a multiplier coprime with num_users, so rank -> (rank * multiplier) mod num_users is a bijection that
+    scatters the heavy users over the ID range.
+    :param num_users: Number of users.
+    :return: int
+    """
+    multiplier = max(1, int(num_users * 0.6180339887))
+    while math.gcd(multiplier, num_users) != 1:
+        multiplier -= 1
+    return multiplier
+
+def skewed_user_ids(rng, size, num_users, user_skew):
+    """
+    Draws user IDs for transactions. Uniform if user_skew is 0, otherwise the rank of the user follows a bounded
+    power law with exponent user_skew, sampled by inverting its continuous CDF.
+    :param rng: numpy Generator.
+    :param size: Number of IDs to draw.
+    :param num_users: Number of users. IDs are drawn from 1 to num_users.
+    :param user_skew: Power law exponent, 0 for uniform.
+    :return: numpy array of int64.
+    """
+    if user_skew <= 0:
+        return rng.integers(1, num_users + 1, size)
+    uniform = rng.random(size)
+    if math.isclose(user_skew, 1.0):
+        ranks = np.exp(uniform * np.log(num_users + 1.0))
+    else:
+        exponent = 1.0 - user_skew
+        ranks = (uniform * ((num_users + 1.0) ** exponent - 1.0) + 1.0) ** (1.0 / exponent)
+    ranks = np.clip(ranks.astype(np.int64), 1, num_users)
+    return (ranks - 1) * scatter_multiplier(num_users) % num_users + 1
+
+def draw_rules(rng, size, rules, bad_row_rates):
+    """
+    Assigns each row the rule it breaks.
+    :param rng: numpy Generator.
+    :param size: Number of rows.
+    :param rules: Rule names.
+    :param bad_row_rates: Dictionary of rule name to the fraction of rows breaking it. Missing rules have a rate of 0.
+    :return: numpy array with 0 for clean rows and i + 1 for rows breaking rules[i].
+    """
+    rates = np.array([bad_row_rates.get(rule, 0.0) for rule in rules])
+    if rates.sum() > 1:
+        raise ValueError(f'Bad-row rates add up to {rates.sum()}, more than 1.')
+    codes = np.searchsorted(np.cumsum(rates), rng.random(size), side='right') + 1
+    codes[codes > len(rules)] = 0
+    return codes
+
+def duplicate_ids(rng, ids, clean, duplicate_rate):
+    """
+    Overwrites the IDs of a fraction of the clean rows with the IDs of other clean rows.
+    :param rng: numpy Generator.
+    :param ids: numpy array of IDs, modified in place.
+    :param clean: Boolean mask of the clean rows.
+    :param duplicate_rate: Fraction of the clean rows to turn into duplicates.
+    :return: Number of clean rows the cleaners keep: those whose ID is not shared with another clean row.
+    """
+    clean_rows = np.flatnonzero(clean)
+    num_duplicates = int(round(len(clean_rows) * duplicate_rate))
+    if num_duplicates and len(clean_rows) > 1:
+        targets = rng.choice(clean_rows, num_duplicates, replace=False)
+        ids[targets] = ids[rng.choice(clean_rows, num_duplicates)]
+    _, counts = np.unique(ids[clean_rows], return_counts=True)
+    return int((counts == 1).sum())
+
+def generate_user_chunks(rng, num_users, bad_row_rates, duplicate_rate, summary, chunk_rows):
+    """
+    Generates users in chunks. User IDs run from 1 to num_users.
+    :param rng: numpy Generator.
+    :param num_users: Number of users.
+    :param bad_row_rates: Dictionary of rule name (USER_RULES) to rate.
+    :param duplicate_rate: Fraction of clean rows with a duplicated user_id.
+    :param summary: Dictionary updated with the row counts of each chunk.
+    :param chunk_rows: Rows per chunk.
+    :return: Generator of DataFrames.
+    """
+    for start in range(0, num_users, chunk_rows):
+        size = min(chunk_rows, num_users - start)
+        ids = np.arange(start + 1, start + size + 1)
+        rules = draw_rules(rng, size, USER_RULES, bad_row_rates)
+        summary['clean_rows'] += duplicate_ids(rng, ids, rules == 0, duplicate_rate)
+
+        signup_dates = random_dates(rng, size)
+        countries = COUNTRIES[rng.integers(0, len(COUNTRIES), size)]
+        user_ids = pd.array(ids, dtype='Int64')
+        user_ids[rules == 1] = pd.NA
+        user_ids[rules == 2] = -rng.integers(0, 1000, int((rules == 2).sum()))
+        signup_dates[rules == 3] = INVALID_DATES[rng.integers(0, len(INVALID_DATES), int((rules == 3).sum()))]
+        countries[rules == 4] = None
+
+        summary['rows'] += size
+        for index, rule in enumerate(USER_RULES, start=1):
+            summary[rule] += int((rules == index).sum())
+        yield pd.DataFrame({'user_id': user_ids, 'signup_date': signup_dates, 'country': countries})
+
+def generate_transaction_chunks(rng, num_transactions, num_users, user_skew, bad_row_rates, duplicate_rate, summary,
+                                chunk_rows):
+    """
+    Generates transactions in chunks. Transaction IDs run from 1 to num_transactions.
+    :param rng: numpy Generator.
+    :param num_transactions: Number of transactions.
+    :param num_users: Number of users the transactions are assigned to.
+    :param user_skew: Power law exponent of transactions per user, 0 for uniform.
+    :param bad_row_rates: Dictionary of rule name (TRANSACTION_RULES) to rate.
+    :param duplicate_rate: Fraction of clean rows with a duplicated transaction_id.
+    :param summary: Dictionary updated with the row counts of each chunk.
+    :param chunk_rows: Rows per chunk.
+    :return: Generator of DataFrames.
+    """
+    for start in range(0, num_transactions, chunk_rows):
+        size = min(chunk_rows, num_transactions - start)
+        ids = np.arange(start + 1, start + size + 1)
+        rules = draw_rules(rng, size, TRANSACTION_RULES, bad_row_rates)
+        summary['clean_rows'] += duplicate_ids(rng, ids, rules == 0, duplicate_rate)
+
+        transaction_ids = pd.array(ids, dtype='Int64')
+        user_ids = pd.array(skewed_user_ids(rng, size, num_users, user_skew), dtype='Int64')
+        transaction_dates = random_dates(rng, size)
+        amounts = np.round(rng.lognormal(5, 1, size) + 0.01, 2)
+        transaction_types = TRANSACTION_TYPES[rng.integers(0, len(TRANSACTION_TYPES), size)]
+
+        transaction_ids[rules == 1] = pd.NA
+        transaction_ids[rules == 2] = -rng.integers(0, 1000, int((rules == 2).sum()))
+        user_ids[rules == 3] = pd.NA
+        transaction_dates[rules == 4] = INVALID_DATES[rng.integers(0, len(INVALID_DATES), int((rules == 4).sum()))]
+        amounts[rules == 5] = -np.round(rng.lognormal(3, 1, int((rules == 5).sum())), 2) * rng.integers(
+            0, 2, int((rules == 5).sum()))
+        transaction_types[rules == 6] = INVALID_TRANSACTION_TYPES[
+            rng.integers(0, len(INVALID_TRANSACTION_TYPES), int((rules == 6).sum()))]
+
+        summary['rows'] += size
+        for index, rule in enumerate(TRANSACTION_RULES, start=1):
+            summary[rule] += int((rules == index).sum())
+        yield pd.DataFrame({'transaction_id': transaction_ids, 'user_id': user_ids,
+                            'transaction_date': transaction_dates, 'amount': amounts,
+                            'transaction_type': transaction_types})
+
+def write_chunks(path, chunks, file_format, schema):
+    """
+    Writes DataFrame chunks to a CSV file, or to a Parquet file with one row group per chunk.
+    :param path: Output path.
+    :param chunks: Iterable of DataFrames.
+    :param file_format: 'csv' or 'parquet'.
+    :param schema: Tuples of column name and Parquet type.
+    :return: None
+    """
+    if file_format == 'csv':
+        for index, chunk in enumerate(chunks):
+            chunk.to_csv(path, mode='w' if index == 0 else 'a', header=index == 0, index=False)
+        return
+
+    import pyarrow as pa  # Optional dependency, only needed for Parquet output.
+    import pyarrow.parquet as pq
+
+    arrow_schema = pa.schema([(column, pa.type_for_alias(column_type)) for column, column_type in schema])
+    with pq.ParquetWriter(path, arrow_schema) as writer:
+        for chunk in chunks:
+            writer.write_table(pa.Table.from_pandas(chunk, schema=arrow_schema, preserve_index=False))
+
+def generate_synthetic_data(output_dir, num_transactions, num_users=None, seed=0, user_skew=0.0, bad_row_rates=None,
+                            duplicate_rate=0.0, file_format='csv', chunk_rows=None):
+    """
+    Generates users and transactions files in chunks so memory stays bounded at any scale.
+    :param output_dir: Directory the files are written to.
+    :param num_transactions: Number of transactions to generate.
+    :param num_users: Number of users to generate. Defaults to one user per TRANSACTIONS_PER_USER transactions.
+    :param seed: Random seed.
+    :param user_skew: Power law exponent of transactions per user, 0 for uniform. Around 1 gives a long tail of heavy
+    users.
+    :param bad_row_rates: Optional dictionary of rule name (USER_RULES and TRANSACTION_RULES) to the fraction of rows
+    breaking it. missing_user_id applies to both files.
+    :param duplicate_rate: Fraction of clean rows whose ID duplicates another row, in both files.
+    :param file_format: 'csv' or 'parquet'. Parquet requires pyarrow.
+    :param chunk_rows: Rows generated and written per chunk. Defaults to CHUNK_ROWS.
+    :return: Dictionary with the users_path and transactions_path, and a summary of each file: rows written, rows per
+    bad-row rule, and clean_rows expected to pass the cleaners.
+    """
+    if file_format not in FORMATS:
+        raise ValueError(f'Invalid file format: {file_format}. Expected one of {", ".join(FORMATS)}.')
+    num_users = num_users or max(1, num_transactions // TRANSACTIONS_PER_USER)
+    bad_row_rates = bad_row_rates or {}
+    unknown_rules = set(bad_row_rates) - set(USER_RULES) - set(TRANSACTION_RULES)
+    if unknown_rules:
+        raise ValueError(f'Unknown bad-row rules: {", ".join(sorted(unknown_rules))}.')
+    chunk_rows = chunk_rows or CHUNK_ROWS
+    user_rng, transaction_rng = [np.random.default_rng(seed_sequence)
+                                 for seed_sequence in np.random.SeedSequence(seed).spawn(2)]
+
+    os.makedirs(output_dir, exist_ok=True)
+    users_path = os.path.join(output_dir, f'users.{file_format}')
+    transactions_path = os.path.join(output_dir, f'transactions.{file_format}')
+    users_summary = dict.fromkeys(('rows', 'clean_rows') + USER_RULES, 0)
+    transactions_summary = dict.fromkeys(('rows', 'clean_rows') + TRANSACTION_RULES, 0)
+
+    write_chunks(users_path, generate_user_chunks(user_rng, num_users, bad_row_rates, duplicate_rate, users_summary,
+                                                  chunk_rows), file_format, USER_SCHEMA)
+    write_chunks(transactions_path, generate_transaction_chunks(transaction_rng, num_transactions, num_users,
+                                                                user_skew, bad_row_rates, duplicate_rate,
+                                                                transactions_summary, chunk_rows),
+                 file_format, TRANSACTION_SCHEMA)
+
+    logs.log_event(f'Synthetic data generated: {users_summary["rows"]} users ({users_summary["clean_rows"]} clean) '
+                   f'and {transactions_summary["rows"]} transactions ({transactions_summary["clean_rows"]} clean) in '
+                   f'{output_dir}.')
+    return {
+        'users_path': users_path,
+        'transactions_path': transactions_path,
+        'users': users_summary,
+        'transactions': transactions_summary,
+    }
+
+def parse_bad_row_rates(bad_row_rate, overrides):
+    """
+    Builds the bad-row rates from a rate shared by every rule and per-rule overrides.
+    :param bad_row_rate: Rate of every rule.
+    :param overrides: Comma-separated rule=rate pairs, e.g. 'missing_country=0.01,invalid_amount=0.002'.
+    :return: Dictionary of rule name to rate.
+    """
+    rates = {rule: bad_row_rate for rule in USER_RULES + TRANSACTION_RULES}
+    for pair in filter(None, (overrides or '').split(',')):
+        rule, _, rate = pair.partition('=')
+        rates[rule.strip()] = float(rate)
+    return rates
+
+def main(argv=None):
+    """
+    Command line entry point, also used by `python main.py generate`.
+    :param argv: Command line arguments. Defaults to sys.argv.
+    :return: The generation summary.
+    """
+    parser = argparse.ArgumentParser(description='Generate synthetic users and transactions files.')
+    parser.add_argument('--scale', default='100k', help='Number of transactions, e.g. 1M, 100M, 1B.')
+    parser.add_argument('--users', default=None, help='Number of users, e.g. 10M. Defaults to scale / 10.')
+    parser.add_argument('--output-dir', default='generated_data', help='Directory the files are written to.')
+    parser.add_argument('--format', choices=FORMATS, default='csv', help='File format. Parquet requires pyarrow.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--user-skew', type=float, default=0.0,
+                        help='Power law exponent of transactions per user. 0 is uniform, around 1 gives heavy users.')
+    parser.add_argument('--bad-row-rate', type=float, default=0.0, help='Fraction of rows breaking each cleaner rule.')
+    parser.add_argument('--bad-row-rates', default=None,
+                        help=f'Per-rule rates overriding --bad-row-rate, e.g. missing_country=0.01. Rules: '
+                             f'{", ".join(dict.fromkeys(USER_RULES + TRANSACTION_RULES))}.')
+    parser.add_argument('--duplicate-rate', type=float, default=0.0, help='Fraction of rows with a duplicated ID.')
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS, help='Rows generated and written per chunk.')
+    args = parser.parse_args(argv)
+
+    num_transactions = parse_scale(args.scale)
+    num_users = parse_scale(args.users) if args.users else None
+    print(f'Generating {num_transactions} synthetic transactions in {args.output_dir}...')
+    summary = generate_synthetic_data(args.output_dir, num_transactions, num_users, args.seed, args.user_skew,
+                                      parse_bad_row_rates(args.bad_row_rate, args.bad_row_rates),
+                                      args.duplicate_rate, args.format, args.chunk_rows)
+    for name in ('users', 'transactions'):
+        print(f'\t{summary[f"{name}_path"]}: {summary[name]["rows"]} rows, {summary[name]["clean_rows"]} clean.')
+    return summary
+
+
+if __name__ == '__main__':
+    logs.init_logging()
+    main()
@@ -5,16 +5,61 @@ Task 5:
     - User Data Cleaning Tests: Tests clean_users_data() function with different forms of test data
     - Transaction Data Cleaning Tests: Tests clean_transaction_data() function with different forms of test data
     - ETL Function Tests: Tests form and quality of results of various ETL processes.
+    - Fused ETL Tests: Tests the single-pass ETL scan against the individual ETL processes on a temporary database.
+    - Analytic Snapshot Tests: Tests lookups against the memory-mapped snapshot written from the ETL results.
+    - API Tests: Tests the Flask API endpoints against a temporary database using the Flask test client.
+    - Benchmark Tests: Tests the benchmark helpers and a small end-to-end benchmark run.
+    - Profiling Tests: Tests stage profiling records and the JSON run summary.
+    - Query Monitoring Tests: Tests query fingerprints, per-fingerprint stats, and slow query plan capture.
+    - Pipeline Scheduler Tests: Tests concurrent stages, serialized writers, skipping, and failure handling.
+    - Ingestion Daemon Tests: Tests micro-batch ingestion and incremental ETL updates against a full ETL recompute.
+    - Background Refresh Tests: Tests building data in a separate process and swapping it into the live database.
+    - Sharding Tests: Tests row routing to shards and API results over shards against a single database.
+    - Partition Tests: Tests migration to monthly partitions, routing by transaction date, and dropping a month or all.
+    - Approximate Analytics Tests: Tests sketch accuracy, sketch maintenance during ingestion, and the approx endpoints.
+    - Rolling Totals Tests: Tests rolling-window totals from the prefix sum tables against range scans.
+    - Command Line Tests: Tests command routing and that startup neither imports heavy modules nor creates a log file.
+    - Rollup Cube Tests: Tests rollups over subsets of the cube dimensions and cube updates against GROUP BYs.
+    - Export Tests: Tests streamed CSV and Parquet exports of the ETL outputs with date filters.
+    - Synthetic Data Tests: Tests generator determinism, user skew, and bad rows and duplicates against the cleaners.
+    - Risk Scoring Tests: Tests incremental risk score updates against a rebuild, withdrawal bursts, and top anomalies.
 
 Note: Unit Tests not logged.
 """
 
+import gzip
+import io
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 from unittest.mock import patch, MagicMock
+import numpy as np
 import pandas as pd
 
+import analytic_snapshot
+import background_refresh
+import benchmark
 import import_raw_to_db
 import etl
+import export
+import flask_api
+import ingest_daemon
+import main
+import partitions
+import pipeline_scheduler
+import profiling
+import risk_scoring
+import rollup_cube
+import sharding
+import sketches
+import synthetic_data
+import utility_library
 
 
 class TestDataCleaning(unittest.TestCase):
@@ -236,5 +281,1181 @@ class TestETLFunctions(unittest.TestCase):
         mock_conn.commit.assert_called_once()
 
 
+def create_test_database(db_path):
+    """
+    Creates a small database with users and transactions for tests that need a real SQLite Database.
+
+    :param db_path: Path of the SQLite database file to create.
+    :return: None
+    """
+    import_raw_to_db.create_db_schemas(db_path)
+    conn = sqlite3.connect(db_path)
+    conn.executemany("INSERT INTO users (user_id, signup_date, country) VALUES (?, ?, ?);", [
+        (1, '2024-01-01', 'USA'),
+        (2, '2024-01-15', 'Canada'),
+        (3, '2024-02-01', 'UK'),
+    ])
+    conn.executemany("""
+        INSERT INTO transactions (transaction_id, user_id, transaction_date, amount, transaction_type)
+        VALUES (?, ?, ?, ?, ?);
+    """, [
+        (1, 1, '2024-03-01', 100.0, 'deposit'),
+        (2, 1, '2024-03-01', 25.0, 'purchase'),
+        (3, 2, '2024-03-01', 40.0, 'withdrawal'),
+        (4, 2, '2024-03-02', 60.0, 'deposit'),
+        (5, 2, '2024-03-02', 10.0, 'purchase'),
+        (6, 1, '2024-03-02', 5.0, 'purchase'),
+        (7, 2, '2024-03-03', 15.0, 'withdrawal'),
+    ])
+    conn.commit()
+    conn.close()
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """
+    Base class for tests that run against a temporary database. Each test gets a temporary directory with the test
+    database, and the patches returned by patch_targets() are started for the test and stopped after it.
+    """
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.db_path = os.path.join(self.temp_dir.name, 'test.db')
+        self.create_database()
+        for p in self.patch_targets():
+            p.start()
+            self.addCleanup(p.stop)
+
+    def create_database(self):
+        """Creates the test database in the temporary directory."""
+        create_test_database(self.db_path)
+
+    def patch_targets(self):
+        """
+        Returns the patches started for each test. Points the utility library at the test database by default.
+        :return: List of unittest.mock patches.
+        """
+        return [patch('utility_library.DATABASE_PATH', self.db_path)]
+
+
+class TestFusedETL(DatabaseTestCase):
+    """
+    Class to test the single-pass ETL scan against the individual ETL processes.
+    """
+
+    def patch_targets(self):
+        return [patch('etl.DATABASE_PATH', self.db_path), patch('utility_library.DATABASE_PATH', self.db_path)]
+
+    def test_fused_scan_matches_individual_tasks(self):
+        """
+        Ensures the fused scan produces the same aggregates as the individual ETL queries.
+        :return: None
+        """
+        user_summary, top_ten, daily_aggregates = etl.fused_etl_scan()
+
+        expected_summary = etl.calculate_total_transaction_amount_per_user(log_events=False)
+        expected_daily = etl.aggregate_daily_transactions()
+        pd.testing.assert_frame_equal(user_summary, expected_summary, check_dtype=False)
+        pd.testing.assert_frame_equal(daily_aggregates, expected_daily, check_dtype=False)
+        self.assertEqual(top_ten['user_id'].tolist(), [2, 1])
+        self.assertEqual(top_ten['transaction_volume'].tolist(), [4, 3])
+
+    def test_fused_scan_loads_destination_tables(self):
+        """
+        Ensures the fused scan writes the user summary, volume rankings, and daily totals to the database.
+        :return: None
+        """
+        etl.fused_etl_scan()
+
+        conn = sqlite3.connect(self.db_path)
+        users = conn.execute("SELECT user_id, total_transaction_amount FROM users ORDER BY user_id;").fetchall()
+        rankings = conn.execute(
+            "SELECT user_id, volume_rank FROM user_volume_rankings ORDER BY volume_rank;").fetchall()
+        daily = conn.execute("""
+            SELECT daily_total, transaction_count FROM daily_transaction_totals
+            WHERE transaction_date = '2024-03-01' AND transaction_type = 'deposit';
+        """).fetchone()
+        conn.close()
+
+        self.assertEqual(users, [(1, 130.0), (2, 125.0), (3, 0.0)])
+        self.assertEqual(rankings, [(2, 1), (1, 2)])
+        self.assertEqual(daily, (100.0, 1))
+
+
+class TestAnalyticSnapshot(DatabaseTestCase):
+    """
+    Class to test the memory-mapped analytic snapshot written from the fused ETL output tables.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.snapshot_path = os.path.join(self.temp_dir.name, 'snapshot.bin')
+        etl.fused_etl_scan()
+        analytic_snapshot.write_snapshot(self.db_path, self.snapshot_path)
+        self.snapshot = analytic_snapshot.AnalyticSnapshot(self.snapshot_path)
+        self.addCleanup(self.snapshot.close)
+
+    def patch_targets(self):
+        return [patch('etl.DATABASE_PATH', self.db_path), patch('utility_library.DATABASE_PATH', self.db_path)]
+
+    def test_user_summary_lookup(self):
+        """
+        Ensures user summaries are found by binary search and users without transactions are not found.
+        :return: None
+        """
+        summary = self.snapshot.get_user_summary(2)
+        self.assertEqual(summary['country'], 'Canada')
+        self.assertEqual(summary['total_transaction_amount'], 125.0)
+        self.assertEqual(summary['total_withdrawal'], 55.0)
+        self.assertIsNone(self.snapshot.get_user_summary(3))
+        self.assertIsNone(self.snapshot.get_user_summary(999))
+
+    def test_daily_and_top_user_lookups(self):
+        """
+        Ensures daily totals and top users match the fused ETL output.
+        :return: None
+        """
+        daily = self.snapshot.get_daily_transactions('2024-03-02')
+        self.assertEqual([(row['transaction_type'], row['daily_total']) for row in daily],
+                         [('deposit', 60.0), ('purchase', 15.0)])
+        self.assertEqual(self.snapshot.get_daily_transactions('2024-04-01'), [])
+        self.assertEqual(self.snapshot.get_daily_transactions('2024-03-02xyz'), [])
+        self.assertEqual(self.snapshot.get_top_users()[0], {'user_id': 2, 'country': 'Canada', 'transaction_count': 4})
+
+    def test_snapshot_served_only_when_written(self):
+        """
+        Ensures a snapshot file is not served when the ETL configuration no longer writes it.
+        :return: None
+        """
+        with patch('settings.ANALYTIC_SNAPSHOT_PATH', self.snapshot_path), \
+                patch('settings.SERVE_FROM_ANALYTIC_SNAPSHOT', True):
+            self.assertIsNotNone(analytic_snapshot.get_snapshot())
+            with patch('settings.USE_FUSED_ETL_SCAN', False):
+                self.assertIsNone(analytic_snapshot.get_snapshot())
+
+
+class TestAPI(DatabaseTestCase):
+    """
+    Class to test the Flask API endpoints against a temporary database.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.client = flask_api.app.test_client()
+
+    def patch_targets(self):
+        return super().patch_targets() + [patch('settings.SERVE_FROM_ANALYTIC_SNAPSHOT', False),
+                                          patch('settings.DATA_VERSION_CACHE_SECONDS', 0)]
+
+    def test_streamed_json_response(self):
+        """
+        Ensures streamed responses are valid JSON arrays and missing data still returns 404.
+        :return: None
+        """
+        response = self.client.get('/api/daily_transactions?date=2024-03-01')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([row['transaction_type'] for row in response.get_json()],
+                         ['deposit', 'purchase', 'withdrawal'])
+
+        response = self.client.get('/api/user_transaction_summary?user_id=3')
+        self.assertEqual(response.status_code, 404)
+
+    def test_streamed_ndjson_response(self):
+        """
+        Ensures the ndjson format returns one JSON document per line.
+        :return: None
+        """
+        with patch('settings.STREAM_CHUNK_ROWS', 1):
+            response = self.client.get('/api/top_users?format=ndjson')
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual([json.loads(line)['user_id'] for line in lines], [2, 1])
+
+    def test_conditional_get_returns_not_modified(self):
+        """
+        Ensures a matching If-None-Match header returns 304 until the data version changes.
+        :return: None
+        """
+        utility_library.bump_data_version()
+        etag = self.client.get('/api/top_users').headers['ETag']
+
+        response = self.client.get('/api/top_users', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        utility_library.bump_data_version()
+        response = self.client.get('/api/top_users', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+    def test_large_responses_are_gzip_compressed(self):
+        """
+        Ensures responses above the size threshold are gzip compressed and smaller responses are not.
+        :return: None
+        """
+        with patch('settings.COMPRESSION_MIN_SIZE', 50):
+            response = self.client.get('/api/daily_transactions?date=2024-03-01', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers.get('Content-Encoding'), 'gzip')
+        self.assertEqual(len(json.loads(gzip.decompress(response.data))), 3)
+
+        response = self.client.get('/api/daily_transactions?date=2024-03-01', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+
+
+class TestBenchmark(unittest.TestCase):
+    """
+    Class to test the benchmark harness.
+    """
+
+    def test_parse_scale_and_percentile(self):
+        """
+        Ensures scale strings are parsed and nearest-rank percentiles are computed correctly.
+        :return: None
+        """
+        self.assertEqual(synthetic_data.parse_scale('1M'), 1_000_000)
+        self.assertEqual(synthetic_data.parse_scale('100k'), 100_000)
+        self.assertEqual(synthetic_data.parse_scale('2500'), 2500)
+        values = list(range(1, 101))
+        self.assertEqual(benchmark.percentile(values, 50), 50)
+        self.assertEqual(benchmark.percentile(values, 99), 99)
+        self.assertIsNone(benchmark.percentile([], 50))
+
+    def test_small_benchmark_run(self):
+        """
+        Ensures a small benchmark run completes without errors and restores the database settings.
+        :return: None
+        """
+        original_db_path = utility_library.DATABASE_PATH
+        results = benchmark.run_benchmark(scale='300', concurrency=4, num_requests=30)
+
+        self.assertEqual(results['api']['overall']['requests'], 30)
+        self.assertEqual(results['api']['overall']['errors'], 0)
+        self.assertIn('etl', results['pipeline_seconds'])
+        self.assertEqual(utility_library.DATABASE_PATH, original_db_path)
+
+
+class TestProfiling(unittest.TestCase):
+    """
+    Class to test stage-level profiling.
+    """
+
+    def setUp(self):
+        profiling.reset()
+
+    def tearDown(self):
+        profiling.reset()
+
+    def test_decorated_stage_records_rows_and_timings(self):
+        """
+        Ensures decorated stages record their calls, row counts from DataFrame results, and timings.
+        :return: None
+        """
+        @profiling.profile_stage('test.build_frame')
+        def build_frame(rows):
+            return pd.DataFrame({'value': range(rows)})
+
+        build_frame(5)
+        build_frame(7)
+        stage = profiling.get_run_summary()['stages']['test.build_frame']
+        self.assertEqual(stage['calls'], 2)
+        self.assertEqual(stage['rows'], 12)
+        self.assertGreaterEqual(stage['wall_seconds'], 0)
+        self.assertGreaterEqual(stage['cpu_seconds'], 0)
+
+    def test_context_manager_with_tracemalloc_writes_summary(self):
+        """
+        Ensures stages used as context managers record explicit row counts and traced memory, and the run summary is
+        written as JSON.
+        :return: None
+        """
+        with patch('settings.PROFILE_TRACEMALLOC', True):
+            with profiling.profile_stage('test.allocate'):
+                data = [0] * 100000
+                profiling.record_rows(len(data))
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            summary_path = os.path.join(temp_dir, 'summary.json')
+            profiling.write_run_summary(summary_path)
+            with open(summary_path) as summary_file:
+                summary = json.load(summary_file)
+
+        run = summary['runs'][0]
+        self.assertEqual(run['stage'], 'test.allocate')
+        self.assertEqual(run['rows'], 100000)
+        self.assertGreater(run['peak_traced_mb'], 0.5)
+        self.assertIn('process_peak_rss_mb', run)
+
+    def test_nested_stage_keeps_outer_peak(self):
+        """
+        Ensures a nested stage resetting the traced peak does not hide the outer stage's earlier peak, and that the
+        nested stage's peak counts toward the outer stage.
+        :return: None
+        """
+        with patch('settings.PROFILE_TRACEMALLOC', True):
+            with profiling.profile_stage('test.outer'):
+                data = [0] * 1000000
+                del data
+                with profiling.profile_stage('test.inner'):
+                    pass
+                with profiling.profile_stage('test.allocating_inner'):
+                    data = [0] * 500000
+                    del data
+
+        runs = {run['stage']: run for run in profiling.get_run_summary()['runs']}
+        self.assertGreater(runs['test.outer']['peak_traced_mb'], 7.0)
+        self.assertLess(runs['test.inner']['peak_traced_mb'], 1.0)
+        self.assertGreater(runs['test.allocating_inner']['peak_traced_mb'], 3.5)
+
+
+class TestQueryMonitoring(DatabaseTestCase):
+    """
+    Class to test query instrumentation in the utility library.
+    """
+
+    def setUp(self):
+        super().setUp()
+        utility_library.reset_query_stats()
+        self.addCleanup(utility_library.reset_query_stats)
+
+    def test_fingerprint_normalizes_literals_and_whitespace(self):
+        """
+        Ensures queries that only differ by literals and formatting share a fingerprint.
+        :return: None
+        """
+        first = utility_library.fingerprint_query("SELECT * FROM users WHERE user_id = 5 AND country = 'USA';")
+        second = utility_library.fingerprint_query("select *\n  from users\n where user_id = 17 and country = 'UK'")
+        self.assertEqual(first, second)
+        self.assertEqual(utility_library.fingerprint_query("SELECT 1 WHERE x IN (1, 2, 3)"),
+                         utility_library.fingerprint_query("SELECT 1 WHERE x IN (4,5)"))
+
+    def test_stats_are_aggregated_and_slow_plans_captured(self):
+        """
+        Ensures executions are aggregated per fingerprint and slow queries capture their query plan.
+        :return: None
+        """
+        query = "SELECT * FROM transactions WHERE user_id = ?;"
+        utility_library.query_db_for_api(query, (1,))
+        list(utility_library.iterate_db_for_api(query, (2,)))
+
+        stats = utility_library.get_query_stats()[0]
+        self.assertEqual(stats['calls'], 2)
+        self.assertEqual(stats['rows'], 7)
+        self.assertIsNone(stats['query_plan'])
+
+        with patch('settings.SLOW_QUERY_THRESHOLD_MS', 0):
+            utility_library.execute_custom_query("SELECT * FROM transactions WHERE amount > 50;")
+        slow_stats = [entry for entry in utility_library.get_query_stats() if 'amount' in entry['fingerprint']][0]
+        self.assertEqual(slow_stats['slow_calls'], 1)
+        self.assertTrue(any('SCAN' in detail for detail in slow_stats['query_plan']))
+
+
+class TestPipelineScheduler(DatabaseTestCase):
+    """
+    Class to test the pipeline stage scheduler.
+    """
+
+    def test_independent_readers_run_concurrently_and_writers_serialize(self):
+        """
+        Ensures independent read stages overlap while write stages never do.
+        :return: None
+        """
+        barrier = threading.Barrier(2, timeout=5)
+        active_writers = []
+        overlapping_writers = []
+
+        def writer():
+            active_writers.append(1)
+            overlapping_writers.append(len(active_writers))
+            time.sleep(0.01)
+            active_writers.pop()
+
+        stages = [
+            pipeline_scheduler.Stage('read_a', barrier.wait),
+            pipeline_scheduler.Stage('read_b', barrier.wait),
+            pipeline_scheduler.Stage('write_a', writer, depends_on=['read_a'], writes=True),
+            pipeline_scheduler.Stage('write_b', writer, depends_on=['read_b'], writes=True),
+        ]
+        statuses, _ = pipeline_scheduler.run_stages(stages, max_workers=4)
+
+        self.assertEqual(set(statuses.values()), {pipeline_scheduler.STAGE_COMPLETED})
+        self.assertEqual(overlapping_writers, [1, 1])
+
+    def test_unchanged_inputs_are_skipped(self):
+        """
+        Ensures a stage is skipped when its input fingerprint matches its last successful run.
+        :return: None
+        """
+        calls = []
+        stage = pipeline_scheduler.Stage('count', lambda: calls.append(1),
+                                         inputs=lambda: pipeline_scheduler.table_fingerprint('transactions'))
+        pipeline_scheduler.run_stages([stage], skip_unchanged=True)
+        statuses, _ = pipeline_scheduler.run_stages([stage], skip_unchanged=True)
+        self.assertEqual(statuses['count'], pipeline_scheduler.STAGE_SKIPPED)
+
+        utility_library.bump_table_version('transactions')
+        statuses, _ = pipeline_scheduler.run_stages([stage], skip_unchanged=True)
+        self.assertEqual(statuses['count'], pipeline_scheduler.STAGE_COMPLETED)
+        self.assertEqual(len(calls), 2)
+
+    def test_failed_stage_blocks_dependents(self):
+        """
+        Ensures dependents of a failed stage do not run and the failure is raised.
+        :return: None
+        """
+        calls = []
+
+        def fail():
+            raise ValueError('boom')
+
+        stages = [
+            pipeline_scheduler.Stage('fail', fail),
+            pipeline_scheduler.Stage('dependent', lambda: calls.append(1), depends_on=['fail']),
+        ]
+        with self.assertRaises(RuntimeError):
+            pipeline_scheduler.run_stages(stages)
+        self.assertEqual(calls, [])
+
+        with self.assertRaises(ValueError):
+            pipeline_scheduler.run_stages([pipeline_scheduler.Stage('a', fail, depends_on=['a'])])
+
+    def test_failed_import_is_not_recorded(self):
+        """
+        Ensures a CSV import that fails is not recorded as the last successful run, so it is imported again.
+        :return: None
+        """
+        generated = synthetic_data.generate_synthetic_data(self.temp_dir.name, 50, 10)
+        with patch.multiple('import_raw_to_db', DATABASE_PATH=self.db_path, USERS_PATH=generated['users_path'],
+                            TRANSACTIONS_PATH=generated['transactions_path']):
+            with patch('import_raw_to_db.insert_users', side_effect=sqlite3.OperationalError('disk I/O error')):
+                with self.assertRaises(RuntimeError):
+                    import_raw_to_db.data_import_executive()
+            self.assertIsNone(utility_library.get_metadata('stage_inputs:load_users_to_db'))
+            self.assertIsNotNone(utility_library.get_metadata('stage_inputs:load_transactions_to_db'))
+
+            import_raw_to_db.data_import_executive()
+            self.assertIsNotNone(utility_library.get_metadata('stage_inputs:load_users_to_db'))
+
+
+class TestIngestDaemon(DatabaseTestCase):
+    """
+    Class to test micro-batch ingestion from the spool directory.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.spool_dir = os.path.join(self.temp_dir.name, 'spool')
+        os.makedirs(self.spool_dir)
+        etl.fused_etl_scan()
+
+    def patch_targets(self):
+        patches = [patch(f'{module}.DATABASE_PATH', self.db_path)
+                   for module in ('etl', 'utility_library', 'ingest_daemon')]
+        return patches + [patch('settings.WRITE_ANALYTIC_SNAPSHOT', False)]
+
+    def read_etl_outputs(self):
+        conn = sqlite3.connect(self.db_path)
+        outputs = (
+            conn.execute("SELECT user_id, total_transaction_amount, total_withdrawal FROM users ORDER BY user_id;")
+            .fetchall(),
+            conn.execute("SELECT * FROM user_volume_rankings ORDER BY user_id;").fetchall(),
+            conn.execute("SELECT * FROM daily_transaction_totals ORDER BY transaction_date, transaction_type;")
+            .fetchall(),
+        )
+        conn.close()
+        return outputs
+
+    def test_micro_batch_matches_full_recompute(self):
+        """
+        Ensures a micro-batch with new users, new transactions, and a replaced transaction produces the same ETL outputs
+        as a full ETL scan, that ingested files are moved out of the spool directory, and that the daemon refuses to run
+        on sharded storage.
+        :return: None
+        """
+        pd.DataFrame({'user_id': [4], 'signup_date': ['2024-03-01'], 'country': ['Japan']}).to_csv(
+            os.path.join(self.spool_dir, 'users_batch.csv'), index=False)
+        pd.DataFrame({
+            'transaction_id': [1, 8, 9],
+            'user_id': [3, 4, 4],
+            'transaction_date': ['2024-03-01', '2024-03-04', '2024-03-04'],
+            'amount': [80.0, 30.0, 20.0],
+            'transaction_type': ['deposit', 'withdrawal', 'withdrawal'],
+        }).to_csv(os.path.join(self.spool_dir, 'transactions_batch.csv'), index=False)
+
+        self.assertEqual(ingest_daemon.ingest_micro_batch(self.spool_dir), 2)
+        incremental_outputs = self.read_etl_outputs()
+        etl.fused_etl_scan()
+
+        self.assertEqual(incremental_outputs, self.read_etl_outputs())
+        self.assertEqual(os.listdir(self.spool_dir), ['processed'])
+        self.assertEqual(ingest_daemon.ingest_micro_batch(self.spool_dir), 0)
+
+        with patch('settings.SHARD_COUNT', 2):
+            with self.assertRaises(RuntimeError):
+                ingest_daemon.start_ingest_daemon_thread()
+            with self.assertRaises(RuntimeError):
+                ingest_daemon.ingest_micro_batch(self.spool_dir)
+
+    def test_user_left_without_transactions(self):
+        """
+        Ensures a user whose transactions are all replaced onto another user gets zero totals and leaves the rankings,
+        while the ranks of the other users match a full ETL scan.
+        :return: None
+        """
+        pd.DataFrame({
+            'transaction_id': [1, 2, 6],
+            'user_id': [3, 3, 3],
+            'transaction_date': ['2024-03-01', '2024-03-01', '2024-03-02'],
+            'amount': [100.0, 25.0, 5.0],
+            'transaction_type': ['deposit', 'purchase', 'purchase'],
+        }).to_csv(os.path.join(self.spool_dir, 'transactions_batch.csv'), index=False)
+
+        self.assertEqual(ingest_daemon.ingest_micro_batch(self.spool_dir), 1)
+        users, rankings, daily_totals = self.read_etl_outputs()
+        self.assertEqual(users[0], (1, 0.0, 0.0))
+        self.assertEqual([row[0] for row in rankings], [2, 3])
+        etl.fused_etl_scan()
+        self.assertEqual((rankings, daily_totals), self.read_etl_outputs()[1:])
+
+
+class TestBackgroundRefresh(unittest.TestCase):
+    """
+    Class to test the background refresh that builds data in a separate process and swaps it in.
+    """
+
+    def test_refresh_swaps_in_new_data_once(self):
+        """
+        Ensures a refresh builds the live database and snapshot from the CSV files, removes its build files, and swaps
+        nothing on a second refresh when the CSV files did not change.
+        :return: None
+        """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            generated = synthetic_data.generate_synthetic_data(temp_dir, 200, 20)
+            users_path, transactions_path = generated['users_path'], generated['transactions_path']
+            db_path = os.path.join(temp_dir, 'live.db')
+            snapshot_path = os.path.join(temp_dir, 'live_snapshot.bin')
+
+            with patch('settings.USER_CSV_PATH', users_path), \
+                    patch('settings.TRANSACTIONS_CSV_PATH', transactions_path):
+                self.assertTrue(background_refresh.refresh_database(db_path, snapshot_path))
+                conn = sqlite3.connect(db_path)
+                self.assertEqual(conn.execute("SELECT COUNT(*) FROM user_volume_rankings;").fetchone()[0], 20)
+                conn.close()
+                self.assertTrue(os.path.exists(snapshot_path))
+                self.assertFalse(any(name.endswith('.building') for name in os.listdir(temp_dir)))
+
+                self.assertFalse(background_refresh.refresh_database(db_path, snapshot_path))
+
+    def test_refuses_sharded_storage(self):
+        """
+        Ensures the refresh refuses to run on sharded storage instead of swapping in only the main database.
+        :return: None
+        """
+        with tempfile.TemporaryDirectory() as temp_dir, patch('settings.SHARD_COUNT', 2):
+            db_path = os.path.join(temp_dir, 'live.db')
+            with self.assertRaises(RuntimeError):
+                background_refresh.refresh_database(db_path, os.path.join(temp_dir, 'live_snapshot.bin'))
+            with self.assertRaises(RuntimeError):
+                background_refresh.start_background_refresh()
+            self.assertEqual(os.listdir(temp_dir), [])
+
+
+class TestSharding(DatabaseTestCase):
+    """
+    Class to test sharded storage by user_id against a single database loaded with the same data.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.client = flask_api.app.test_client()
+
+    def create_database(self):
+        # Each test loads its own databases from synthetic CSV files.
+        generated = synthetic_data.generate_synthetic_data(self.temp_dir.name, 300, 30)
+        self.users_path, self.transactions_path = generated['users_path'], generated['transactions_path']
+
+    def patch_targets(self):
+        return [
+            patch('import_raw_to_db.USERS_PATH', self.users_path),
+            patch('import_raw_to_db.TRANSACTIONS_PATH', self.transactions_path),
+            patch('settings.WRITE_ANALYTIC_SNAPSHOT', False),
+            patch('settings.SERVE_FROM_ANALYTIC_SNAPSHOT', False),
+            patch('settings.DATA_VERSION_CACHE_SECONDS', 0),
+        ]
+
+    def run_pipeline(self, db_name, shard_count):
+        """
+        Loads the synthetic data and runs the ETL, then answers API requests against the result.
+        :return: Tuple of (database path, dictionary of URL path to JSON response)
+        """
+        db_path = os.path.join(self.temp_dir.name, db_name)
+        transaction_date = pd.read_csv(self.transactions_path)['transaction_date'].iloc[0]
+        paths = ['/api/top_users', f'/api/daily_transactions?date={transaction_date}'] + \
+                [f'/api/user_transaction_summary?user_id={user_id}' for user_id in (1, 2, 3, 17)]
+        with patch('settings.SHARD_COUNT', shard_count), \
+                patch.multiple('import_raw_to_db', DATABASE_PATH=db_path), \
+                patch.multiple('etl', DATABASE_PATH=db_path), \
+                patch.multiple('utility_library', DATABASE_PATH=db_path):
+            import_raw_to_db.data_import_executive()
+            etl.etl_executive()
+            return db_path, {path: self.client.get(path).get_json() for path in paths}
+
+    def test_sharded_results_match_single_database(self):
+        """
+        Ensures every user lives in the shard its user_id routes to, and that routed and scatter-gather API responses
+        over three shards match the responses of a single database.
+        :return: None
+        """
+        _, single_responses = self.run_pipeline('single.db', 1)
+        db_path, sharded_responses = self.run_pipeline('sharded.db', 3)
+
+        with patch('settings.SHARD_COUNT', 3):
+            paths = sharding.shard_paths(db_path)
+        for index, path in enumerate(paths):
+            conn = sqlite3.connect(path)
+            user_ids = [row[0] for row in conn.execute("SELECT user_id FROM transactions;")]
+            conn.close()
+            self.assertTrue(user_ids)
+            self.assertTrue(all(user_id % 3 == index for user_id in user_ids))
+
+        for path, expected in single_responses.items():
+            actual = sharded_responses[path]
+            if path == '/api/top_users':
+                self.assertEqual(sorted(row['transaction_count'] for row in actual),
+                                 sorted(row['transaction_count'] for row in expected))
+                continue
+            self.assertIsInstance(actual, list)
+            self.assertEqual(len(actual), len(expected))
+            for actual_row, expected_row in zip(actual, expected):
+                self.assertEqual(actual_row.keys(), expected_row.keys())
+                for key, value in expected_row.items():
+                    if isinstance(value, float):
+                        self.assertAlmostEqual(actual_row[key], value, places=6)
+                    else:
+                        self.assertEqual(actual_row[key], value)
+
+
+class TestPartitions(DatabaseTestCase):
+    """
+    Class to test monthly partitions of the transactions table.
+    """
+
+    def setUp(self):
+        super().setUp()
+        import_raw_to_db.create_db_schemas(self.db_path)
+        self.client = flask_api.app.test_client()
+
+    def patch_targets(self):
+        return super().patch_targets() + [patch('settings.PARTITION_TRANSACTIONS_BY_MONTH', True),
+                                          patch('settings.SERVE_FROM_ANALYTIC_SNAPSHOT', False),
+                                          patch('settings.DATA_VERSION_CACHE_SECONDS', 0)]
+
+    def test_partition_routing_and_drop(self):
+        """
+        Ensures an existing transactions table is migrated to partitions, new rows are routed to the partition of their
+        month, a replaced transaction moves between partitions, dropping a month removes its rows from the view and
+        the daily endpoint, and deleting the transactions table drops the view and every partition.
+        :return: None
+        """
+        conn = sqlite3.connect(self.db_path)
+        self.assertEqual(partitions.list_partitions(conn), ['transactions_2024_03'])
+        import_raw_to_db.insert_transactions(conn, pd.DataFrame({
+            'transaction_id': [1, 8],
+            'user_id': [1, 3],
+            'transaction_date': ['2024-04-01', '2024-4-2'],
+            'amount': [70.0, 20.0],
+            'transaction_type': ['deposit', 'purchase'],
+        }))
+        conn.commit()
+        self.assertEqual(partitions.list_partitions(conn), ['transactions_2024_03', 'transactions_2024_04'])
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM transactions;").fetchone()[0], 8)
+        self.assertEqual(conn.execute("SELECT transaction_date FROM transactions_2024_04 ORDER BY 1;").fetchall(),
+                         [('2024-04-01',), ('2024-04-02',)])
+        conn.close()
+
+        response = self.client.get('/api/daily_transactions?date=2024-03-01')
+        self.assertEqual([row['transaction_type'] for row in response.get_json()], ['purchase', 'withdrawal'])
+
+        self.assertTrue(partitions.drop_month('2024-03'))
+        self.assertFalse(partitions.drop_month('2024-03'))
+        conn = sqlite3.connect(self.db_path)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM transactions;").fetchone()[0], 2)
+        conn.close()
+        self.assertEqual(self.client.get('/api/daily_transactions?date=2024-03-01').status_code, 404)
+        self.assertEqual(self.client.get('/api/daily_transactions?date=2024-04-01').status_code, 200)
+
+        import_raw_to_db.delete_table(self.db_path, 'transactions')
+        conn = sqlite3.connect(self.db_path)
+        self.assertEqual(conn.execute("SELECT name FROM sqlite_master WHERE name LIKE 'transactions%';").fetchall(), [])
+        conn.close()
+
+
+class TestApproximateAnalytics(DatabaseTestCase):
+    """
+    Class to test the streaming sketches and the approximate analytics endpoints.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.client = flask_api.app.test_client()
+
+    def patch_targets(self):
+        return super().patch_targets() + [patch('settings.ENABLE_APPROXIMATE_ANALYTICS', True),
+                                          patch('settings.DATA_VERSION_CACHE_SECONDS', 0)]
+
+    def test_sketch_accuracy(self):
+        """
+        Ensures the sketches stay within their expected error on larger data and survive serialization.
+        :return: None
+        """
+        rng = np.random.default_rng(0)
+        hll = sketches.HyperLogLog(12)
+        hll.update(rng.integers(0, 10 ** 12, 50000))
+        hll = sketches.HyperLogLog.from_bytes(hll.to_bytes())
+        self.assertLess(abs(hll.count() / 50000 - 1), 0.06)
+
+        amounts = rng.lognormal(5, 1, 100000)
+        digest = sketches.TDigest(100)
+        for chunk in np.array_split(amounts, 10):
+            digest.update(chunk)
+        digest = sketches.TDigest.from_bytes(digest.to_bytes())
+        for q in (0.1, 0.5, 0.9):
+            self.assertAlmostEqual(digest.quantile(q) / np.quantile(amounts, q), 1, delta=0.02)
+
+        top_users = sketches.SpaceSaving(20)
+        top_users.update({user_id: 1000 - user_id for user_id in range(100)})
+        self.assertEqual([user_id for user_id, _, _ in top_users.top(3)], [0, 1, 2])
+
+    def test_sketches_maintained_during_ingest(self):
+        """
+        Ensures rebuilt sketches answer the approx endpoints, newly ingested transactions are added, and re-ingested
+        transaction IDs are not counted twice.
+        :return: None
+        """
+        sketches.rebuild_sketches()
+        response = self.client.get('/api/approx/top_users?k=2')
+        self.assertEqual([(row['user_id'], row['estimated_transaction_count']) for row in response.get_json()],
+                         [(2, 4), (1, 3)])
+        response = self.client.get('/api/approx/active_users?date=2024-03-01')
+        self.assertEqual(response.get_json()['estimated_active_users'], 2)
+
+        batch = pd.DataFrame({
+            'transaction_id': [7, 8, 9],
+            'user_id': [2, 3, 3],
+            'transaction_date': ['2024-03-03', '2024-03-03', '2024-03-04'],
+            'amount': [15.0, 50.0, 70.0],
+            'transaction_type': ['withdrawal', 'deposit', 'deposit'],
+        })
+        for _ in range(2):
+            conn = sqlite3.connect(self.db_path)
+            import_raw_to_db.insert_transactions(conn, batch)
+            conn.commit()
+            conn.close()
+
+        response = self.client.get('/api/approx/top_users?k=3')
+        self.assertEqual([(row['user_id'], row['estimated_transaction_count']) for row in response.get_json()],
+                         [(2, 4), (1, 3), (3, 2)])
+        response = self.client.get('/api/approx/active_users?date=2024-03-03')
+        self.assertEqual(response.get_json()['estimated_active_users'], 2)
+        response = self.client.get('/api/approx/amount_percentiles?transaction_type=deposit&q=0,1')
+        self.assertEqual(response.get_json()['transaction_count'], 4)
+        self.assertEqual(response.get_json()['percentiles'], {'0.0': 50.0, '1.0': 100.0})
+
+        self.assertEqual(self.client.get('/api/approx/amount_percentiles?transaction_type=deposit&q=2').status_code,
+                         400)
+        with patch('settings.ENABLE_APPROXIMATE_ANALYTICS', False):
+            self.assertEqual(self.client.get('/api/approx/top_users').status_code, 404)
+
+
+class TestRollingTotals(DatabaseTestCase):
+    """
+    Class to test rolling-window totals answered from the prefix sum tables.
+    """
+
+    def setUp(self):
+        super().setUp()
+        etl.fused_etl_scan()
+        etl.build_prefix_sums()
+        self.client = flask_api.app.test_client()
+
+    def patch_targets(self):
+        return super().patch_targets() + [patch('etl.DATABASE_PATH', self.db_path),
+                                          patch('settings.DATA_VERSION_CACHE_SECONDS', 0)]
+
+    def range_scan_total(self, start, end, transaction_type, user_id):
+        query = "SELECT COALESCE(SUM(amount), 0) FROM transactions WHERE transaction_date > ? AND transaction_date <= ?"
+        params = [start, end]
+        if transaction_type != 'all':
+            query += " AND transaction_type = ?"
+            params.append(transaction_type)
+        if user_id is not None:
+            query += " AND user_id = ?"
+            params.append(user_id)
+        conn = sqlite3.connect(self.db_path)
+        total = conn.execute(query, params).fetchone()[0]
+        conn.close()
+        return total
+
+    def test_rolling_totals_match_range_scans(self):
+        """
+        Ensures window totals and moving averages match range scans over the transactions table, for global and per-user
+        series, inside and outside the range of transaction dates.
+        :return: None
+        """
+        from datetime import date, timedelta
+
+        for transaction_type, user_id in (('all', None), ('purchase', None), ('all', 2), ('deposit', 1)):
+            url = f'/api/rolling_totals?start=2024-02-28&end=2024-03-06&window=2&transaction_type={transaction_type}'
+            if user_id is not None:
+                url += f'&user_id={user_id}'
+            rows = self.client.get(url).get_json()
+            self.assertEqual(len(rows), 8)
+            for row in rows:
+                day = date.fromisoformat(row['date'])
+                expected = self.range_scan_total((day - timedelta(days=2)).isoformat(), row['date'], transaction_type,
+                                                 user_id)
+                self.assertAlmostEqual(row['window_total'], expected)
+                self.assertAlmostEqual(row['moving_average'], expected / 2)
+
+        self.assertEqual(self.client.get('/api/rolling_totals?start=2024-03-02&end=2024-03-01').status_code, 400)
+        self.assertEqual(self.client.get('/api/rolling_totals?start=2023-01-10&end=2023-01-12&window=99999999')
+                         .status_code, 400)
+        rows = self.client.get('/api/rolling_totals?start=0001-01-02&end=0001-01-03&window=5').get_json()
+        self.assertEqual([row['window_total'] for row in rows], [0.0, 0.0])
+
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("DROP TABLE daily_prefix_sums;")
+        conn.close()
+        self.assertEqual(self.client.get('/api/rolling_totals?start=2024-03-01&end=2024-03-02').status_code, 404)
+
+
+class TestCommandLine(unittest.TestCase):
+    """
+    Class to test the command line entry point in main.py.
+    """
+
+    def test_commands_are_routed(self):
+        """
+        Ensures each subcommand runs its function, and that only the bench command accepts unknown arguments.
+        :return: None
+        """
+        with patch('main.log_global_settings'), patch('import_raw_to_db.data_import_executive') as ingest, \
+                patch('etl.etl_executive') as run_etl, patch('benchmark.main') as bench:
+            main.main(['ingest'])
+            main.main(['etl'])
+            main.main(['bench', '--scale', '1k', '--http'])
+        ingest.assert_called_once()
+        run_etl.assert_called_once()
+        bench.assert_called_once_with(['--scale', '1k', '--http'])
+
+        with patch('sys.stderr'), self.assertRaises(SystemExit):
+            main.main(['etl', '--scale', '1k'])
+
+    def test_startup_is_lazy(self):
+        """
+        Ensures importing main does not import Flask or pandas, and that importing modules does not create a log file.
+        :return: None
+        """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+            script = 'import sys, main; print(sorted({"flask", "flask_api", "pandas"} & set(sys.modules)))'
+            output = subprocess.run([sys.executable, '-c', script], cwd=temp_dir, env=env, capture_output=True,
+                                    text=True, check=True).stdout
+            self.assertEqual(output.strip(), '[]')
+
+            subprocess.run([sys.executable, '-c', 'import etl, flask_api'], cwd=temp_dir, env=env, check=True)
+            self.assertFalse(os.path.exists(os.path.join(temp_dir, 'logs')))
+
+
+class TestRollupCube(DatabaseTestCase):
+    """
+    Class to test rollups answered from the rollup cube against GROUP BYs over the transactions table.
+    """
+
+    def setUp(self):
+        super().setUp()
+        rollup_cube.build_rollup_cube()
+        self.client = flask_api.app.test_client()
+
+    def patch_targets(self):
+        return super().patch_targets() + [patch('settings.DATA_VERSION_CACHE_SECONDS', 0)]
+
+    def group_by(self, dimensions, where='', params=()):
+        """Returns the rows of a GROUP BY over the transactions table, shaped like the rollup rows."""
+        columns = {'country': 'u.country', 'signup_month': 'substr(u.signup_date, 1, 7)',
+                   'transaction_type': 't.transaction_type', 'transaction_date': 't.transaction_date'}
+        select = ''.join(f'{columns[name]} AS {name}, ' for name in dimensions)
+        group = f'GROUP BY {", ".join(columns[name] for name in dimensions)}' if dimensions else ''
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        rows = conn.execute(f"""
+            SELECT {select}SUM(t.amount) AS total_amount, COUNT(*) AS transaction_count
+            FROM transactions t JOIN users u ON t.user_id = u.user_id {where} {group};
+        """, params).fetchall()
+        conn.close()
+        return sorted(tuple(row) for row in rows)
+
+    def rollup_rows(self, url):
+        """Returns the rows of a rollup request as tuples of the dimensions, total, and count."""
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return sorted(tuple(value for key, value in row.items() if key != 'average_amount')
+                      for row in response.get_json())
+
+    def test_rollups_match_group_by(self):
+        """
+        Ensures rollups over subsets of the dimensions, with and without filters, match GROUP BYs over the transactions.
+        :return: None
+        """
+        for dimensions in ((), ('country',), ('signup_month', 'transaction_type'), rollup_cube.CUBE_DIMENSIONS):
+            rows = self.rollup_rows(f'/api/rollup?dimensions={",".join(dimensions)}')
+            self.assertEqual(rows, self.group_by(dimensions))
+
+        rows = self.rollup_rows('/api/rollup?dimensions=transaction_date&country=Canada&start=2024-03-02')
+        self.assertEqual(rows, self.group_by(('transaction_date',), "WHERE u.country = ? AND t.transaction_date >= ?",
+                                             ('Canada', '2024-03-02')))
+
+        row = self.client.get('/api/rollup?transaction_type=purchase').get_json()[0]
+        self.assertAlmostEqual(row['average_amount'], 40.0 / 3)
+        self.assertEqual(self.client.get('/api/rollup?dimensions=user_id').status_code, 400)
+        self.assertEqual(self.client.get('/api/rollup?country=France').status_code, 404)
+
+        conn = sqlite3.connect(self.db_path)
+        conn.execute(f"DROP TABLE {rollup_cube.CUBE_TABLE};")
+        conn.close()
+        self.assertEqual(self.client.get('/api/rollup').status_code, 404)
+
+    def test_incremental_update_matches_rebuild(self):
+        """
+        Ensures updating the cube for the days and users changed by a batch matches a full rebuild, including a user
+        moving to another country.
+        :return: None
+        """
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("UPDATE users SET country = 'UK' WHERE user_id = 1;")
+        conn.execute("INSERT INTO transactions VALUES (8, 3, '2024-03-04', 70.0, 'deposit');")
+        conn.commit()
+        conn.close()
+
+        rollup_cube.update_rollup_cube([1], ['2024-03-04'])
+        rows = self.rollup_rows(f'/api/rollup?dimensions={",".join(rollup_cube.CUBE_DIMENSIONS)}')
+        self.assertEqual(rows, self.group_by(rollup_cube.CUBE_DIMENSIONS))
+
+
+class TestExport(DatabaseTestCase):
+    """
+    Class to test bulk exports of the ETL outputs.
+    """
+
+    def setUp(self):
+        super().setUp()
+        etl.fused_etl_scan()
+        self.client = flask_api.app.test_client()
+
+    def patch_targets(self):
+        return super().patch_targets() + [patch('etl.DATABASE_PATH', self.db_path),
+                                          patch('settings.DATA_VERSION_CACHE_SECONDS', 0),
+                                          patch('settings.EXPORT_CHUNK_ROWS', 2)]
+
+    def test_csv_export(self):
+        """
+        Ensures the CSV export endpoint streams every row in chunks, applies the date filter, and rejects bad requests.
+        :return: None
+        """
+        chunks = list(export.generate_export('daily_aggregates'))
+        self.assertEqual(len(chunks), 3)
+
+        response = self.client.get('/api/export/daily_aggregates?start=2024-03-02')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/csv')
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual(lines[0], 'transaction_date,transaction_type,daily_total,transaction_count')
+        self.assertEqual(lines[1:], ['2024-03-02,deposit,60.0,1', '2024-03-02,purchase,15.0,2',
+                                     '2024-03-03,withdrawal,15.0,1'])
+
+        users = pd.read_csv(io.BytesIO(self.client.get('/api/export/user_summary').get_data()))
+        self.assertEqual(users['user_id'].tolist(), [1, 2, 3])
+        self.assertEqual(users['total_transaction_amount'].tolist(), [130.0, 125.0, 0.0])
+
+        self.assertEqual(self.client.get('/api/export/transactions').status_code, 404)
+        self.assertEqual(self.client.get('/api/export/user_summary?format=xlsx').status_code, 400)
+        self.assertEqual(self.client.get('/api/export/user_summary?end=March').status_code, 400)
+
+    @unittest.skipUnless(export.parquet_available(), 'pyarrow is not installed')
+    def test_parquet_export(self):
+        """
+        Ensures Parquet exports hold one row group per chunk, the same rows as the CSV export, and a typed schema when
+        no rows match.
+        :return: None
+        """
+        import pyarrow.parquet as pq
+
+        output_path = export.export_to_file('daily_aggregates', 'parquet',
+                                            os.path.join(self.temp_dir.name, 'exports', 'daily.parquet'))
+        self.assertEqual(pq.ParquetFile(output_path).metadata.num_row_groups, 3)
+        csv_rows = pd.read_csv(io.BytesIO(b''.join(export.generate_export('daily_aggregates'))))
+        pd.testing.assert_frame_equal(pq.read_table(output_path).to_pandas(), csv_rows)
+
+        response = self.client.get('/api/export/daily_aggregates?format=parquet&start=2030-01-01')
+        table = pq.read_table(io.BytesIO(response.get_data()))
+        self.assertEqual(table.num_rows, 0)
+        self.assertEqual(str(table.schema.field('daily_total').type), 'double')
+
+
+class TestSyntheticData(unittest.TestCase):
+    """
+    Class to test the synthetic data generator.
+    """
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def generate(self, name, **kwargs):
+        """Generates 5000 transactions for 500 users in chunks of 1000 rows into a subdirectory."""
+        return synthetic_data.generate_synthetic_data(os.path.join(self.temp_dir.name, name), 5000, 500,
+                                                      chunk_rows=1000, **kwargs)
+
+    def test_bad_rows_and_duplicates_match_cleaners(self):
+        """
+        Ensures the cleaners keep exactly the rows the generator reports as clean, that every rule is represented, and
+        that the same seed produces the same files.
+        :return: None
+        """
+        rates = {rule: 0.02 for rule in synthetic_data.USER_RULES + synthetic_data.TRANSACTION_RULES}
+        generated = self.generate('bad', seed=7, bad_row_rates=rates, duplicate_rate=0.01)
+        for name in ('users', 'transactions'):
+            self.assertTrue(all(generated[name][rule] > 0 for rule in generated[name] if rule != 'clean_rows'))
+
+        users = import_raw_to_db.clean_users_data(pd.read_csv(generated['users_path']))
+        transactions = import_raw_to_db.clean_transactions_data(pd.read_csv(generated['transactions_path']))
+        self.assertEqual(len(users), generated['users']['clean_rows'])
+        self.assertEqual(len(transactions), generated['transactions']['clean_rows'])
+
+        repeated = self.generate('repeated', seed=7, bad_row_rates=rates, duplicate_rate=0.01)
+        with open(generated['transactions_path'], 'rb') as first, open(repeated['transactions_path'], 'rb') as second:
+            self.assertEqual(first.read(), second.read())
+
+    def test_user_skew(self):
+        """
+        Ensures a user skew concentrates transactions on a few heavy users spread over the ID range, and that the
+        default is close to uniform.
+        :return: None
+        """
+        skewed = pd.read_csv(self.generate('skewed', user_skew=1.2)['transactions_path'])['user_id'].value_counts()
+        uniform = pd.read_csv(self.generate('uniform')['transactions_path'])['user_id'].value_counts()
+        self.assertGreater(skewed.head(5).sum() / skewed.sum(), 0.3)
+        self.assertLess(uniform.head(5).sum() / uniform.sum(), 0.05)
+        self.assertGreater(skewed.head(5).index.max(), 100)
+        self.assertTrue(skewed.index.isin(range(1, 501)).all())
+
+
+
+class TestRiskScoring(DatabaseTestCase):
+    """
+    Class to test the user risk scores against statistics computed from scratch over the daily totals.
+    """
+
+    def setUp(self):
+        super().setUp()
+        # Ten days of deposits for user 3, so the user has enough history to be scored.
+        self.insert_transactions([(100 + day, 3, f'2024-03-{day:02d}', 40.0 + 5 * (day % 3), 'deposit')
+                                  for day in range(1, 11)])
+        self.client = flask_api.app.test_client()
+
+    def patch_targets(self):
+        return super().patch_targets() + [patch('settings.DATA_VERSION_CACHE_SECONDS', 0)]
+
+    def insert_transactions(self, rows):
+        """Inserts or replaces transactions in the test database."""
+        conn = sqlite3.connect(self.db_path)
+        conn.executemany("INSERT OR REPLACE INTO transactions VALUES (?, ?, ?, ?, ?);", rows)
+        conn.commit()
+        conn.close()
+
+    def risk_rows(self, db_path):
+        """Returns the user_risk rows of a database, keyed by user_id."""
+        conn = sqlite3.connect(db_path)
+        conn.row_factory = sqlite3.Row
+        rows = {row['user_id']: dict(row) for row in conn.execute("SELECT * FROM user_risk;")}
+        conn.close()
+        return rows
+
+    def test_incremental_update_matches_rebuild(self):
+        """
+        Ensures folding inserted, replaced, and deleted transactions into the accumulators matches scores built from
+        scratch, and that the accumulators hold the mean and variance of each user's daily amounts.
+        :return: None
+        """
+        risk_scoring.update_user_risk()
+        self.insert_transactions([(1, 1, '2024-03-01', 80.0, 'deposit'), (8, 1, '2024-03-05', 30.0, 'purchase'),
+                                  (9, 3, '2024-03-11', 400.0, 'deposit')])
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("DELETE FROM transactions WHERE transaction_id = 7;")
+        conn.commit()
+        conn.close()
+        updated = risk_scoring.update_user_risk([1, 2, 3], ['2024-03-01', '2024-03-03', '2024-03-05', '2024-03-11'])
+        self.assertEqual(updated, 3)
+        self.assertEqual(risk_scoring.update_user_risk([1, 2, 3], ['2024-03-01']), 0)
+
+        rebuilt_path = os.path.join(self.temp_dir.name, 'rebuilt.db')
+        create_test_database(rebuilt_path)
+        conn = sqlite3.connect(rebuilt_path)
+        conn.execute("DELETE FROM transactions;")
+        conn.execute(f"ATTACH DATABASE '{self.db_path}' AS source;")
+        conn.execute("INSERT INTO transactions SELECT * FROM source.transactions;")
+        conn.commit()
+        conn.close()
+        risk_scoring.update_user_risk(db_path=rebuilt_path)
+
+        incremental, rebuilt = self.risk_rows(self.db_path), self.risk_rows(rebuilt_path)
+        self.assertEqual(incremental.keys(), rebuilt.keys())
+        for user_id, row in incremental.items():
+            for column, value in row.items():
+                if isinstance(value, float):
+                    self.assertAlmostEqual(value, rebuilt[user_id][column], places=6)
+                else:
+                    self.assertEqual(value, rebuilt[user_id][column])
+
+        conn = sqlite3.connect(self.db_path)
+        daily = pd.read_sql_query("""
+            SELECT user_id, transaction_date, SUM(amount) AS daily_amount FROM transactions
+            GROUP BY user_id, transaction_date;
+        """, conn)
+        conn.close()
+        for user_id, amounts in daily.groupby('user_id')['daily_amount']:
+            self.assertEqual(incremental[user_id]['day_count'], len(amounts))
+            self.assertAlmostEqual(incremental[user_id]['mean_daily_amount'], amounts.mean())
+            self.assertAlmostEqual(incremental[user_id]['m2_daily_amount'], np.var(amounts) * len(amounts))
+
+        history = daily[daily['user_id'] == 3]['daily_amount'].iloc[:-1]
+        self.assertAlmostEqual(incremental[3]['amount_z_score'], (400.0 - history.mean()) / history.std())
+        self.assertEqual(incremental[1]['amount_z_score'], 0.0)  # Not enough history.
+
+    def test_withdrawal_bursts_and_top_anomalies(self):
+        """
+        Ensures withdrawal bursts are counted in the window ending on the user's latest day, so later activity clears an
+        old burst, and that the endpoint ranks users by risk score.
+        :return: None
+        """
+        self.assertEqual(self.client.get('/api/top_anomalies').status_code, 404)
+        self.insert_transactions([(10 + i, 1, date, 20.0, 'withdrawal') for i, date in enumerate(
+            ['2024-03-03', '2024-03-03', '2024-03-04', '2024-03-05', '2024-03-05', '2024-03-05'])])
+        risk_scoring.update_user_risk()
+
+        response = self.client.get('/api/top_anomalies?k=2')
+        self.assertEqual(response.status_code, 200)
+        rows = response.get_json()
+        self.assertEqual([row['user_id'] for row in rows], [1, 2])
+        self.assertEqual(rows[0]['withdrawal_burst'], 6)
+        self.assertAlmostEqual(rows[0]['risk_score'], 6 / 5)
+        self.assertEqual(rows[1]['withdrawal_burst'], 2)
+        self.assertEqual(self.client.get('/api/top_anomalies?k=0').status_code, 400)
+
+        self.insert_transactions([(20, 1, '2024-03-09', 20.0, 'withdrawal')])
+        risk_scoring.update_user_risk([1], ['2024-03-09'])
+        rows = self.client.get('/api/top_anomalies?k=2').get_json()
+        self.assertEqual([(row['user_id'], row['withdrawal_burst']) for row in rows], [(2, 2), (1, 1)])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -2,14 +2,125 @@
 Utility library for reusable code.
 """
 
+import heapq
+import re
 import sqlite3
-import pandas as pd
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 import settings
 import logs
+import profiling
+import sharding
 
 DATABASE_PATH = settings.DB_PATH
 
+# Modules that bind settings.DB_PATH to a module level DATABASE_PATH when they are imported.
+DATABASE_PATH_MODULES = ('utility_library', 'import_raw_to_db', 'etl', 'flask_api', 'ingest_daemon')
+
+_query_stats = {}
+_query_stats_lock = threading.Lock()
+
+
+def set_database_path(db_path):
+    """
+    Points the application at a different SQLite database file. Modules copy settings.DB_PATH into DATABASE_PATH when
+    they are imported, so the new path is applied to every loaded module as well as to the settings.
+    :param db_path: Path to the SQLite database file.
+    :return: None
+    """
+    settings.DB_PATH = db_path
+    for module_name in DATABASE_PATH_MODULES:
+        module = sys.modules.get(module_name)
+        if module is not None:
+            module.DATABASE_PATH = db_path
+
+def fingerprint_query(query):
+    """
+    Normalizes a SQL query into a fingerprint shared by every execution of the same query shape: comments are removed,
+    string and numeric literals are replaced by placeholders, lists of placeholders are collapsed, and whitespace and
+    case are normalized.
+    :param query: The SQL query string.
+    :return: Normalized query string.
+    """
+    fingerprint = re.sub(r'--[^\n]*', ' ', query)
+    fingerprint = re.sub(r'/\*.*?\*/', ' ', fingerprint, flags=re.DOTALL)
+    fingerprint = re.sub(r"'(?:[^']|'')*'", '?', fingerprint)
+    fingerprint = re.sub(r'\b\d+(?:\.\d+)?\b', '?', fingerprint)
+    fingerprint = re.sub(r'\(\s*\?(?:\s*,\s*\?)+\s*\)', '(?+)', fingerprint)
+    fingerprint = re.sub(r'\s+', ' ', fingerprint).strip().rstrip(';').strip()
+    return fingerprint.lower()
+
+def explain_query_plan(conn, query, params=()):
+    """
+    Captures the EXPLAIN QUERY PLAN output of a query.
+    :param conn: Open SQLite connection.
+    :param query: The SQL query string.
+    :param params: Query parameters.
+    :return: List of plan detail strings, or None if the plan could not be captured.
+    """
+    try:
+        return [row[-1] for row in conn.execute(f'EXPLAIN QUERY PLAN {query}', params).fetchall()]
+    except sqlite3.Error as e:
+        logs.log_warning(f'Query plan could not be captured. Error: {e}')
+        return None
+
+def record_query(conn, query, params, duration_seconds, row_count):
+    """
+    Records one query execution: logs the duration, row count, and fingerprint, updates the per-fingerprint stats, and
+    captures the query plan when the query took longer than SLOW_QUERY_THRESHOLD_MS.
+    :param conn: The open connection the query ran on, used to capture the query plan.
+    :param query: The SQL query string.
+    :param params: Query parameters.
+    :param duration_seconds: Query duration in seconds.
+    :param row_count: Number of rows returned.
+    :return: None
+    """
+    if not settings.ENABLE_QUERY_STATS:
+        return
+
+    fingerprint = fingerprint_query(query)
+    duration_ms = duration_seconds * 1000
+    slow = duration_ms >= settings.SLOW_QUERY_THRESHOLD_MS
+    plan = explain_query_plan(conn, query, params) if slow else None
+
+    with _query_stats_lock:
+        stats = _query_stats.setdefault(fingerprint, {
+            'fingerprint': fingerprint, 'calls': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'rows': 0, 'slow_calls': 0,
+            'query_plan': None,
+        })
+        stats['calls'] += 1
+        stats['total_ms'] += duration_ms
+        stats['max_ms'] = max(stats['max_ms'], duration_ms)
+        stats['rows'] += row_count
+        if slow:
+            stats['slow_calls'] += 1
+            stats['query_plan'] = plan
+
+    if settings.LOG_QUERIES:
+        logs.log_event(f'Query completed in {duration_ms:.2f} ms, {row_count} rows: {fingerprint}')
+    if slow:
+        logs.log_warning(f'Slow query ({duration_ms:.2f} ms, {row_count} rows): {fingerprint}\n'
+                         f'\tQuery plan: {plan}')
+
+def get_query_stats():
+    """
+    Returns the per-fingerprint query statistics collected in this process, sorted by total time spent.
+    :return: List of dictionaries.
+    """
+    with _query_stats_lock:
+        stats = [dict(entry, avg_ms=entry['total_ms'] / entry['calls']) for entry in _query_stats.values()]
+    return sorted(stats, key=lambda entry: entry['total_ms'], reverse=True)
+
+def reset_query_stats():
+    """Clears the collected query statistics."""
+    with _query_stats_lock:
+        _query_stats.clear()
+
+@profiling.profile_stage()
 def execute_custom_query(query):
     """
     Executes a custom SQL query on the desired table and returns the result as a Pandas DataFrame.
@@ -17,10 +128,14 @@ def execute_custom_query(query):
     :param query: The SQL query string to execute.
     :return: Pandas DataFrame containing the query result.
     """
+    import pandas as pd  # Imported lazily, so the API and the CLI don't pay for pandas until a DataFrame is needed.
+
     conn = sqlite3.connect(DATABASE_PATH)
     try:
         # Execute the query and fetch the results
+        start = time.perf_counter()
         result = pd.read_sql_query(query, conn)
+        record_query(conn, query, (), time.perf_counter() - start, len(result))
         conn.close()
         return result
     except Exception as e:
@@ -28,17 +143,189 @@ def execute_custom_query(query):
         logs.log_error(f'An error occurred while executing the query: {e}')
         raise ValueError(f"An error occurred while executing the query: {e}")
 
-def query_db_for_api(query, params=()):
+@profiling.profile_stage()
+def query_db_for_api(query, params=(), db_path=None):
     """
     Function used to query SQLite Database
     :param query:
     :param params:
+    :param db_path: Database to query. Defaults to DATABASE_PATH.
     :return:
     """
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = sqlite3.connect(db_path or DATABASE_PATH)
     conn.row_factory = sqlite3.Row  # To access columns by name
     cur = conn.cursor()
+    start = time.perf_counter()
     cur.execute(query, params)
     result = cur.fetchall()
+    record_query(conn, query, params, time.perf_counter() - start, len(result))
     conn.close()
-    return result
\ No newline at end of file
+    profiling.record_rows(len(result))
+    return result
+
+def iterate_db_for_api(query, params=(), fetch_size=None, db_path=None):
+    """
+    Generator variant of query_db_for_api. Rows are fetched from the cursor in batches and yielded one at a time so the
+    full result set is never held in memory. The connection is closed once the generator is exhausted or closed.
+    The recorded query duration covers the time spent fetching rows, not the time the caller spends consuming them.
+    :param query: The SQL query string to execute.
+    :param params: Query parameters.
+    :param fetch_size: Number of rows fetched from the cursor per batch.
+    :param db_path: Database to query. Defaults to DATABASE_PATH.
+    :return: Generator of sqlite3.Row objects.
+    """
+    fetch_size = fetch_size or settings.STREAM_FETCH_SIZE
+    conn = sqlite3.connect(db_path or DATABASE_PATH)
+    conn.row_factory = sqlite3.Row  # To access columns by name
+    row_count = 0
+    fetch_seconds = 0.0
+    try:
+        cur = conn.cursor()
+        start = time.perf_counter()
+        cur.execute(query, params)
+        while True:
+            rows = cur.fetchmany(fetch_size)
+            fetch_seconds += time.perf_counter() - start
+            if not rows:
+                break
+            row_count += len(rows)
+            yield from rows
+            start = time.perf_counter()
+    finally:
+        record_query(conn, query, params, fetch_seconds, row_count)
+        conn.close()
+
+def get_user_db_path(user_id):
+    """
+    Routes a point query for a user to the database storing the user.
+    :param user_id: User ID, as an integer or a string.
+    :return: DATABASE_PATH, or the path of the user's shard when sharded storage is enabled.
+    """
+    if not sharding.is_sharded():
+        return DATABASE_PATH
+    if not str(user_id).isdigit():
+        # IDs that are not positive integers match no user in any shard.
+        return sharding.shard_path(0, DATABASE_PATH)
+    return sharding.shard_path(sharding.shard_for_user(user_id), DATABASE_PATH)
+
+@profiling.profile_stage()
+def scatter_gather(query, params=()):
+    """
+    Runs a query on every shard concurrently and concatenates the results. Runs on DATABASE_PATH alone when sharded
+    storage is disabled.
+    :param query: The SQL query string to execute.
+    :param params: Query parameters.
+    :return: List of dictionaries.
+    """
+    paths = sharding.shard_paths(DATABASE_PATH) if sharding.is_sharded() else [DATABASE_PATH]
+    with ThreadPoolExecutor(max_workers=len(paths)) as executor:
+        results = list(executor.map(lambda path: query_db_for_api(query, params, db_path=path), paths))
+    return [dict(row) for rows in results for row in rows]
+
+def merge_top_rows(rows, sort_column, limit):
+    """
+    Merges the top rows gathered from every shard into the overall top rows.
+    :param rows: List of dictionaries, containing the top `limit` rows of each shard.
+    :param sort_column: Column the rows are ranked by, in descending order.
+    :param limit: Number of rows to keep.
+    :return: List of dictionaries.
+    """
+    return heapq.nlargest(limit, rows, key=lambda row: row[sort_column])
+
+def merge_summed_rows(rows, group_columns, sum_columns):
+    """
+    Merges rows gathered from every shard by summing the given columns of rows with the same group columns.
+    :param rows: List of dictionaries.
+    :param group_columns: Columns identifying a group.
+    :param sum_columns: Columns summed within a group.
+    :return: List of dictionaries, sorted by the group columns.
+    """
+    merged = {}
+    for row in rows:
+        key = tuple(row[column] for column in group_columns)
+        if key not in merged:
+            merged[key] = dict(row)
+        else:
+            for column in sum_columns:
+                merged[key][column] += row[column]
+    return [merged[key] for key in sorted(merged)]
+
+def set_metadata(key, value, conn=None):
+    """
+    Stores a key/value pair in the pipeline_metadata table, creating the table if it doesn't exist.
+    :param key: Metadata key.
+    :param value: Metadata value, stored as text.
+    :param conn: Optional open connection. The write joins the caller's transaction when a connection is given.
+    :return: None
+    """
+    own_connection = conn is None
+    if own_connection:
+        conn = sqlite3.connect(DATABASE_PATH)
+    try:
+        conn.execute("CREATE TABLE IF NOT EXISTS pipeline_metadata (key TEXT PRIMARY KEY, value TEXT);")
+        conn.execute("INSERT OR REPLACE INTO pipeline_metadata (key, value) VALUES (?, ?);", (key, str(value)))
+        if own_connection:
+            conn.commit()
+    finally:
+        if own_connection:
+            conn.close()
+
+def get_metadata(key, default=None):
+    """
+    Reads a value from the pipeline_metadata table.
+    :param key: Metadata key.
+    :param default: Value returned if the key or the table doesn't exist.
+    :return: Metadata value as text, or the default.
+    """
+    conn = sqlite3.connect(DATABASE_PATH)
+    try:
+        row = conn.execute("SELECT value FROM pipeline_metadata WHERE key = ?;", (key,)).fetchone()
+    except sqlite3.OperationalError:
+        row = None
+    finally:
+        conn.close()
+    return row[0] if row else default
+
+def bump_data_version():
+    """
+    Records that the data served by the API has changed. Called at the end of ingestion and ETL so API responses can be
+    revalidated against the current data version.
+    :return: The new data version string.
+    """
+    data_version = uuid.uuid4().hex
+    set_metadata('data_version', data_version)
+    logs.log_event(f'Data version updated to {data_version}.')
+    return data_version
+
+def get_table_version(table):
+    """
+    Returns the version ingestion last recorded for a table, or None if the table was never versioned.
+    :param table: Table name.
+    :return: Version string or None.
+    """
+    return get_metadata(f'table_version:{table}')
+
+def bump_table_version(table, conn=None):
+    """
+    Records that the contents of a table changed, so pipeline stages reading the table are not skipped.
+    :param table: Table name.
+    :param conn: Optional open connection. The write joins the caller's transaction when a connection is given.
+    :return: The new table version string.
+    """
+    table_version = uuid.uuid4().hex
+    set_metadata(f'table_version:{table}', table_version, conn)
+    return table_version
+
+def table_has_rows(table):
+    """
+    Checks whether a table exists and contains at least one row.
+    :param table: Table name.
+    :return: bool
+    """
+    conn = sqlite3.connect(DATABASE_PATH)
+    try:
+        return conn.execute(f"SELECT 1 FROM {table} LIMIT 1;").fetchone() is not None
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        conn.close()